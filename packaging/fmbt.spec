@@ -238,6 +238,7 @@ rm -f $RPM_BUILD_ROOT/%{_libdir}/python*/site-packages/eye4graphics.la
 %defattr(-, root, root, -)
 %{_bindir}/%{name}-log
 %{_bindir}/%{name}-stats
+%{_bindir}/%{name}-oirbench
 %{_bindir}/%{name}-view
 %{_bindir}/lsts2dot
 %{_bindir}/%{name}-ucheck
@@ -76,3 +76,754 @@ ti.refreshScreenshot("screenshot2-icon.png")
 print ti.verifyBitmap("screenshot2.png")' 2>&1 | grep -q False && {
     testpassed
 } ) || testpassed
+
+teststep "eye4graphics: screenshot from raw data"
+( python -c '
+import os
+import tempfile
+import fmbtgti
+ss = fmbtgti.Screenshot("screenshot2.png", oirEngine=fmbtgti._defaultOirEngine())
+width, height = ss.size()
+data = "".join([chr(c) for y in xrange(height) for x in xrange(width)
+                for c in ss.getColor((x, y))])
+class RawConnection(fmbtgti.GUITestConnection):
+    def recvScreenshotData(self):
+        return (width, height, "RGB", data)
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(RawConnection())
+ti.setScreenshotDir(tempfile.mkdtemp())
+s = ti.refreshScreenshot()
+assert not os.access(s._filename, os.F_OK), "screenshot file written too early"
+assert s.findItemsByBitmap("screenshot2-icon.png")[0].bbox() == (6, 6, 27, 24)
+assert os.access(s.filename(), os.R_OK), "screenshot file not written"
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: bitmap cache"
+( python -c '
+import os, shutil, tempfile
+import fmbtgti
+d = tempfile.mkdtemp()
+bitmap = os.path.join(d, "icon.png")
+shutil.copy("screenshot2-icon.png", bitmap)
+ti = fmbtgti.GUITestInterface()
+s = ti.refreshScreenshot("screenshot2-icon.png")
+oe = ti.oirEngine()
+oe.setResultCacheSize(0)
+assert [i.bbox() for i in s.findItemsByBitmap(bitmap)] == [(0, 0, 21, 18)]
+assert bitmap in oe._bitmapCache
+# modified bitmap file is reloaded
+shutil.copy("screenshot2.png", bitmap)
+st = os.stat(bitmap)
+os.utime(bitmap, (st.st_atime, st.st_mtime + 10))
+s = ti.refreshScreenshot("screenshot2-icon.png")
+assert s.findItemsByBitmap(bitmap) == []
+st = os.stat(bitmap)
+assert oe._bitmapCache[bitmap][0] == (st.st_mtime, st.st_size)
+# cache size is respected
+oe.setBitmapCacheSize(0)
+assert len(oe._bitmapCache) == 0 and oe._bitmapCacheBytes == 0
+s.findItemsByBitmap("screenshot2-icon.png")
+assert len(oe._bitmapCache) == 0 and oe._bitmapCacheBytes == 0
+oe.setBitmapCacheSize(1024 * 1024)
+s = ti.refreshScreenshot("screenshot2-icon.png")
+s.findItemsByBitmap("screenshot2-icon.png")
+assert len(oe._bitmapCache) == 1
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: find many bitmaps at once"
+( python -c '
+import fmbtgti
+ti = fmbtgti.GUITestInterface()
+s = ti.refreshScreenshot("screenshot2-icon.png")
+items = s.findItemsByBitmaps(["screenshot2.png", "screenshot2-icon.png"], limit=1)
+assert [[i.bbox() for i in l] for l in items] == [[], [(0, 0, 21, 18)]], items
+s = ti.refreshScreenshot("screenshot2-icon.png")
+items = s.findItemsByBitmaps(["screenshot2.png", "screenshot2-icon.png"], limit=1, threads=4)
+assert [[i.bbox() for i in l] for l in items] == [[], [(0, 0, 21, 18)]], items
+assert ti.waitAnyBitmap(["screenshot2.png", "screenshot2-icon.png"], waitTime=0) == ["screenshot2-icon.png"]
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "visual log: find items by OCR"
+( python -c '
+import tempfile
+import fmbtgti
+class WordsOcrEngine(fmbtgti.OcrEngine):
+    def __init__(self, *args, **kwargs):
+        fmbtgti.OcrEngine.__init__(self, *args, **kwargs)
+        self._ss = {}
+    def _addScreenshot(self, screenshot, **findTextDefaults):
+        self._ss[id(screenshot)] = screenshot.filename()
+    def _removeScreenshot(self, screenshot):
+        del self._ss[id(screenshot)]
+    def _findText(self, screenshot, text, lang=None):
+        if lang != "fin":
+            return []
+        return [fmbtgti.GUIItem("OCR text", (2, 2, 20, 10), self._ss[id(screenshot)],
+                                ocrFind=text, ocrFound=text)]
+d = tempfile.mkdtemp()
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(fmbtgti.SimulatedGUITestConnection(["screenshot2.png"]))
+ti.setOcrEngine(WordsOcrEngine())
+ti.setScreenshotDir(d)
+ti.enableVisualLog(d + "/log.html")
+s = ti.refreshScreenshot()
+s._notifyOcrEngine()
+ti.ocrEngine().setScreenshotFindTextDefaults(s, lang="fin")
+assert [i.bbox() for i in s.findItemsByOcr("hello")] == [(2, 2, 20, 10)]
+assert ti.verifyOcrText("hello")
+ti.close()
+html = file(d + "/log.html").read()
+assert "findItemsByOcr" in html, "findItemsByOcr not logged"
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "visual log: wait any bitmap"
+( python -c '
+import glob
+import tempfile
+import fmbtgti
+d = tempfile.mkdtemp()
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(fmbtgti.SimulatedGUITestConnection(["screenshot2-icon.png"]))
+ti.setScreenshotDir(d)
+ti.enableVisualLog(d + "/log.html")
+assert ti.waitAnyBitmap(["screenshot2.png", "screenshot2-icon.png"], waitTime=0) == ["screenshot2-icon.png"]
+ti.close()
+html = file(d + "/log.html").read()
+assert "findItemsByBitmaps" in html, "findItemsByBitmaps not logged"
+assert glob.glob(d + "/*.00001.png"), "no highlight image"
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: find bitmap in parallel threads"
+( python -c '
+import fmbtgti
+ti = fmbtgti.GUITestInterface()
+s = ti.refreshScreenshot("screenshot2.png")
+serial = [i.bbox() for i in s.findItemsByBitmap("screenshot2-icon.png", allowOverlap=True)]
+threaded = [i.bbox() for i in s.findItemsByBitmap("screenshot2-icon.png", allowOverlap=True, threads=4)]
+assert serial and serial == threaded, (serial, threaded)
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: adjust parameters in parallel"
+( python -c '
+import fmbtgti
+ti = fmbtgti.GUITestInterface()
+oe = ti.oirEngine()
+oe.setResultCacheSize(0)
+def adjust(**kwargs):
+    # fresh screenshot, results of previous searches are not reused
+    s = ti.refreshScreenshot("screenshot2.png")
+    return [(i.bbox(), p) for i, p in oe.adjustParameters(
+        s, "screenshot2-icon.png", scaleRange=[1.0, 1.1],
+        colorMatchRange=[1.0, 0.9], pixelSizeRange=[1, 2], **kwargs)]
+for resultCount in [0, 1, 3]:
+    serial = adjust(resultCount=resultCount)
+    assert serial, "no parameters found"
+    for parallel in [2, 4]:
+        parallelResults = adjust(resultCount=resultCount, parallel=parallel)
+        assert parallelResults == serial, (resultCount, parallel, serial, parallelResults)
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: vectorized and scalar color comparison"
+( python -c '
+import os, subprocess
+findAll = "\n".join([
+    "import fmbtgti",
+    "s = fmbtgti.GUITestInterface().refreshScreenshot(\"screenshot2.png\")",
+    "print fmbtgti.eye4graphics.colorCompareKernel()",
+    "for colorMatch in [1.0, 0.9, 0.5]:",
+    "    print [i.bbox() for i in s.findItemsByBitmap(\"screenshot2-icon.png\", colorMatch=colorMatch)]",
+    "    print [i.bbox() for i in s.findItemsByColor((255, 255, 255), colorMatch=colorMatch, limit=10)]"])
+results = []
+for simd in ["0", "1"]:
+    env = dict(os.environ)
+    env["EYE4GRAPHICS_SIMD"] = simd
+    results.append(subprocess.check_output(["python", "-c", findAll], env=env).splitlines())
+assert results[0][0] == "scalar", results[0][0]
+assert results[0][1:] == results[1][1:], results
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: in-process preprocessing"
+( python -c '
+import fmbtgti, subprocess
+def noConvert(*args, **kwargs):
+    raise AssertionError("convert called: %s" % (args,))
+subprocess.call = noConvert
+ti = fmbtgti.GUITestInterface()
+s = ti.refreshScreenshot("screenshot2.png")
+assert s.crop((0, 0, 21, 18)).size() == (21, 18)
+assert s.flop().flop().getColor((3, 4)) == s.getColor((3, 4))
+assert s.flip().getColor((3, 0)) == s.getColor((3, s.size()[1] - 1))
+assert s.findItemsByBitmap("screenshot2-icon.png", preprocess="-threshold 60%")
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: bulk pixel access"
+( python -c '
+import fmbtgti
+s = fmbtgti.GUITestInterface().refreshScreenshot("screenshot2.png")
+w, h = s.size()
+reds, greens, blues = s.colorHistogram((0, 0, 8, 4))
+assert sum(reds) == sum(greens) == sum(blues) == 32
+colors = [s.getColor((x, y)) for x in xrange(8) for y in xrange(4)]
+for c in xrange(3):
+    assert abs(s.meanColor((0, 0, 8, 4))[c] - sum(color[c] for color in colors) / 32.0) < 1e-9
+try:
+    import numpy
+except ImportError:
+    numpy = None
+if numpy:
+    p = s.pixels()
+    assert p.shape == (h, w, 3), p.shape
+    assert tuple(p[h-1, w-1]) == s.getColor((w-1, h-1))
+    assert all(tuple(p[y, x]) == s.getColor((x, y)) for x in xrange(8) for y in xrange(4))
+    # the array keeps the image open after the screenshot is released
+    s.release()
+    del s
+    assert [tuple(p[y, x]) for x in xrange(8) for y in xrange(4)] == colors
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: group adjacent pixels by color"
+( python -c '
+import fmbtgti
+s = fmbtgti.GUITestInterface().refreshScreenshot("screenshot2.png")
+color = s.getColor((0, 0))
+area = (0, 0, 40, 30)
+pixels = set((x, y) for x in xrange(40) for y in xrange(30) if s.getColor((x, y)) == color)
+for connectivity in [4, 8]:
+    items = s.findItemsByColor(color, limit=-1, area=area, group="adjacent", connectivity=connectivity)
+    assert items and items[0].bbox()[:2] == (0, 0), items
+    bboxes = [i.bbox() for i in items]
+    # every matching pixel belongs to a group, groups are in scan order
+    assert all(any(l <= x <= r and t <= y <= b for (l, t, r, b) in bboxes) for (x, y) in pixels)
+    assert bboxes[:2] == [i.bbox() for i in s.findItemsByColor(color, limit=2, area=area, group="adjacent", connectivity=connectivity)]
+    if connectivity == 4:
+        groups4 = len(items)
+assert len(items) <= groups4
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: filter overlapping bitmap matches"
+( python -c '
+import fmbtgti
+s = fmbtgti.GUITestInterface().refreshScreenshot("screenshot2.png")
+allItems = s.findItemsByBitmap("screenshot2-icon.png", colorMatch=0.7, allowOverlap=True)
+items = s.findItemsByBitmap("screenshot2-icon.png", colorMatch=0.7)
+accepted = []
+for (l, t, r, b) in [i.bbox() for i in allItems]:
+    if not [a for a in accepted if
+            (a[0] <= l <= a[2] or a[0] <= r <= a[2]) and (a[1] <= t <= a[3] or a[1] <= b <= a[3]) and
+            ((a[0] < l < a[2] or a[0] < r < a[2]) or (a[1] < t < a[3] or a[1] < b < a[3]))]:
+        accepted.append((l, t, r, b))
+assert [i.bbox() for i in items] == accepted, (items, accepted)
+assert type(items) == list
+items.append(items.pop(0))
+assert [i.bbox() for i in s.findItemsByBitmap("screenshot2-icon.png", colorMatch=0.7)] == accepted
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: coarse-to-fine pyramid search"
+( python -c '
+import fmbtgti
+s = fmbtgti.GUITestInterface().refreshScreenshot("screenshot2.png")
+engine = s.oirEngine()
+engine.setResultCacheSize(0)
+for kwargs in [{}, {"colorMatch": 0.9}, {"scale": 0.75}, {"limit": 1, "area": (5, 5, 1.0, 1.0)}]:
+    exhaustive = [i.bbox() for i in s.findItemsByBitmap("screenshot2-icon.png", allowOverlap=True, **kwargs)]
+    for pyramid in [1, 2]:
+        engine._findBitmapCache[s.filename()].clear()
+        found = [i.bbox() for i in s.findItemsByBitmap("screenshot2-icon.png", allowOverlap=True, pyramid=pyramid, **kwargs)]
+        assert found == exhaustive, (kwargs, pyramid, found, exhaustive)
+# samples of the bitmap and the screenshot are reused by later searches
+sampleImage = fmbtgti.eye4graphics.sampleImage
+samplings = []
+def countingSampleImage(*args):
+    samplings.append(args)
+    return sampleImage(*args)
+fmbtgti.eye4graphics.sampleImage = countingSampleImage
+engine._findBitmapCache[s.filename()].clear()
+assert s.findItemsByBitmap("screenshot2-icon.png", pyramid=2)
+fmbtgti.eye4graphics.sampleImage = sampleImage
+assert samplings == [], len(samplings)
+engine.invalidateBitmapCache()
+assert engine._bitmapSamples == {} and engine._bitmapCacheBytes == 0
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: changed regions between screenshots"
+( python -c '
+import fmbtgti
+ti = fmbtgti.GUITestInterface()
+s1 = ti.refreshScreenshot("screenshot2.png")
+s2 = ti.refreshScreenshot("screenshot2.png")
+assert s1.changedRegions(s2) == []
+w, h = s1.size()
+flopped = s1.flop()
+regions = flopped.changedRegions(s1, tileSize=16)
+assert regions and all(0 <= l < r <= w and 0 <= t < b <= h for (l, t, r, b) in regions), regions
+assert s1.changedRegions(s1.crop((0, 0, 10, 10))) == [(0, 0, w, h)]
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: incremental bitmap search"
+( python -c '
+import fmbtgti
+ti = fmbtgti.GUITestInterface()
+s = ti.refreshScreenshot("screenshot2.png")
+screenshots = [s, s.crop((0, 0, 1.0, 1.0)), s.flip(), s.flop(), s]
+for kwargs in [{}, {"colorMatch": 0.8}, {"limit": 1}]:
+    for ss in screenshots:
+        incremental = [i.bbox() for i in ss.findItemsByBitmap("screenshot2-icon.png", incremental=True, **kwargs)]
+        ss.oirEngine()._findBitmapCache[ss._filename].clear()
+        full = [i.bbox() for i in ss.findItemsByBitmap("screenshot2-icon.png", **kwargs)]
+        ss.oirEngine()._findBitmapCache[ss._filename].clear()
+        assert incremental == full, (kwargs, ss, incremental, full)
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: content-addressed result cache"
+( python -c '
+import fmbtgti
+ti = fmbtgti.GUITestInterface()
+s1 = ti.refreshScreenshot("screenshot2.png")
+found1 = [i.bbox() for i in s1.findItemsByBitmap("screenshot2-icon.png")]
+hits = ti.oirEngine().resultCacheStats()["hits"]
+s2 = ti.refreshScreenshot("screenshot2.png")
+found2 = [i.bbox() for i in s2.findItemsByBitmap("screenshot2-icon.png")]
+assert found1 == found2, (found1, found2)
+assert ti.oirEngine().resultCacheStats()["hits"] == hits + 1
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: rotate screenshot in memory"
+( python -c '
+import os
+import tempfile
+import fmbtgti
+ss = fmbtgti.Screenshot("screenshot2.png", oirEngine=fmbtgti._defaultOirEngine())
+width, height = ss.size()
+data = "".join([chr(c) for y in xrange(height) for x in xrange(width)
+                for c in ss.getColor((x, y))])
+class RawConnection(fmbtgti.GUITestConnection):
+    def recvScreenshotData(self):
+        return (width, height, "RGB", data)
+ti = fmbtgti.GUITestInterface(rotateScreenshot=90)
+ti.setConnection(RawConnection())
+ti.setScreenshotDir(tempfile.mkdtemp())
+s = ti.refreshScreenshot()
+assert not os.access(s._filename, os.F_OK), "rotated screenshot file written"
+assert s.size() == (height, width), s.size()
+assert s.getColor((height - 1, 0)) == ss.getColor((0, 0))
+assert ti.refreshScreenshot(rotate=180).size() == (width, height)
+assert ti.refreshScreenshot(rotate=270).size() == (height, width)
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: archive screenshots in background"
+( python -c '
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import fmbtgti
+d = tempfile.mkdtemp()
+ti = fmbtgti.GUITestInterface()
+ti.setScreenshotLimit(1)
+ti.setScreenshotArchiveMethod("resize 10x10")
+for i in xrange(4):
+    f = "%s/%s.png" % (d, i)
+    shutil.copy("screenshot2.png", f)
+    ti.refreshScreenshot(f)
+ti.refreshScreenshot("screenshot2.png")
+ti.close()
+sizes = [max(fmbtgti.Screenshot(f).size()) for f in sorted(glob.glob(d + "/*.png"))]
+assert sizes[:3] == [10, 10, 10] and sizes[3] > 10, sizes
+assert sorted(os.listdir(d)) == ["0.png", "1.png", "2.png", "3.png"], os.listdir(d)
+# screenshots queued for archiving are archived at exit without close
+d = tempfile.mkdtemp()
+subprocess.check_call([sys.executable, "-c", "\n".join([
+    "import shutil, sys, fmbtgti",
+    "ti = fmbtgti.GUITestInterface()",
+    "ti.setScreenshotLimit(1)",
+    "ti.setScreenshotArchiveMethod(\"resize 10x10\")",
+    "for i in xrange(4):",
+    "    f = \"%s/%s.png\" % (sys.argv[1], i)",
+    "    shutil.copy(\"screenshot2.png\", f)",
+    "    ti.refreshScreenshot(f)",
+    "ti.refreshScreenshot(\"screenshot2.png\")"]), d])
+sizes = [max(fmbtgti.Screenshot(f).size()) for f in sorted(glob.glob(d + "/*.png"))]
+assert sizes[:3] == [10, 10, 10], sizes
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: release screenshots without garbage collection"
+( python -c '
+import gc
+import StringIO
+import weakref
+import fmbtgti
+gc.disable()
+ti = fmbtgti.GUITestInterface()
+ti.enableVisualLog(StringIO.StringIO(), delayedDrawing=True)
+s = ti.refreshScreenshot("screenshot2.png")
+assert s.findItemsByBitmap("screenshot2-icon.png")
+oirEngine = ti.oirEngine()
+assert "screenshot2.png" in oirEngine._openedImages
+r = weakref.ref(s)
+del s
+ti.refreshScreenshot("screenshot2-icon.png")
+assert r() == None, "screenshot not freed"
+assert not "screenshot2.png" in oirEngine._openedImages
+s = ti.screenshot()
+assert s.findItemsByBitmap("screenshot2-icon.png")
+s.release()
+assert not "screenshot2-icon.png" in oirEngine._openedImages
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: prefetch screenshots"
+( python -c '
+import tempfile
+import time
+import fmbtgti
+ss = fmbtgti.Screenshot("screenshot2.png", oirEngine=fmbtgti._defaultOirEngine())
+width, height = ss.size()
+data = "".join([chr(c) for y in xrange(height) for x in xrange(width)
+                for c in ss.getColor((x, y))])
+class RawConnection(fmbtgti.GUITestConnection):
+    captures = 0
+    def recvScreenshotData(self):
+        time.sleep(0.1)
+        self.captures += 1
+        return (width, height, "RGB", data)
+conn = RawConnection()
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(conn)
+ti.setScreenshotDir(tempfile.mkdtemp())
+try:
+    ti.setScreenshotPrefetch(True)
+    raise AssertionError("prefetch enabled on a shared channel connection")
+except fmbtgti.ConnectionError:
+    pass
+assert not ti.screenshotPrefetch()
+conn.canRecvScreenshotConcurrently = lambda: True
+ti.setScreenshotPrefetch(True)
+time.sleep(0.3)
+t = time.time()
+s = ti.refreshScreenshot()
+assert time.time() - t < 0.05, "prefetched screenshot not ready"
+t = time.time()
+s = ti.refreshScreenshot(newerThan=t)
+assert time.time() - t >= 0.1, "too old screenshot"
+assert s.findItemsByBitmap("screenshot2-icon.png")[0].bbox() == (6, 6, 27, 24)
+ti.close()
+captures = conn.captures
+time.sleep(0.3)
+assert conn.captures == captures, "capturing continued after close"
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: adaptive polling in wait"
+( python -c '
+import tempfile
+import fmbtgti
+ss = fmbtgti.Screenshot("screenshot2.png", oirEngine=fmbtgti._defaultOirEngine())
+width, height = ss.size()
+data = "".join([chr(c) for y in xrange(height) for x in xrange(width)
+                for c in ss.getColor((x, y))])
+class RawConnection(fmbtgti.GUITestConnection):
+    def recvScreenshotData(self):
+        return (width, height, "RGB", data)
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(RawConnection())
+ti.setScreenshotDir(tempfile.mkdtemp())
+assert not ti.waitBitmap("screenshot2-icon.png", area=(0.5, 0.5, 1.0, 1.0),
+                         waitTime=0.5, pollDelay=0.2, minPollDelay=0.01)
+stats = ti.waitStats()
+# delays 0.01, 0.02, 0.04, 0.08, 0.16, 0.19 => 6 polls in 0.5 s
+assert 5 <= stats["polls"] <= 6, stats
+# the screen never changed, waitFunc was evaluated only once
+assert stats["evaluations"] == 1, stats
+assert ti.waitBitmap("screenshot2-icon.png", waitTime=0.5, minPollDelay=0.01)
+assert ti.waitStats()["polls"] == 0
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "waitAny: concurrent evaluation"
+( python -c '
+import time
+import fmbtgti
+ti = fmbtgti.GUITestInterface()
+def probe(retval):
+    def f():
+        time.sleep(0.3)
+        return retval
+    return f
+funcs = [probe(False), probe(False), probe("found")]
+t = time.time()
+assert ti.waitAny(funcs, waitTime=5, concurrent=True) == [(2, funcs[2], "found")]
+assert time.time() - t < 0.6, "functions were not called concurrently"
+assert ti.waitAny(funcs[:2], waitTime=0, concurrent=True) == []
+running = []
+def slow():
+    running.append(slow)
+    time.sleep(0.5)
+    running.remove(slow)
+    return False
+def quick():
+    time.sleep(0.1)
+    return True
+assert ti.waitAny([slow, quick], waitTime=5, concurrent=True) == [(1, quick, True)]
+assert running == [], "function left running after waitAny returned"
+def hung():
+    time.sleep(3)
+    return False
+t = time.time()
+assert ti.waitAny([hung, quick], waitTime=0.5, concurrent=True) == [(1, quick, True)]
+assert time.time() - t < 1.0, "waited for a hung function after waitTime"
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "fmbt-oirbench: json and csv results"
+( fmbt-oirbench -b screenshot2-icon.png -r 2 -o /tmp/fmbt.test.oirbench.json screenshot2.png screenshot2.png >>$LOGFILE 2>&1 &&
+  fmbt-oirbench -b screenshot2-icon.png -O colorMatch=0.8 -o /tmp/fmbt.test.oirbench.csv screenshot2.png >>$LOGFILE 2>&1 &&
+  python -c '
+import json
+results = json.load(file("/tmp/fmbt.test.oirbench.json"))["results"]
+counts = dict((r["operation"], r["count"]) for r in results)
+assert counts["refreshScreenshot"] == 4, counts
+assert counts["findItemsByBitmap colorMatch=0.9"] == 4, counts
+assert counts["findItemsByDiff"] == 3, counts
+assert all(r["min"] <= r["p50"] <= r["p90"] <= r["p99"] <= r["max"] for r in results)
+lines = file("/tmp/fmbt.test.oirbench.csv").read().splitlines()
+assert lines[0] == "operation,count,min,p50,p90,p99,max,mean,total", lines
+assert lines[1].startswith("\"findItemsByBitmap colorMatch=0.8\",1,"), lines
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: perfStats instrumentation"
+( python -c '
+import os
+import StringIO
+import tempfile
+import fmbtgti
+conn = fmbtgti.SimulatedGUITestConnection(["screenshot2.png"])
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(conn)
+ti.setScreenshotDir(tempfile.mkdtemp())
+assert ti.perfStats() == None
+ti.setPerfStats(True)
+s = ti.refreshScreenshot()
+assert s.findItemsByBitmap("screenshot2-icon.png")
+ti.tap((1, 1))
+stats = ti.perfStats()
+assert stats["refreshScreenshot"]["count"] == 1, stats
+assert stats["conn.recvScreenshot"]["bytes"] == os.stat("screenshot2.png").st_size, stats
+assert stats["conn.sendTap"]["count"] == 1, stats
+assert stats["oir.findBitmap"]["count"] == 1, stats
+dump = StringIO.StringIO()
+ti.dumpPerfStats(dump)
+assert len(dump.getvalue().splitlines()) == 1 + sum(v["count"] for v in stats.values())
+# the OIR engine is shared, searches of other interfaces are not recorded
+ti2 = fmbtgti.GUITestInterface()
+ti2.setConnection(fmbtgti.SimulatedGUITestConnection(["screenshot2.png"]))
+ti2.setScreenshotDir(tempfile.mkdtemp())
+ti2.setPerfStats(True)
+ti2.refreshScreenshot().findItemsByBitmap("screenshot2-icon.png")
+assert ti.perfStats()["oir.findBitmap"]["count"] == 1, ti.perfStats()
+assert ti2.perfStats()["oir.findBitmap"]["count"] == 1, ti2.perfStats()
+assert ti.oirEngine() is ti2.oirEngine() and not "_findBitmap" in ti.oirEngine().__dict__
+ti2.setPerfStats(False)
+# only connection methods that send input or receive screenshots
+assert not "conn.target" in stats and not "conn.setScreenshotSubdir" in stats, stats
+ti.setPerfStats(False)
+assert ti.perfStats() == None
+assert not "refreshScreenshot" in ti.__dict__
+assert conn.sendTap.__name__ != "perfStatsWrapper"
+# a wrapper that cannot be removed stops recording
+ti.setPerfStats(True)
+ti.enableVisualLog(StringIO.StringIO())
+ti.setPerfStats(True)
+ti.refreshScreenshot()
+assert ti.perfStats()["refreshScreenshot"]["count"] == 1, ti.perfStats()
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "eye4graphics: prefetch errors, poll delay and timeout"
+( python -c '
+import shutil
+import tempfile
+import time
+import fmbtgti
+class FlakyConnection(fmbtgti.GUITestConnection):
+    captures = 0
+    fail = True
+    delay = 0.0
+    def canRecvScreenshotConcurrently(self):
+        return True
+    def recvScreenshot(self, filename):
+        self.captures += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise IOError("capture failed")
+        shutil.copy("screenshot2.png", filename)
+        return True
+conn = FlakyConnection()
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(conn)
+ti.setScreenshotDir(tempfile.mkdtemp())
+ti.setScreenshotPrefetch(True, pollDelay=0.2, timeout=0.5)
+try:
+    ti.refreshScreenshot()
+    raise AssertionError("capture error not raised")
+except IOError:
+    pass
+# the error is raised only once, and capturing continues
+conn.fail = False
+s = ti.refreshScreenshot(newerThan=time.time())
+assert s and s.size() == fmbtgti.Screenshot("screenshot2.png").size()
+captures = conn.captures
+time.sleep(1.0)
+assert 3 <= conn.captures - captures <= 6, conn.captures - captures
+conn.delay = 2.0
+t = time.time()
+assert ti.refreshScreenshot(newerThan=t) == None
+assert time.time() - t < 1.5, "timeout ignored"
+ti.close()
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "visual log: background writer and gzip output"
+( python -c '
+import gzip
+import tempfile
+import threading
+import fmbtgti
+d = tempfile.mkdtemp()
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(fmbtgti.SimulatedGUITestConnection(["screenshot2.png"]))
+ti.setScreenshotDir(d)
+ti.enableVisualLog(d + "/log.html.gz", delayedDrawing=True)
+ti.refreshScreenshot()
+ti.visualLog("logged message")
+ti.refreshScreenshot()
+ti.close()
+assert threading.active_count() == 1, "writer thread left running"
+html = gzip.open(d + "/log.html.gz").read()
+assert "logged message" in html
+assert "data-imgage" in html and not "\x00" in html
+assert html.rstrip().endswith("</body></html>")
+# no empty gzip files are left from splitting the log
+import os
+logDir = tempfile.mkdtemp()
+ti.enableVisualLog(logDir + "/log-%Y.html.gz")
+ti.refreshScreenshot()
+ti.close()
+logFiles = os.listdir(logDir)
+assert len(logFiles) == 1 and not "%" in logFiles[0], logFiles
+assert "</body></html>" in gzip.open(logDir + "/" + logFiles[0]).read()
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "drawing highlights without convert"
+( python -c '
+import tempfile
+import eyenfinger
+import fmbtgti
+d = tempfile.mkdtemp()
+def noConvert(cmd):
+    raise AssertionError("convert called: %s" % (cmd,))
+eyenfinger._runcmd = noConvert
+eyenfinger.drawIcon("screenshot2.png", d + "/icon.png", "icon", [(10, 10, 40, 30)])
+eyenfinger.drawClickedPoint(d + "/icon.png", d + "/icon.png", (25, 20))
+orig = fmbtgti.Screenshot("screenshot2.png")
+drawn = fmbtgti.Screenshot(d + "/icon.png")
+assert drawn.size() == orig.size()
+assert drawn.getColor((10, 20)) != orig.getColor((10, 20))
+assert drawn.getColor((0, 0)) == orig.getColor((0, 0))
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
+
+teststep "drag as one input sequence"
+( python -c '
+import time
+import fmbtgti
+sequences = []
+class SequenceConnection(fmbtgti.SimulatedGUITestConnection):
+    def sendInputSequence(self, events, **kwargs):
+        sequences.append(events)
+        return True
+conn = SequenceConnection(["screenshot2.png"])
+ti = fmbtgti.GUITestInterface()
+ti.setConnection(conn)
+ti.refreshScreenshot()
+assert ti.drag((10, 10), (50, 10), delayBetweenMoves=0.5, movePoints=4)
+assert conn.history()[-1][1] == "recvScreenshot", "events not sent in one sequence"
+events = sequences[0]
+assert [e[0] for e in events] == ["down"] + ["move"] * 4 + ["up"], events
+assert events[1][1:] == (18, 10, 0.5), events
+assert events[-1][1:] == (50, 10, 2.5), events
+assert ti.swipe((10, 10), "east", movePoints=1)
+assert sequences[1][-1][0] == "up"
+# connections that are not GUITestConnections may lack sendInputSequence
+class TouchConnection(object):
+    def __init__(self):
+        self.events = []
+    def sendTouchDown(self, x, y):
+        self.events.append(("down", x, y, time.time()))
+        return True
+    def sendTouchMove(self, x, y):
+        self.events.append(("move", x, y, time.time()))
+        return True
+    def sendTouchUp(self, x, y):
+        self.events.append(("up", x, y, time.time()))
+        return True
+conn = TouchConnection()
+ti.setConnection(conn)
+assert ti.drag((10, 10), (50, 10), delayBetweenMoves=0, movePoints=4)
+assert [e[:3] for e in conn.events] == [("down", 10, 10), ("move", 18, 10), ("move", 26, 10),
+    ("move", 34, 10), ("move", 42, 10), ("up", 50, 10)], conn.events
+conn.events = []
+assert ti.tap((5, 5), hold=0.2)
+assert [e[:3] for e in conn.events] == [("down", 5, 5), ("up", 5, 5)], conn.events
+assert conn.events[1][3] - conn.events[0][3] >= 0.19, conn.events
+print "ok"' 2>&1 | tee -a $LOGFILE | grep -q ^ok$ && {
+    testpassed
+} ) || testfailed
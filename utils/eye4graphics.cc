@@ -19,13 +19,36 @@
 
 #include <algorithm>
 #include <climits>
+#include <cstddef>
 #include <map>
 #include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
 #include <vector>
 
 #include <magick/MagickCore.h>
 
+#if defined(__MINGW32__) || defined(_MSC_VER)
+#include <windows.h>
+#else
+#include <pthread.h>
+#endif
+
+/* Vectorized color comparison works on 16-bit quantum RGBO pixels
+ * on x86. SSE2 is always available on x86-64, AVX2 is detected at
+ * runtime. */
+#if (defined(__x86_64__) || defined(_M_X64)) && \
+    MAGICKCORE_QUANTUM_DEPTH == 16 && \
+    !(defined(MAGICKCORE_HDRI_SUPPORT) && MAGICKCORE_HDRI_SUPPORT)
+#define E4G_SSE2
+#include <emmintrin.h>
+#if defined(__GNUC__) && (__GNUC__ > 4 || (__GNUC__ == 4 && __GNUC_MINOR__ >= 9) || defined(__clang__))
+#define E4G_AVX2
+#include <immintrin.h>
+#endif
+#endif
+
 #include "eye4graphics.h"
 
 #define COLORS 64
@@ -33,11 +56,97 @@
 #define INCOMPARABLE -1
 
 #define MIN(a,b) (((a)<(b))?(a):(b))
+#define MAX(a,b) (((a)>(b))?(a):(b))
+
+/* Pixel perfect search is split to threads only if each thread gets
+ * at least this many rows to search. */
+#define MIN_ROWS_PER_THREAD 32
 
 void initeye4graphics() {}
 
 PixelPacket* getPixels(Image* image, size_t x1, size_t y1, size_t x2, size_t y2);
 
+/*
+ * Mutex protects data shared by searches running in parallel
+ * threads.
+ */
+class Mutex {
+public:
+#if defined(__MINGW32__) || defined(_MSC_VER)
+    Mutex() { InitializeCriticalSection(&cs); }
+    ~Mutex() { DeleteCriticalSection(&cs); }
+    void lock() { EnterCriticalSection(&cs); }
+    void unlock() { LeaveCriticalSection(&cs); }
+private:
+    CRITICAL_SECTION cs;
+#else
+    Mutex() { pthread_mutex_init(&m, NULL); }
+    ~Mutex() { pthread_mutex_destroy(&m); }
+    void lock() { pthread_mutex_lock(&m); }
+    void unlock() { pthread_mutex_unlock(&m); }
+private:
+    pthread_mutex_t m;
+#endif
+};
+
+class MutexLock {
+public:
+    MutexLock(Mutex& mutex_): mutex(mutex_) { mutex.lock(); }
+    ~MutexLock() { mutex.unlock(); }
+private:
+    Mutex& mutex;
+};
+
+/* imagePixelsMutex protects imagePixels, pixelCacheMutex protects
+ * pixel cache access in getPixels. If both are needed,
+ * imagePixelsMutex must be locked first. */
+static Mutex imagePixelsMutex;
+static Mutex pixelCacheMutex;
+
+/*
+ * Thread runs a function in a new thread until join() is called.
+ */
+class Thread {
+public:
+    Thread(void (*func_)(void*), void* arg_): func(func_), arg(arg_), started(false) {}
+    bool start() {
+#if defined(__MINGW32__) || defined(_MSC_VER)
+        handle = CreateThread(NULL, 0, run, this, 0, NULL);
+        started = (handle != NULL);
+#else
+        started = (pthread_create(&handle, NULL, run, this) == 0);
+#endif
+        return started;
+    }
+    void join() {
+        if (!started) return;
+#if defined(__MINGW32__) || defined(_MSC_VER)
+        WaitForSingleObject(handle, INFINITE);
+        CloseHandle(handle);
+#else
+        pthread_join(handle, NULL);
+#endif
+        started = false;
+    }
+private:
+#if defined(__MINGW32__) || defined(_MSC_VER)
+    static DWORD WINAPI run(LPVOID self) {
+        static_cast<Thread*>(self)->func(static_cast<Thread*>(self)->arg);
+        return 0;
+    }
+    HANDLE handle;
+#else
+    static void* run(void* self) {
+        static_cast<Thread*>(self)->func(static_cast<Thread*>(self)->arg);
+        return NULL;
+    }
+    pthread_t handle;
+#endif
+    void (*func)(void*);
+    void* arg;
+    bool started;
+};
+
 static int _ceil(float f) {
     int floor = int(f);
     static const float epsilon = 0.00001;
@@ -65,15 +174,17 @@ public:
 
 class Search_id_less_comparator {
 public:
+    /* std::map requires strict weak ordering, compare fields
+     * lexicographically. */
     bool operator()(const Search_id &lhs, const Search_id &rhs) const {
-        return (lhs.haystack < rhs.haystack ||
-                lhs.needle < rhs.needle ||
-                lhs.threshold < rhs.threshold ||
-                lhs.colorMatch < rhs.colorMatch ||
-                lhs.area.left < rhs.area.left ||
-                lhs.area.right < rhs.area.right ||
-                lhs.area.top < rhs.area.top ||
-                lhs.area.bottom < rhs.area.bottom);
+        if (lhs.haystack != rhs.haystack) return lhs.haystack < rhs.haystack;
+        if (lhs.needle != rhs.needle) return lhs.needle < rhs.needle;
+        if (lhs.threshold != rhs.threshold) return lhs.threshold < rhs.threshold;
+        if (lhs.colorMatch != rhs.colorMatch) return lhs.colorMatch < rhs.colorMatch;
+        if (lhs.area.left != rhs.area.left) return lhs.area.left < rhs.area.left;
+        if (lhs.area.right != rhs.area.right) return lhs.area.right < rhs.area.right;
+        if (lhs.area.top != rhs.area.top) return lhs.area.top < rhs.area.top;
+        return lhs.area.bottom < rhs.area.bottom;
     }
 };
 
@@ -103,6 +214,243 @@ inline bool same_color(const PixelPacket *p1, const PixelPacket *p2,
     }
 }
 
+/*
+ * Color comparison kernels
+ *
+ * A kernel returns the index of the first of count pixels for which
+ * same_color(a + i, b + i * bStep) equals wantMatch, or count if
+ * there is no such pixel. bStep 0 compares all pixels to *b.
+ */
+typedef int (*ColorKernel)(const PixelPacket* a, const PixelPacket* b,
+                           const int bStep, const int count,
+                           const int colorDiff,
+                           const unsigned char skipTransparency,
+                           const bool wantMatch);
+
+static int first_pixel_scalar(const PixelPacket* a, const PixelPacket* b,
+                              const int bStep, const int count,
+                              const int colorDiff,
+                              const unsigned char skipTransparency,
+                              const bool wantMatch)
+{
+    for (int i = 0; i < count; i++) {
+        if (same_color(a + i, b + i * bStep,
+                       colorDiff, skipTransparency) == wantMatch)
+            return i;
+    }
+    return count;
+}
+
+#ifdef E4G_SSE2
+/*
+ * Lanes of a vector are (blue, green, red, opacity) quantums of two
+ * pixels. Like same_color, colors are compared by their low bytes,
+ * whereas opacity is compared as a whole.
+ */
+static inline __m128i mismatch_sse2(const __m128i va, const __m128i vb,
+                                    const __m128i colorMask,
+                                    const __m128i vColorDiff,
+                                    const __m128i vSkip,
+                                    const bool skip)
+{
+    const __m128i ca = _mm_and_si128(va, colorMask);
+    const __m128i cb = _mm_and_si128(vb, colorMask);
+    const __m128i absDiff = _mm_or_si128(_mm_subs_epu16(ca, cb),
+                                         _mm_subs_epu16(cb, ca));
+    /* lane is zero if colors match */
+    __m128i mismatch = _mm_subs_epu16(absDiff, vColorDiff);
+    if (skip) {
+        /* opacity >= skipTransparency <=> skip - opacity saturates to 0 */
+        const __m128i transparent = _mm_or_si128(
+            _mm_cmpeq_epi16(_mm_subs_epu16(vSkip, va), _mm_setzero_si128()),
+            _mm_cmpeq_epi16(_mm_subs_epu16(vSkip, vb), _mm_setzero_si128()));
+        const __m128i pixelTransparent = _mm_shufflehi_epi16(
+            _mm_shufflelo_epi16(transparent, _MM_SHUFFLE(3, 3, 3, 3)),
+            _MM_SHUFFLE(3, 3, 3, 3));
+        mismatch = _mm_andnot_si128(pixelTransparent, mismatch);
+    }
+    return mismatch;
+}
+
+static int first_pixel_sse2(const PixelPacket* a, const PixelPacket* b,
+                            const int bStep, const int count,
+                            const int colorDiff,
+                            const unsigned char skipTransparency,
+                            const bool wantMatch)
+{
+    if (colorDiff >= 255 && wantMatch) return count > 0 ? 0 : count;
+    const __m128i colorMask = _mm_set_epi16(0, 0xff, 0xff, 0xff,
+                                            0, 0xff, 0xff, 0xff);
+    const __m128i vColorDiff = _mm_set1_epi16((short)MIN(colorDiff, 255));
+    const __m128i vSkip = _mm_set1_epi16((short)skipTransparency);
+    const bool skip = skipTransparency != 0;
+    __m128i vbConst = _mm_setzero_si128();
+    if (bStep == 0) {
+        long long bPixel;
+        memcpy(&bPixel, b, sizeof(bPixel));
+        vbConst = _mm_set1_epi64x(bPixel);
+    }
+    int i = 0;
+    for (; i + 2 <= count; i += 2) {
+        const __m128i va = _mm_loadu_si128((const __m128i*)(a + i));
+        const __m128i vb = bStep == 0 ? vbConst :
+            _mm_loadu_si128((const __m128i*)(b + i));
+        const __m128i mismatch = mismatch_sse2(va, vb, colorMask, vColorDiff,
+                                               vSkip, skip);
+        const int mask = _mm_movemask_epi8(
+            _mm_cmpeq_epi16(mismatch, _mm_setzero_si128()));
+        /* every pixel owns 8 bits of the mask, all set if it matches */
+        for (int p = 0; p < 2; p++) {
+            const bool match = ((mask >> (8 * p)) & 0xff) == 0xff;
+            if (match == wantMatch) return i + p;
+        }
+    }
+    return i + first_pixel_scalar(a + i, b + i * bStep, bStep, count - i,
+                                  colorDiff, skipTransparency, wantMatch);
+}
+#endif /* E4G_SSE2 */
+
+#ifdef E4G_AVX2
+__attribute__((target("avx2")))
+static int first_pixel_avx2(const PixelPacket* a, const PixelPacket* b,
+                            const int bStep, const int count,
+                            const int colorDiff,
+                            const unsigned char skipTransparency,
+                            const bool wantMatch)
+{
+    if (colorDiff >= 255 && wantMatch) return count > 0 ? 0 : count;
+    const __m256i colorMask = _mm256_set_epi16(0, 0xff, 0xff, 0xff,
+                                               0, 0xff, 0xff, 0xff,
+                                               0, 0xff, 0xff, 0xff,
+                                               0, 0xff, 0xff, 0xff);
+    const __m256i vColorDiff = _mm256_set1_epi16((short)MIN(colorDiff, 255));
+    const __m256i vSkip = _mm256_set1_epi16((short)skipTransparency);
+    const __m256i zero = _mm256_setzero_si256();
+    const bool skip = skipTransparency != 0;
+    __m256i vbConst = zero;
+    if (bStep == 0) {
+        long long bPixel;
+        memcpy(&bPixel, b, sizeof(bPixel));
+        vbConst = _mm256_set1_epi64x(bPixel);
+    }
+    int i = 0;
+    for (; i + 4 <= count; i += 4) {
+        const __m256i va = _mm256_loadu_si256((const __m256i*)(a + i));
+        const __m256i vb = bStep == 0 ? vbConst :
+            _mm256_loadu_si256((const __m256i*)(b + i));
+        const __m256i ca = _mm256_and_si256(va, colorMask);
+        const __m256i cb = _mm256_and_si256(vb, colorMask);
+        const __m256i absDiff = _mm256_or_si256(_mm256_subs_epu16(ca, cb),
+                                                _mm256_subs_epu16(cb, ca));
+        __m256i mismatch = _mm256_subs_epu16(absDiff, vColorDiff);
+        if (skip) {
+            const __m256i transparent = _mm256_or_si256(
+                _mm256_cmpeq_epi16(_mm256_subs_epu16(vSkip, va), zero),
+                _mm256_cmpeq_epi16(_mm256_subs_epu16(vSkip, vb), zero));
+            const __m256i pixelTransparent = _mm256_shufflehi_epi16(
+                _mm256_shufflelo_epi16(transparent, _MM_SHUFFLE(3, 3, 3, 3)),
+                _MM_SHUFFLE(3, 3, 3, 3));
+            mismatch = _mm256_andnot_si256(pixelTransparent, mismatch);
+        }
+        const unsigned int mask = _mm256_movemask_epi8(
+            _mm256_cmpeq_epi16(mismatch, zero));
+        if ((wantMatch && mask == 0) || (!wantMatch && mask == 0xffffffff))
+            continue;
+        for (int p = 0; p < 4; p++) {
+            const bool match = ((mask >> (8 * p)) & 0xff) == 0xff;
+            if (match == wantMatch) return i + p;
+        }
+    }
+    return i + first_pixel_sse2(a + i, b + i * bStep, bStep, count - i,
+                                colorDiff, skipTransparency, wantMatch);
+}
+#endif /* E4G_AVX2 */
+
+/*
+ * Compare a kernel to first_pixel_scalar with pixels that exercise
+ * color byte boundaries, high bytes of quantums and opacity limits.
+ */
+static bool kernel_selfcheck(ColorKernel kernel)
+{
+    const int n = 37;
+    PixelPacket a[n], b[n];
+    unsigned int seed = 4242;
+    for (int round = 0; round < 200; round++) {
+        for (int i = 0; i < n; i++) {
+            seed = seed * 1103515245 + 12345;
+            const int v = (seed >> 8) & 0xffff;
+            a[i].red = (Quantum)(v & 0xff00 ? v : v & 0xff);
+            a[i].green = (Quantum)((v >> 3) & 0x1ff);
+            a[i].blue = (Quantum)((v * 7) & 0xffff);
+            a[i].opacity = (Quantum)((v >> 4) & 0x1ff);
+            b[i] = a[i];
+            if ((seed >> 3) & 1) b[i].red = (Quantum)(b[i].red + ((seed >> 5) & 0x7));
+            if ((seed >> 4) & 1) b[i].blue = (Quantum)(b[i].blue ^ ((seed >> 9) & 0x1ff));
+            if ((seed >> 6) & 1) b[i].opacity = (Quantum)((seed >> 12) & 0x1ff);
+        }
+        const int colorDiffs[] = {0, 1, 3, 128, 255, 256};
+        const unsigned char skips[] = {0, 1, 128, 255};
+        for (int c = 0; c < 6; c++) {
+            for (int sk = 0; sk < 4; sk++) {
+                for (int bStep = 0; bStep < 2; bStep++) {
+                    for (int want = 0; want < 2; want++) {
+                        for (int start = 0; start < 4; start++) {
+                            const int count = n - start - (round % 5);
+                            if (kernel(a + start, b + start, bStep, count,
+                                       colorDiffs[c], skips[sk], want != 0) !=
+                                first_pixel_scalar(a + start, b + start,
+                                                   bStep, count,
+                                                   colorDiffs[c], skips[sk],
+                                                   want != 0))
+                                return false;
+                        }
+                    }
+                }
+            }
+        }
+    }
+    return true;
+}
+
+/*
+ * Select the fastest kernel that passes the self-check.
+ * EYE4GRAPHICS_SIMD=0 forces the scalar kernel.
+ */
+static ColorKernel select_kernel(const char** name)
+{
+    *name = "scalar";
+    const char* simd = getenv("EYE4GRAPHICS_SIMD");
+    if (simd && strcmp(simd, "0") == 0) return first_pixel_scalar;
+    const bool debug = getenv("EYE4GRAPHICS_DEBUG") != NULL;
+#ifdef E4G_AVX2
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2")) {
+        if (kernel_selfcheck(first_pixel_avx2)) {
+            *name = "avx2";
+            return first_pixel_avx2;
+        }
+        if (debug) fprintf(stderr, "eye4graphics: avx2 self-check failed\n");
+    }
+#endif
+#ifdef E4G_SSE2
+    if (kernel_selfcheck(first_pixel_sse2)) {
+        *name = "sse2";
+        return first_pixel_sse2;
+    }
+    if (debug) fprintf(stderr, "eye4graphics: sse2 self-check failed\n");
+#endif
+    (void)debug;
+    return first_pixel_scalar;
+}
+
+static const char* firstPixelName;
+static const ColorKernel first_pixel = select_kernel(&firstPixelName);
+
+const char* colorCompareKernel()
+{
+    return firstPixelName;
+}
+
 inline bool same_rect(const int hayxsize,
                       const int neexsize,
                       const PixelPacket* hay_pixel,
@@ -187,6 +535,17 @@ static bool pixelperfect_match(const int hayxsize,
     }
 
     /* full check, pixel-by-pixel */
+    if (neePixelSize == 1 && hayPixelSize == 1 &&
+        xscale == 1.0 && yscale == 1.0) {
+        /* unscaled rows can be compared as a whole */
+        for(int _y=0; _y+1 < neeysize; _y++) {
+            if (first_pixel(hay_pixel + hayxsize*(y+_y) + x,
+                            nee_pixel + neexsize*_y, 1, neexsize-1,
+                            colorDiff, skipTransparency, false) < neexsize-1)
+                return false;
+        }
+        return true;
+    }
     for(int _y=0; _y+neePixelSize < int(neeysize*yscale); _y++) {
         for(int _x=0; _x+neePixelSize < int(neexsize*xscale); _x++) {
             if (!same_rect(hayxsize, neexsize,
@@ -287,6 +646,150 @@ long normdiag_error(int hayxsize,int neex,int neey,int x,int y,
     return delta / checked_steps;
 }
 
+/*
+ * RowSearch holds parameters and shared state of a pixel perfect
+ * icon search that may be split into bands of rows searched in
+ * parallel threads.
+ */
+struct RowSearch {
+    const std::vector<BoundingBox>* ignore;
+    const PixelPacket* hay_pixel;
+    const PixelPacket* nee_pixel;
+    int hayx, neex, neey;
+    int colorDiff;
+    unsigned char skipTransparency;
+    float xscale, yscale;
+    int neePixelSize, hayPixelSize;
+    int keyY;            // needle row of the key pixel, -1 if none
+    const std::vector<int>* candidates; // (x, y) pairs to check, or NULL
+    int startX, startY;  // first coordinates to be checked
+    int endX, endY;      // x < endX and y < endY are checked
+    int bandRows;
+    /* shared state, protected by mutex */
+    Mutex mutex;
+    int nextBand;
+    int foundBand;       // lowest band with a match, INT_MAX if none
+    int foundX, foundY;
+};
+
+static bool ignored(const std::vector<BoundingBox>& ignore,
+                    const int x, const int y)
+{
+    BoundingBoxConstIterator it = ignore.begin();
+    while (it != ignore.end()) {
+        if (x > it->left && x < it->right &&
+            y > it->top && y < it->bottom)
+            return true;
+        ++it;
+    }
+    return false;
+}
+
+/*
+ * Search the first match in raster order from rows firstY...lastY-1
+ * of a band. Search is cancelled if a match is found from an earlier
+ * band. Returns true if a match was found.
+ */
+static bool search_rows(RowSearch* s, const int band,
+                        const int firstY, const int lastY,
+                        int* foundX, int* foundY)
+{
+    const std::vector<BoundingBox>& ignore = *s->ignore;
+    const bool ignoreBoxes = ignore.size() > 0;
+    int startX = firstY == s->startY ? s->startX : 0;
+    const PixelPacket* key_pixel = s->keyY >= 0 ?
+        s->nee_pixel + s->neex * s->keyY : NULL;
+    for (int y = firstY; y < lastY; y++) {
+        if (band > 0) {
+            MutexLock lock(s->mutex);
+            if (s->foundBand < band) return false;
+        }
+        for (int x = startX; x < s->endX; x++) {
+            if (key_pixel) {
+                /* skip coordinates where the key pixel does not match */
+                x += first_pixel(s->hay_pixel + s->hayx * (y + s->keyY) + x,
+                                 key_pixel, 0, s->endX - x,
+                                 s->colorDiff, s->skipTransparency, true);
+                if (x >= s->endX) break;
+            }
+            if (ignoreBoxes && ignored(ignore, x, y)) continue;
+            if (pixelperfect_match(s->hayx, s->neex, s->neey, x, y,
+                                   s->hay_pixel, s->nee_pixel,
+                                   s->colorDiff,
+                                   s->skipTransparency,
+                                   s->xscale, s->yscale,
+                                   s->neePixelSize, s->hayPixelSize)) {
+                *foundX = x;
+                *foundY = y;
+                return true;
+            }
+        }
+        startX = 0;
+    }
+    return false;
+}
+
+/*
+ * Search the first match in raster order from candidate coordinates
+ * only. Returns true if a match was found.
+ */
+static bool search_candidates(RowSearch* s, int* foundX, int* foundY)
+{
+    const std::vector<BoundingBox>& ignore = *s->ignore;
+    const std::vector<int>& candidates = *s->candidates;
+    for (size_t i = 0; i + 1 < candidates.size(); i += 2) {
+        const int x = candidates[i];
+        const int y = candidates[i + 1];
+        if (y < s->startY || (y == s->startY && x < s->startX)) continue;
+        if (y >= s->endY) break;
+        if (x < 0 || x >= s->endX) continue;
+        if (ignore.size() > 0 && ignored(ignore, x, y)) continue;
+        if (pixelperfect_match(s->hayx, s->neex, s->neey, x, y,
+                               s->hay_pixel, s->nee_pixel,
+                               s->colorDiff,
+                               s->skipTransparency,
+                               s->xscale, s->yscale,
+                               s->neePixelSize, s->hayPixelSize)) {
+            *foundX = x;
+            *foundY = y;
+            return true;
+        }
+    }
+    return false;
+}
+
+/*
+ * Search thread takes bands of rows in increasing order until a match
+ * is found or there are no bands left. As bands before a band with a
+ * match have been searched completely, the match in the lowest band
+ * is the first match in raster order.
+ */
+static void search_bands(void* arg)
+{
+    RowSearch* s = static_cast<RowSearch*>(arg);
+    for (;;) {
+        int band;
+        {
+            MutexLock lock(s->mutex);
+            band = s->nextBand++;
+            if (band > s->foundBand) return;
+        }
+        const int firstY = s->startY + band * s->bandRows;
+        if (firstY >= s->endY) return;
+        const int lastY = MIN(firstY + s->bandRows, s->endY);
+        int x, y;
+        if (search_rows(s, band, firstY, lastY, &x, &y)) {
+            MutexLock lock(s->mutex);
+            if (band < s->foundBand) {
+                s->foundBand = band;
+                s->foundX = x;
+                s->foundY = y;
+            }
+            return;
+        }
+    }
+}
+
 /*
  * iconsearch
  *
@@ -306,6 +809,12 @@ long normdiag_error(int hayxsize,int neex,int neey,int x,int y,
  *                  1 for xscale 1.0, 2 for xscale > 1.0
  *     hayPixelSize - size of pixel rectangle on haystack, default:
  *                  ceil(neePixelSize * xscale)
+ *     threads    - number of threads searching for a pixel perfect
+ *                  match, default: 1
+ *     positions  - (x, y) pairs of coordinates in the image where
+ *                  a pixel perfect match is searched for, in raster
+ *                  order. NULL: everywhere.
+ *     positionCount - number of positions
  *
  * Return value:
  *     1         - icon candidate found
@@ -324,7 +833,10 @@ static int iconsearch(std::vector<BoundingBox>& retval,
                       const float xscale,
                       const float yscale,
                       const int neePixelSize,
-                      const int hayPixelSize)
+                      const int hayPixelSize,
+                      const int threads,
+                      const int32_t* positions = NULL,
+                      const int positionCount = 0)
 {
     const int color_threshold = COLORS * threshold;
 
@@ -332,8 +844,6 @@ static int iconsearch(std::vector<BoundingBox>& retval,
 
     const unsigned char skipTransparency = 255 * opacityLimit;
 
-    const bool ignoreBoxes = ignore.size() > 0;
-
     typedef std::pair<long, std::pair<int,int> > Candidate;
     std::vector< Candidate > candidates;
 
@@ -368,52 +878,95 @@ static int iconsearch(std::vector<BoundingBox>& retval,
                         static_cast<void*>(needle),
                         threshold, colorMatch, opacityLimit, searchArea);
 
-    ImagePixelsIterator it;
-    if ((it = imagePixels.find(search_id)) != imagePixels.end()) {
-        hay_pixel = it->first.hay_pixel;
-        nee_pixel = it->first.nee_pixel;
-    } else {
-        hay_pixel = getPixels(haystack, searchArea.left, searchArea.top, hayx, hayy);
-        nee_pixel = getPixels(needle, 0, 0, neex, neey);
+    {
+        MutexLock lock(imagePixelsMutex);
+        ImagePixelsIterator it;
+        if ((it = imagePixels.find(search_id)) != imagePixels.end()) {
+            hay_pixel = it->first.hay_pixel;
+            nee_pixel = it->first.nee_pixel;
+        } else {
+            hay_pixel = getPixels(haystack, searchArea.left, searchArea.top, hayx, hayy);
+            nee_pixel = getPixels(needle, 0, 0, neex, neey);
 
-        search_id.hay_pixel = hay_pixel;
-        search_id.nee_pixel = nee_pixel;
-        imagePixels[search_id] = true;
+            search_id.hay_pixel = hay_pixel;
+            search_id.nee_pixel = nee_pixel;
+            imagePixels[search_id] = true;
+        }
     }
 
     if (threshold == 0) {
         /* Pixel-perfect match */
-        int startXinArea = startX - searchArea.left;
-        int startYinArea = startY - searchArea.top;
-        for (int y=startYinArea; y+hayPixelSize <= hayy-int(neey*yscale); y++) {
-            for (int x=startXinArea; x+hayPixelSize <= hayx-int(neex*xscale); x++) {
-                if (ignoreBoxes) {
-                    bool skipCoordinates = false;
-                    BoundingBoxConstIterator it = ignore.begin();
-                    while (it != ignore.end() && !skipCoordinates) {
-                        skipCoordinates |= (x > it->left && x < it->right &&
-                                            y > it->top && y < it->bottom);
-                        ++it;
-                    }
-                    if (skipCoordinates) continue;
-                }
-                if (pixelperfect_match(hayx, neex, neey, x, y,
-                                       hay_pixel, nee_pixel,
-                                       colorDiff,
-                                       skipTransparency,
-                                       xscale, yscale,
-                                       _neePixelSize, _hayPixelSize)) {
-                    BoundingBox bbox;
-                    bbox.left = x + searchArea.left + _hayPixelSize/2;
-                    bbox.top = y + searchArea.top + _hayPixelSize/2;
-                    bbox.right = bbox.left + int(neex*xscale) +_hayPixelSize/2;
-                    bbox.bottom = bbox.top + int(neey*yscale) +_hayPixelSize/2;
-                    bbox.error = 0;
-                    retval.push_back(bbox);
-                    return 1;
-                }
+        RowSearch s;
+        s.ignore = &ignore;
+        s.hay_pixel = hay_pixel;
+        s.nee_pixel = nee_pixel;
+        s.hayx = hayx;
+        s.neex = neex;
+        s.neey = neey;
+        s.colorDiff = colorDiff;
+        s.skipTransparency = skipTransparency;
+        s.xscale = xscale;
+        s.yscale = yscale;
+        s.neePixelSize = _neePixelSize;
+        s.hayPixelSize = _hayPixelSize;
+        /* pixelperfect_match compares the first pixel on the middle
+         * row of an unscaled needle first. It is the key pixel. */
+        if (neex > 1 && _neePixelSize == 1 && _hayPixelSize == 1 &&
+            xscale == 1.0 && yscale == 1.0)
+            s.keyY = neey / 2;
+        else
+            s.keyY = -1;
+        s.startX = startX - searchArea.left;
+        s.startY = startY - searchArea.top;
+        s.endX = hayx - int(neex*xscale) - hayPixelSize + 1;
+        s.endY = hayy - int(neey*yscale) - hayPixelSize + 1;
+        s.nextBand = 0;
+        s.foundBand = INT_MAX;
+
+        /* positions relative to the search area */
+        std::vector<int> areaPositions;
+        if (positions) {
+            areaPositions.reserve(2 * positionCount);
+            for (int i = 0; i < positionCount; i++) {
+                areaPositions.push_back(positions[2 * i] - searchArea.left);
+                areaPositions.push_back(positions[2 * i + 1] - searchArea.top);
             }
-            startXinArea = 0;
+            s.candidates = &areaPositions;
+        } else {
+            s.candidates = NULL;
+        }
+
+        const int rows = s.endY - s.startY;
+        int threadCount = MIN(threads, rows / MIN_ROWS_PER_THREAD);
+        if (s.candidates) {
+            if (search_candidates(&s, &s.foundX, &s.foundY))
+                s.foundBand = 0;
+        } else if (threadCount > 1) {
+            /* Several bands per thread balance the load when
+             * matching is faster in some parts of the image. */
+            s.bandRows = MAX(MIN_ROWS_PER_THREAD / 4,
+                             rows / (threadCount * 4));
+            std::vector<Thread> helpers(threadCount - 1,
+                                        Thread(search_bands, &s));
+            for (size_t i = 0; i < helpers.size(); i++)
+                helpers[i].start();
+            search_bands(&s);
+            for (size_t i = 0; i < helpers.size(); i++)
+                helpers[i].join();
+        } else if (rows > 0 &&
+                   search_rows(&s, 0, s.startY, s.endY, &s.foundX, &s.foundY)) {
+            s.foundBand = 0;
+        }
+
+        if (s.foundBand != INT_MAX) {
+            BoundingBox bbox;
+            bbox.left = s.foundX + searchArea.left + _hayPixelSize/2;
+            bbox.top = s.foundY + searchArea.top + _hayPixelSize/2;
+            bbox.right = bbox.left + int(neex*xscale) +_hayPixelSize/2;
+            bbox.bottom = bbox.top + int(neey*yscale) +_hayPixelSize/2;
+            bbox.error = 0;
+            retval.push_back(bbox);
+            return 1;
         }
         return 0;
     }
@@ -526,6 +1079,88 @@ int rgb888at(rgb888* color,
     return 0;
 }
 
+const void* openedImagePixels(void* image, PixelLayout* layout)
+{
+#if defined(MAGICKCORE_HDRI_SUPPORT) && MAGICKCORE_HDRI_SUPPORT
+    /* floating point quantums have no 8-bit color values */
+    return NULL;
+#else
+    if (!image || !layout) return NULL;
+    Image* im = static_cast<Image*>(image);
+    const PixelPacket* pixels = getPixels(im, 0, 0, im->columns, im->rows);
+    if (!pixels) return NULL;
+    /* colors are compared by their lowest bytes, see same_color */
+    const Quantum one = 1;
+    const int lowByte = *reinterpret_cast<const unsigned char*>(&one) == 1 ?
+        0 : sizeof(Quantum) - 1;
+    layout->pixelSize = sizeof(PixelPacket);
+    layout->red = offsetof(PixelPacket, red) + lowByte;
+    layout->green = offsetof(PixelPacket, green) + lowByte;
+    layout->blue = offsetof(PixelPacket, blue) + lowByte;
+    return pixels;
+#endif
+}
+
+int colorHistogram(uint32_t* histogram,
+                   void* image,
+                   const BoundingBox* area)
+{
+    if (!histogram || !image || !area) return -1;
+    Image* im = static_cast<Image*>(image);
+    const int width = im->columns;
+    const int left = area->left > 0 ? area->left : 0;
+    const int top = area->top > 0 ? area->top : 0;
+    const int right = MIN(area->right, width);
+    const int bottom = MIN(area->bottom, (int)im->rows);
+    const PixelPacket* pixels = getPixels(im, 0, 0, im->columns, im->rows);
+    if (!pixels) return -1;
+    memset(histogram, 0, 3 * 256 * sizeof(uint32_t));
+    int count = 0;
+    for (int y = top; y < bottom; y++) {
+        const PixelPacket* p = pixels + y * width + left;
+        for (int x = left; x < right; x++, p++) {
+            ++histogram[(unsigned char)p->red];
+            ++histogram[256 + (unsigned char)p->green];
+            ++histogram[512 + (unsigned char)p->blue];
+        }
+        if (right > left) count += right - left;
+    }
+    return count;
+}
+
+int tileHashes(uint32_t* hashes,
+               void* image,
+               const int tileWidth,
+               const int tileHeight)
+{
+    if (!hashes || !image || tileWidth < 1 || tileHeight < 1) return -1;
+    Image* im = static_cast<Image*>(image);
+    const int width = im->columns;
+    const int height = im->rows;
+    const int columns = (width + tileWidth - 1) / tileWidth;
+    const int rows = (height + tileHeight - 1) / tileHeight;
+    const PixelPacket* pixels = getPixels(im, 0, 0, width, height);
+    if (!pixels) return -1;
+    /* FNV-1a of colors compared by same_color */
+    for (int i = 0; i < columns * rows; i++)
+        hashes[i] = 2166136261u;
+    for (int y = 0; y < height; y++) {
+        uint32_t* rowHashes = hashes + (y / tileHeight) * columns;
+        const PixelPacket* p = pixels + y * width;
+        for (int tileX = 0; tileX < columns; tileX++) {
+            uint32_t hash = rowHashes[tileX];
+            const int lastX = MIN((tileX + 1) * tileWidth, width);
+            for (int x = tileX * tileWidth; x < lastX; x++, p++) {
+                hash = (hash ^ (unsigned char)p->red) * 16777619u;
+                hash = (hash ^ (unsigned char)p->green) * 16777619u;
+                hash = (hash ^ (unsigned char)p->blue) * 16777619u;
+            }
+            rowHashes[tileX] = hash;
+        }
+    }
+    return columns * rows;
+}
+
 int findNextColor(BoundingBox* bbox,
                   void* image,
                   const rgb888* color,
@@ -556,23 +1191,24 @@ int findNextColor(BoundingBox* bbox,
     needle.red = color->red;
     needle.green = color->green;
     needle.blue = color->blue;
+    needle.opacity = 0;
 
     for (int y = startY; y < searchArea->bottom; y++) {
-        for (int x = startX; x < searchArea->right; x++) {
+        const int x = startX + first_pixel(hay_pixel_p + y * xsize + startX,
+                                           &needle, 0,
+                                           searchArea->right - startX,
+                                           colorDiff, skipTransparency,
+                                           !invertMatch);
+        if (x < searchArea->right) {
             const PixelPacket hay_pixel = *(hay_pixel_p + y * xsize + x);
-            const bool match = same_color(
-                &needle, &hay_pixel,
-                colorDiff, skipTransparency);
-            if ((!invertMatch && match) || (invertMatch && !match)) {
-                bbox->left = x;
-                bbox->right = x;
-                bbox->top = y;
-                bbox->bottom = y;
-                bbox->error = ((((int) hay_pixel.red & 0xff) << 16) +
-                               (((int) hay_pixel.green & 0xff) << 8) +
-                               ((int) hay_pixel.blue & 0xff));
-                return 1;
-            }
+            bbox->left = x;
+            bbox->right = x;
+            bbox->top = y;
+            bbox->bottom = y;
+            bbox->error = ((((int) hay_pixel.red & 0xff) << 16) +
+                           (((int) hay_pixel.green & 0xff) << 8) +
+                           ((int) hay_pixel.blue & 0xff));
+            return 1;
         }
         if (bbox->error == 0) break;
         startX = searchArea->left;
@@ -580,6 +1216,135 @@ int findNextColor(BoundingBox* bbox,
     return 0;
 }
 
+/*
+ * Horizontal run of matching pixels [x0, x1) on row y. Runs are
+ * created in raster order, and the root of every region is the run
+ * with the smallest index, that is, the run of its first pixel.
+ */
+struct ColorRun {
+    int x0, x1, y;
+};
+
+static int root_run(std::vector<int>& parent, int run)
+{
+    int root = run;
+    while (parent[root] != root) root = parent[root];
+    while (parent[run] != root) {
+        const int next = parent[run];
+        parent[run] = root;
+        run = next;
+    }
+    return root;
+}
+
+static void join_runs(std::vector<int>& parent, const int run1, const int run2)
+{
+    const int root1 = root_run(parent, run1);
+    const int root2 = root_run(parent, run2);
+    if (root1 < root2) parent[root2] = root1;
+    else if (root2 < root1) parent[root1] = root2;
+}
+
+int findColorRegions(ColorRegion* regions,
+                     const int maxRegions,
+                     void* image,
+                     const rgb888* color,
+                     const double colorMatch,
+                     const double opacityLimit,
+                     const int invertMatch,
+                     const BoundingBox* searchArea,
+                     const int connectivity)
+{
+    if (!image || !color || !searchArea ||
+        (connectivity != 4 && connectivity != 8) ||
+        (maxRegions > 0 && !regions)) return -1;
+
+    Image* im = static_cast<Image*>(image);
+    const int xsize = im->columns;
+    const int ysize = im->rows;
+    const PixelPacket* hay_pixel_p = getPixels(im, 0, 0, xsize, ysize);
+    if (!hay_pixel_p) return -1;
+
+    const int left = MAX(searchArea->left, 0);
+    const int top = MAX(searchArea->top, 0);
+    const int right = MIN(searchArea->right, xsize);
+    const int bottom = MIN(searchArea->bottom, ysize);
+
+    const int colorDiff = 256 - (256 * colorMatch);
+    const unsigned char skipTransparency = 255 * opacityLimit;
+    const bool wantMatch = !invertMatch;
+    /* runs on adjacent rows touch if they are this close */
+    const int reach = connectivity == 8 ? 1 : 0;
+
+    PixelPacket needle;
+    needle.red = color->red;
+    needle.green = color->green;
+    needle.blue = color->blue;
+    needle.opacity = 0;
+
+    std::vector<ColorRun> runs;
+    std::vector<int> parent;
+    int prevFirst = 0, prevEnd = 0;
+
+    for (int y = top; y < bottom; y++) {
+        const PixelPacket* row = hay_pixel_p + y * xsize;
+        const int rowFirst = runs.size();
+        int prev = prevFirst;
+        int x = left;
+        while (x < right) {
+            x += first_pixel(row + x, &needle, 0, right - x,
+                             colorDiff, skipTransparency, wantMatch);
+            if (x >= right) break;
+            ColorRun run;
+            run.x0 = x;
+            run.x1 = x + first_pixel(row + x, &needle, 0, right - x,
+                                     colorDiff, skipTransparency, !wantMatch);
+            run.y = y;
+            const int current = runs.size();
+            runs.push_back(run);
+            parent.push_back(current);
+            while (prev < prevEnd && runs[prev].x1 + reach <= run.x0)
+                prev++;
+            for (int p = prev; p < prevEnd && runs[p].x0 < run.x1 + reach; p++)
+                join_runs(parent, p, current);
+            x = run.x1;
+        }
+        prevFirst = rowFirst;
+        prevEnd = runs.size();
+    }
+
+    /* roots precede other runs of their regions */
+    std::vector<int> regionOf(runs.size(), -1);
+    int regionCount = 0;
+    for (int i = 0; i < (int)runs.size(); i++) {
+        const ColorRun& run = runs[i];
+        const int root = root_run(parent, i);
+        if (root == i) {
+            regionOf[i] = regionCount++;
+            if (regionOf[i] < maxRegions) {
+                ColorRegion& region = regions[regionOf[i]];
+                const PixelPacket first = hay_pixel_p[run.y * xsize + run.x0];
+                region.left = run.x0;
+                region.top = run.y;
+                region.right = run.x1 - 1;
+                region.bottom = run.y;
+                region.pixels = 0;
+                region.color = ((((int) first.red & 0xff) << 16) +
+                                (((int) first.green & 0xff) << 8) +
+                                ((int) first.blue & 0xff));
+            }
+        }
+        if (regionOf[root] < maxRegions) {
+            ColorRegion& region = regions[regionOf[root]];
+            region.left = MIN(region.left, run.x0);
+            region.right = MAX(region.right, run.x1 - 1);
+            region.bottom = run.y;
+            region.pixels += run.x1 - run.x0;
+        }
+    }
+    return regionCount;
+}
+
 int findNextIcon(BoundingBox* bbox,
                  void* image,
                  void* icon,
@@ -592,6 +1357,49 @@ int findNextIcon(BoundingBox* bbox,
                  const float yscale,
                  const int neePixelSize,
                  const int hayPixelSize)
+{
+    return findNextIconThreads(bbox, image, icon, threshold,
+                               colorMatch, opacityLimit, searchArea,
+                               continueOpts, xscale, yscale,
+                               neePixelSize, hayPixelSize, 1);
+}
+
+int findNextIconThreads(BoundingBox* bbox,
+                        void* image,
+                        void* icon,
+                        const int threshold,
+                        const double colorMatch,
+                        const double opacityLimit,
+                        const BoundingBox* searchArea,
+                        const int continueOpts,
+                        const float xscale,
+                        const float yscale,
+                        const int neePixelSize,
+                        const int hayPixelSize,
+                        const int threads)
+{
+    return findNextIconCandidates(bbox, image, icon, threshold,
+                                  colorMatch, opacityLimit, searchArea,
+                                  continueOpts, xscale, yscale,
+                                  neePixelSize, hayPixelSize, threads,
+                                  NULL, 0);
+}
+
+int findNextIconCandidates(BoundingBox* bbox,
+                           void* image,
+                           void* icon,
+                           const int threshold,
+                           const double colorMatch,
+                           const double opacityLimit,
+                           const BoundingBox* searchArea,
+                           const int continueOpts,
+                           const float xscale,
+                           const float yscale,
+                           const int neePixelSize,
+                           const int hayPixelSize,
+                           const int threads,
+                           const int32_t* candidates,
+                           const int candidateCount)
 {
     /* TODO: another version with multiple versions of the same
      * icon. Clear, blurred, etc.
@@ -627,7 +1435,8 @@ int findNextIcon(BoundingBox* bbox,
                    colorMatch, opacityLimit,
                    startX, startY,
                    xscale, yscale,
-                   neePixelSize, hayPixelSize) > 0
+                   neePixelSize, hayPixelSize,
+                   threads, candidates, candidateCount) > 0
         && found.size() > 0) {
         *bbox = found[0];
         if (bbox->error > threshold)
@@ -640,6 +1449,177 @@ int findNextIcon(BoundingBox* bbox,
     return retval;
 }
 
+/*
+ * IconsSearch holds the pixel perfect searches of findIcons. All
+ * icons are searched for band by band, so that a band of image rows
+ * is compared to every icon while it is still in the cache.
+ */
+struct IconsSearch {
+    RowSearch* searches;
+    int count;
+    int endY;            // largest endY of searches
+    int bandRows;
+    /* shared state, protected by mutex */
+    Mutex mutex;
+    int nextBand;
+};
+
+/*
+ * Search thread takes bands of rows in increasing order and searches
+ * every icon that has not been found in an earlier band. As in
+ * search_bands, the match in the lowest band of each icon is its
+ * first match in raster order.
+ */
+static void search_icon_bands(void* arg)
+{
+    IconsSearch* is = static_cast<IconsSearch*>(arg);
+    for (;;) {
+        int band;
+        {
+            MutexLock lock(is->mutex);
+            band = is->nextBand++;
+        }
+        const int firstY = band * is->bandRows;
+        if (firstY >= is->endY) return;
+        bool searched = false;
+        for (int i = 0; i < is->count; i++) {
+            RowSearch* s = &is->searches[i];
+            if (firstY >= s->endY) continue;
+            {
+                MutexLock lock(s->mutex);
+                if (s->foundBand < band) continue;
+            }
+            searched = true;
+            const int lastY = MIN(firstY + is->bandRows, s->endY);
+            int x, y;
+            if (search_rows(s, band, firstY, lastY, &x, &y)) {
+                MutexLock lock(s->mutex);
+                if (band < s->foundBand) {
+                    s->foundBand = band;
+                    s->foundX = x;
+                    s->foundY = y;
+                }
+            }
+        }
+        /* every icon has been found in an earlier band or does not
+         * fit in the rest of the rows */
+        if (!searched) return;
+    }
+}
+
+int findIcons(BoundingBox* bboxes,
+              void* image,
+              void** icons,
+              const int iconCount,
+              const double colorMatch,
+              const double opacityLimit,
+              const BoundingBox* searchArea,
+              const float xscale,
+              const float yscale,
+              const int neePixelSize,
+              const int hayPixelSize,
+              const int threads)
+{
+    Image* haystack = static_cast<Image*>(image);
+    const int colorDiff = 256 - (256 * colorMatch);
+    const unsigned char skipTransparency = 255 * opacityLimit;
+
+    int _neePixelSize = xscale > 1.0 ? 2 : 1;
+    if (neePixelSize > 0) _neePixelSize = neePixelSize;
+    int _hayPixelSize = hayPixelSize > 0 ? hayPixelSize : _ceil(_neePixelSize * xscale);
+
+    int hayx = haystack->columns;
+    int hayy = haystack->rows;
+    hayx = MIN(hayx, searchArea->right - searchArea->left);
+    hayy = MIN(hayy, searchArea->bottom - searchArea->top);
+
+    for (int i = 0; i < iconCount; i++) {
+        bboxes[i].left = -1;
+        bboxes[i].top = -1;
+        bboxes[i].right = -1;
+        bboxes[i].bottom = -1;
+        bboxes[i].error = -1;
+    }
+    if (iconCount <= 0 || hayx <= 0 || hayy <= 0) return 0;
+
+    const PixelPacket* hay_pixel = getPixels(haystack, searchArea->left, searchArea->top, hayx, hayy);
+    if (hay_pixel == NULL) return 0;
+
+    const std::vector<BoundingBox> ignore;
+    IconsSearch is;
+    is.searches = new RowSearch[iconCount];
+    is.count = iconCount;
+    is.endY = 0;
+    is.nextBand = 0;
+    for (int i = 0; i < iconCount; i++) {
+        Image* needle = static_cast<Image*>(icons[i]);
+        RowSearch& s = is.searches[i];
+        s.ignore = &ignore;
+        s.hay_pixel = hay_pixel;
+        s.neex = needle->columns;
+        s.neey = needle->rows;
+        s.nee_pixel = getPixels(needle, 0, 0, s.neex, s.neey);
+        s.hayx = hayx;
+        s.colorDiff = colorDiff;
+        s.skipTransparency = skipTransparency;
+        s.xscale = xscale;
+        s.yscale = yscale;
+        s.neePixelSize = _neePixelSize;
+        s.hayPixelSize = _hayPixelSize;
+        /* skip to coordinates where the key pixel matches, see
+         * iconsearch */
+        if (s.neex > 1 && _neePixelSize == 1 && _hayPixelSize == 1 &&
+            xscale == 1.0 && yscale == 1.0)
+            s.keyY = s.neey / 2;
+        else
+            s.keyY = -1;
+        s.candidates = NULL;
+        s.startX = 0;
+        s.startY = 0;
+        s.endX = hayx - int(s.neex*xscale) - hayPixelSize + 1;
+        s.endY = hayy - int(s.neey*yscale) - hayPixelSize + 1;
+        s.foundBand = INT_MAX;
+        if (s.nee_pixel == NULL || s.endX <= 0 || s.endY <= 0) {
+            /* the icon does not fit in the search area */
+            s.endY = 0;
+            continue;
+        }
+        if (s.endY > is.endY) is.endY = s.endY;
+    }
+
+    const int rows = is.endY;
+    int threadCount = MIN(threads, rows / MIN_ROWS_PER_THREAD);
+    if (threadCount > 1) {
+        is.bandRows = MAX(MIN_ROWS_PER_THREAD / 4,
+                          rows / (threadCount * 4));
+        std::vector<Thread> helpers(threadCount - 1,
+                                    Thread(search_icon_bands, &is));
+        for (size_t i = 0; i < helpers.size(); i++)
+            helpers[i].start();
+        search_icon_bands(&is);
+        for (size_t i = 0; i < helpers.size(); i++)
+            helpers[i].join();
+    } else {
+        is.bandRows = MIN_ROWS_PER_THREAD / 4;
+        search_icon_bands(&is);
+    }
+
+    int foundCount = 0;
+    for (int i = 0; i < iconCount; i++) {
+        const RowSearch& s = is.searches[i];
+        if (s.foundBand == INT_MAX) continue;
+        BoundingBox* bbox = &bboxes[i];
+        bbox->left = s.foundX + searchArea->left + _hayPixelSize/2;
+        bbox->top = s.foundY + searchArea->top + _hayPixelSize/2;
+        bbox->right = bbox->left + int(s.neex*xscale) +_hayPixelSize/2;
+        bbox->bottom = bbox->top + int(s.neey*yscale) +_hayPixelSize/2;
+        bbox->error = 0;
+        ++foundCount;
+    }
+    delete[] is.searches;
+    return foundCount;
+}
+
 int findNextDiff(BoundingBox* bbox,
                  void* imageA,
                  void* imageB,
@@ -690,20 +1670,23 @@ int findNextDiff(BoundingBox* bbox,
     const PixelPacket* pB = getPixels(imB, 0, 0, endXB, endYB);
 
     for (int y = startY; y < height; ++y) {
-        for (int x = startX; x < width; ++x) {
+        const int x = startX + first_pixel(pA + (y+startYA)*widthA + startX,
+                                           pB + (y+startYB)*widthB + startX,
+                                           1, width - startX,
+                                           colorDiff, skipTransparency,
+                                           false);
+        if (x < width) {
             const PixelPacket* pAxy = pA + (y+startYA)*widthA + x;
             const PixelPacket* pBxy = pB + (y+startYB)*widthB + x;
-            if (!same_color(pAxy, pBxy, colorDiff, skipTransparency)) {
-                bbox->left = x;
-                bbox->top = y;
-                bbox->right = x;
-                bbox->bottom = y;
-                bbox->error = (
-                    ((unsigned char)abs(pAxy->red - pBxy->red) << 16) +
-                    ((unsigned char)abs(pAxy->green - pBxy->green) << 8) +
-                    ((unsigned char)abs(pAxy->blue - pBxy->blue)));
-                return 1;
-            }
+            bbox->left = x;
+            bbox->top = y;
+            bbox->right = x;
+            bbox->bottom = y;
+            bbox->error = (
+                ((unsigned char)abs(pAxy->red - pBxy->red) << 16) +
+                ((unsigned char)abs(pAxy->green - pBxy->green) << 8) +
+                ((unsigned char)abs(pAxy->blue - pBxy->blue)));
+            return 1;
         }
         startX = 0;
     }
@@ -806,11 +1789,200 @@ int openedImageIsBlank(void* image)
 
 void* openBlob(const void* blob, const char* pixelorder, int x, int y)
 {
-    // Image* image = new Image(x,y,pixelorder,CharPixel,blob);
-    Image* image = NULL;
+    Image* image;
+    ExceptionInfo *exception;
+    exception = AcquireExceptionInfo();
+    image = ConstituteImage(x, y, pixelorder, CharPixel, blob, exception);
+    if (image == NULL) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL)
+            CatchException(exception);
+    }
+    DestroyExceptionInfo(exception);
     return static_cast<void*>(image);
 }
 
+void* sampleImage(void* image,
+                  const int x,
+                  const int y,
+                  const int step,
+                  const float xscale,
+                  const float yscale,
+                  const int margin)
+{
+    if (image == NULL || step < 1 || x < 0 || y < 0) return NULL;
+    Image* src = static_cast<Image*>(image);
+    const int srcx = src->columns;
+    const int srcy = src->rows;
+    /* scaled size is computed like in pixelperfect_match */
+    const int columns = (int(srcx * xscale) - margin - x + step - 1) / step;
+    const int rows = (int(srcy * yscale) - margin - y + step - 1) / step;
+    if (columns <= 0 || rows <= 0) return NULL;
+    const PixelPacket* src_pixel = getPixels(src, 0, 0, srcx, srcy);
+    if (src_pixel == NULL) return NULL;
+
+    ExceptionInfo *exception = AcquireExceptionInfo();
+    Image* dst = CloneImage(src, columns, rows, MagickTrue, exception);
+    PixelPacket* dst_pixel = NULL;
+    if (dst != NULL)
+        dst_pixel = getPixels(dst, 0, 0, columns, rows);
+    if (dst_pixel != NULL) {
+        for (int j = 0; j < rows; j++) {
+            const int sy = MIN(int((y + step * j) / yscale), srcy - 1);
+            for (int i = 0; i < columns; i++) {
+                const int sx = MIN(int((x + step * i) / xscale), srcx - 1);
+                dst_pixel[j * columns + i] = src_pixel[sy * srcx + sx];
+            }
+        }
+        SyncAuthenticPixels(dst, exception);
+    } else if (dst != NULL) {
+        dst = DestroyImage(dst);
+    }
+    DestroyExceptionInfo(exception);
+    return static_cast<void*>(dst);
+}
+
+int writeImage(void* image, const char* imagefile)
+{
+    Image* img = static_cast<Image*>(image);
+    ImageInfo *image_info;
+    int retval = 0;
+    if (img == NULL ||
+        strlen(imagefile) >= sizeof(img->filename))
+        return ERROR_CANNOT_WRITE_IMAGEFILE;
+    image_info = CloneImageInfo((ImageInfo *) NULL);
+    strcpy(image_info->filename, imagefile);
+    strcpy(img->filename, imagefile);
+    if (WriteImage(image_info, img) == MagickFalse) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL)
+            CatchException(&img->exception);
+        retval = ERROR_CANNOT_WRITE_IMAGEFILE;
+    }
+    DestroyImageInfo(image_info);
+    return retval;
+}
+
+
+/*
+ * Parse a number argument of a convert option. If percentOf > 0, the
+ * number can be given as a percentage of percentOf.
+ */
+static bool parse_number(const char* s, const double percentOf, double* value)
+{
+    char* end;
+    *value = strtod(s, &end);
+    if (end == s) return false;
+    if (*end == '%' && percentOf > 0) {
+        *value *= percentOf / 100.0;
+        ++end;
+    }
+    return *end == '\0';
+}
+
+void* convertImage(void* image, const char* option, const char* argument)
+{
+    Image* src = static_cast<Image*>(image);
+    Image* dst = NULL;
+    double value;
+    if (src == NULL || option == NULL) return NULL;
+    ExceptionInfo* exception = AcquireExceptionInfo();
+    if (strcmp(option, "-flip") == 0) {
+        dst = FlipImage(src, exception);
+    } else if (strcmp(option, "-flop") == 0) {
+        dst = FlopImage(src, exception);
+    } else if (argument == NULL) {
+        /* all other options require an argument */
+    } else if (strcmp(option, "-crop") == 0) {
+        RectangleInfo geometry;
+        const MagickStatusType flags = ParseAbsoluteGeometry(argument, &geometry);
+        const MagickStatusType required = WidthValue | HeightValue | XValue | YValue;
+        /* crop without offsets would split the image into tiles */
+        if ((flags & required) == required &&
+            (flags & (PercentValue | AspectValue | GreaterValue |
+                      LessValue | AreaValue)) == 0)
+            dst = CropImage(src, &geometry, exception);
+    } else if (strcmp(option, "-rotate") == 0) {
+        if (parse_number(argument, 0, &value))
+            dst = RotateImage(src, value, exception);
+    } else if (strcmp(option, "-resize") == 0) {
+        RectangleInfo geometry;
+        const MagickStatusType flags = ParseRegionGeometry(src, argument, &geometry, exception);
+        if ((flags & (WidthValue | HeightValue)) &&
+            geometry.width > 0 && geometry.height > 0)
+            dst = ResizeImage(src, geometry.width, geometry.height,
+                              src->filter, src->blur, exception);
+    } else if (strcmp(option, "-threshold") == 0) {
+        if (parse_number(argument, QuantumRange + 1.0, &value)) {
+            dst = CloneImage(src, 0, 0, MagickTrue, exception);
+            if (dst != NULL) BilevelImage(dst, value);
+        }
+    } else if (strcmp(option, "-colorspace") == 0) {
+        if (strcasecmp(argument, "gray") == 0) {
+            dst = CloneImage(src, 0, 0, MagickTrue, exception);
+            if (dst != NULL) TransformImageColorspace(dst, GRAYColorspace);
+        }
+    } else if (strcmp(option, "-depth") == 0) {
+        if (parse_number(argument, 0, &value) &&
+            value >= 1 && value <= MAGICKCORE_QUANTUM_DEPTH &&
+            value == int(value)) {
+            dst = CloneImage(src, 0, 0, MagickTrue, exception);
+            if (dst != NULL) SetImageDepth(dst, (size_t)value);
+        }
+    }
+    if (dst == NULL) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL)
+            CatchException(exception);
+    }
+    DestroyExceptionInfo(exception);
+    return static_cast<void*>(dst);
+}
+
+void* cloneImage(void* image)
+{
+    Image* dst = NULL;
+    if (image == NULL) return NULL;
+    ExceptionInfo* exception = AcquireExceptionInfo();
+    dst = CloneImage(static_cast<Image*>(image), 0, 0, MagickTrue, exception);
+    if (dst == NULL) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL)
+            CatchException(exception);
+    }
+    DestroyExceptionInfo(exception);
+    return static_cast<void*>(dst);
+}
+
+int drawImage(void* image, const char* stroke, const char* fill,
+              const char* primitive)
+{
+    Image* img = static_cast<Image*>(image);
+    int retval = 0;
+    if (img == NULL || primitive == NULL) return ERROR_CANNOT_DRAW;
+    ExceptionInfo* exception = AcquireExceptionInfo();
+    DrawInfo* draw_info = CloneDrawInfo((ImageInfo*) NULL, (DrawInfo*) NULL);
+    if ((stroke != NULL &&
+         QueryColorDatabase(stroke, &draw_info->stroke, exception) == MagickFalse) ||
+        (fill != NULL &&
+         QueryColorDatabase(fill, &draw_info->fill, exception) == MagickFalse)) {
+        retval = ERROR_CANNOT_DRAW;
+    } else {
+        CloneString(&draw_info->primitive, primitive);
+        if (DrawImage(img, draw_info) == MagickFalse)
+            retval = ERROR_CANNOT_DRAW;
+    }
+    if (retval != 0) {
+        char* debug = getenv("EYE4GRAPHICS_DEBUG");
+        if (debug != NULL) {
+            CatchException(exception);
+            CatchException(&img->exception);
+        }
+    }
+    DestroyDrawInfo(draw_info);
+    DestroyExceptionInfo(exception);
+    return retval;
+}
 
 void* openImage(const char* imagefile)
 {
@@ -833,6 +2005,7 @@ void* openImage(const char* imagefile)
 
 PixelPacket* getPixels(Image* image, size_t x1, size_t y1, size_t x2, size_t y2)
 {
+    MutexLock lock(pixelCacheMutex);
     ExceptionInfo *exception = AcquireExceptionInfo();
     PixelPacket* p = GetAuthenticPixels(image, x1, y1, x2, y2, exception);
     DestroyExceptionInfo(exception);
@@ -843,14 +2016,17 @@ PixelPacket* getPixels(Image* image, size_t x1, size_t y1, size_t x2, size_t y2)
 
 void closeImage(void* image)
 {
-    ImagePixelsIterator it = imagePixels.begin();
-    while (it != imagePixels.end()) {
-        if (it->first.haystack == image ||
-            it->first.needle == image)
-        {
-            imagePixels.erase(it++);
-        } else {
-            ++it;
+    {
+        MutexLock lock(imagePixelsMutex);
+        ImagePixelsIterator it = imagePixels.begin();
+        while (it != imagePixels.end()) {
+            if (it->first.haystack == image ||
+                it->first.needle == image)
+            {
+                imagePixels.erase(it++);
+            } else {
+                ++it;
+            }
         }
     }
     if (image != NULL)
@@ -20,10 +20,13 @@
 
 #define ERROR_CANNOT_OPEN_IMAGEFILE -3
 #define ERROR_CANNOT_OPEN_ICONFILE -4
+#define ERROR_CANNOT_WRITE_IMAGEFILE -5
+#define ERROR_CANNOT_DRAW -6
 
 #if defined(__MINGW32__) || defined(_MSC_VER)
 
 typedef signed int int32_t;
+typedef unsigned int uint32_t;
 #define EXPORT __declspec(dllexport)
 
 #else
@@ -31,6 +34,7 @@ typedef signed int int32_t;
 #define EXPORT
 
 #include <sys/types.h>
+#include <stdint.h>
 
 #endif
 
@@ -47,6 +51,17 @@ extern "C" {
         unsigned char red, green, blue;
     } rgb888;
 
+    typedef struct _pixellayout {
+        int32_t pixelSize;  // bytes per pixel
+        int32_t red, green, blue;  // byte offsets of 8-bit color values
+    } PixelLayout;
+
+    typedef struct _colorregion {
+        int32_t left, top, right, bottom;  // inclusive coordinates
+        int32_t pixels;  // number of pixels in the region
+        int32_t color;   // 0xRRGGBB of the topmost-leftmost pixel
+    } ColorRegion;
+
     /*
      * rgb888at - read color value at coordinates
      *
@@ -62,6 +77,62 @@ extern "C" {
                  const int x,
                  const int y);
 
+    /*
+     * openedImagePixels - access pixel data of an opened image
+     *
+     * Parameters:
+     *   - image        - opened image
+     *   - layout (out) - size of a pixel and positions of 8-bit color
+     *                    values in a pixel, in bytes
+     *
+     * Return value:
+     *   NULL if pixels cannot be accessed as 8-bit color values.
+     *   Otherwise pointer to width * height pixels in row-major
+     *   order. Pixels are valid until the image is closed.
+     */
+
+    EXPORT
+    const void* openedImagePixels(void* image, PixelLayout* layout);
+
+    /*
+     * colorHistogram - count pixels of each color value
+     *
+     * Parameters:
+     *   - histogram (out) - 3 * 256 counters: number of pixels with
+     *                    red values 0...255, then green and blue.
+     *   - image        - opened image
+     *   - area         - bounding box of counted pixels
+     *
+     * Return value:
+     *   number of counted pixels, -1 on error.
+     */
+
+    EXPORT
+    int colorHistogram(uint32_t* histogram,
+                       void* image,
+                       const BoundingBox* area);
+
+    /*
+     * tileHashes - compute hashes of colors in tiles of an image
+     *
+     * Parameters:
+     *   - hashes (out) - one hash per tile, tiles in raster order.
+     *                    There are ceil(width / tileWidth) tiles on
+     *                    a row and ceil(height / tileHeight) rows.
+     *   - image        - opened image
+     *   - tileWidth, tileHeight - size of a tile in pixels. Tiles on
+     *                    the last column and row may be smaller.
+     *
+     * Return value:
+     *   number of tiles, -1 on error.
+     */
+
+    EXPORT
+    int tileHashes(uint32_t* hashes,
+                   void* image,
+                   const int tileWidth,
+                   const int tileHeight);
+
     /*
      * findNextColor
      *
@@ -92,6 +163,36 @@ extern "C" {
                       const int invertMatch,
                       const BoundingBox* searchArea);
 
+    /*
+     * findColorRegions - find connected regions of matching pixels
+     *
+     * Parameters:
+     *   - regions (out) - found regions in the order of their
+     *                    topmost-leftmost pixels.
+     *   - maxRegions   - max. number of regions written to regions.
+     *   - image        - opened image
+     *   - color, colorMatch, opacityLimit, invertMatch, searchArea
+     *                  - see findNextColor.
+     *   - connectivity - 4: pixels are connected to their left, right,
+     *                    upper and lower neighbours.
+     *                    8: diagonal neighbours are connected, too.
+     *
+     * Return value:
+     *   number of regions, may be greater than maxRegions.
+     *   -1 on invalid parameters.
+     */
+
+    EXPORT
+    int findColorRegions(ColorRegion* regions,
+                         const int maxRegions,
+                         void* image,
+                         const rgb888* color,
+                         const double colorMatch,
+                         const double opacityLimit,
+                         const int invertMatch,
+                         const BoundingBox* searchArea,
+                         const int connectivity);
+
     /*
      * findSingleIcon
      *
@@ -159,6 +260,159 @@ extern "C" {
                      const int neeRectSize,
                      const int hayRectSize);
 
+    /*
+     * colorCompareKernel
+     *
+     * Return value:
+     *     name of the pixel comparison implementation in use:
+     *     "avx2", "sse2" or "scalar". Vectorized implementations are
+     *     used only if they pass a self-check against the scalar
+     *     implementation. Environment variable EYE4GRAPHICS_SIMD=0
+     *     forces the scalar implementation.
+     */
+
+    EXPORT
+    const char* colorCompareKernel();
+
+    /*
+     * findNextIconThreads - findNextIcon in parallel threads
+     *
+     * Parameters:
+     * - bbox ... hayRectSize - see findNextIcon
+     * - threads        - max. number of threads searching for a pixel
+     *                    perfect match (threshold 0). Rows of the
+     *                    search area are split into bands searched in
+     *                    parallel. Fuzzy search and small search
+     *                    areas are searched in one thread.
+     *
+     * Results are the same as from findNextIcon.
+     *
+     * Return value:
+     *     see findSingleIcon
+     */
+
+    EXPORT
+    int findNextIconThreads(BoundingBox* bbox,
+                            void* image,
+                            void* icon,
+                            const int threshold,
+                            const double colorMatch,
+                            const double opacityLimit,
+                            const BoundingBox* searchArea,
+                            const int continueOpts,
+                            const float xscale,
+                            const float yscale,
+                            const int neeRectSize,
+                            const int hayRectSize,
+                            const int threads);
+
+    /*
+     * findNextIconCandidates - findNextIcon at candidate coordinates
+     *
+     * Parameters:
+     * - bbox ... threads - see findNextIconThreads
+     * - candidates     - candidateCount pairs of (x, y) coordinates
+     *                    in raster order (y first, then x). Only
+     *                    these top-left corners of pixel perfect
+     *                    matches are checked. Other coordinates are
+     *                    handled as if they did not match. If NULL,
+     *                    all coordinates are checked.
+     * - candidateCount - number of candidates
+     *
+     * Results are the same as from findNextIcon, if candidates
+     * include all matches found by findNextIcon.
+     *
+     * Return value:
+     *     see findSingleIcon
+     */
+
+    EXPORT
+    int findNextIconCandidates(BoundingBox* bbox,
+                               void* image,
+                               void* icon,
+                               const int threshold,
+                               const double colorMatch,
+                               const double opacityLimit,
+                               const BoundingBox* searchArea,
+                               const int continueOpts,
+                               const float xscale,
+                               const float yscale,
+                               const int neeRectSize,
+                               const int hayRectSize,
+                               const int threads,
+                               const int32_t* candidates,
+                               const int candidateCount);
+
+    /*
+     * sampleImage - sample every step'th pixel of an image
+     *
+     * Parameters:
+     *   - image        - opened image, not modified
+     *   - x, y         - coordinates of the first sampled pixel
+     *   - step         - distance between sampled pixels
+     *   - xscale, yscale - image is sampled as if it was scaled
+     *                    like findNextIcon scales icons, that is,
+     *                    pixel (x, y) is the pixel
+     *                    (int(x / xscale), int(y / yscale)) of the
+     *                    original image.
+     *   - margin       - number of last columns and rows of the
+     *                    scaled image that are not sampled.
+     *
+     * Pixel (i, j) of the result is pixel (x + step * i,
+     * y + step * j) of the scaled image.
+     *
+     * Return value:
+     *   NULL if nothing is sampled, otherwise an opened image that
+     *   must be closed with closeImage.
+     */
+
+    EXPORT
+    void* sampleImage(void* image,
+                      const int x,
+                      const int y,
+                      const int step,
+                      const float xscale,
+                      const float yscale,
+                      const int margin);
+
+    /*
+     * findIcons - find the first match of many icons in one pass
+     *
+     * Parameters:
+     * - bboxes (out)   - array of iconCount bounding boxes. Bounding
+     *                    box of the first match of icons[i] is
+     *                    stored to bboxes[i]. If icons[i] is not
+     *                    found, all fields of bboxes[i] are -1.
+     * - image          - opened image
+     * - icons          - array of iconCount opened icons
+     * - iconCount      - number of icons
+     * - colorMatch, opacityLimit, searchArea - see findSingleIcon
+     * - xscale, yscale, neeRectSize, hayRectSize - see findNextIcon
+     * - threads        - number of threads searching for the icons
+     *
+     * Every icon is searched for with pixel perfect matching
+     * (threshold 0). Results are the same as from calling
+     * findNextIcon with continueOpts 0 for each icon. Rows of the
+     * image are compared to all icons band by band.
+     *
+     * Return value:
+     *     number of icons found
+     */
+
+    EXPORT
+    int findIcons(BoundingBox* bboxes,
+                  void* image,
+                  void** icons,
+                  const int iconCount,
+                  const double colorMatch,
+                  const double opacityLimit,
+                  const BoundingBox* searchArea,
+                  const float xscale,
+                  const float yscale,
+                  const int neeRectSize,
+                  const int hayRectSize,
+                  const int threads);
+
     /*
      * findNextDiff
      *
@@ -223,9 +477,85 @@ extern "C" {
     EXPORT
     void* openImage(const char* imagefile);
 
+    /*
+     * openBlob - create an image from raw pixel data in memory
+     *
+     * Parameters:
+     *   - blob         - pixel data, 8 bits per channel
+     *   - pixelorder   - order of channels in a pixel, for instance
+     *                    "RGB", "RGBA" or "BGRP" (P is padding)
+     *   - x, y         - width and height of the image
+     *
+     * Return value:
+     *   NULL on failure, otherwise an opened image that must be
+     *   closed with closeImage.
+     */
     EXPORT
     void* openBlob(const void* blob, const char* pixelorder, int x, int y);
 
+    /*
+     * writeImage - write opened image to a file
+     *
+     * Parameters:
+     *   - image        - opened image
+     *   - imagefile    - output file, format is detected from suffix
+     *
+     * Return value:
+     *   0 on success, ERROR_CANNOT_WRITE_IMAGEFILE on failure.
+     */
+    EXPORT
+    int writeImage(void* image, const char* imagefile);
+
+    /*
+     * convertImage - apply an ImageMagick convert option to an image
+     *
+     * Parameters:
+     *   - image        - opened image, not modified
+     *   - option       - convert command line option. Supported
+     *                    options are -colorspace (gray only), -crop
+     *                    (WxH+X+Y only), -depth, -flip, -flop,
+     *                    -resize, -rotate and -threshold.
+     *   - argument     - argument of the option, NULL if the option
+     *                    takes no arguments
+     *
+     * Return value:
+     *   NULL if the option or its argument is not supported, or the
+     *   conversion failed. Otherwise a new opened image that must
+     *   be closed with closeImage.
+     */
+    EXPORT
+    void* convertImage(void* image, const char* option, const char* argument);
+
+    /*
+     * cloneImage - copy an opened image
+     *
+     * Return value:
+     *   NULL on failure, otherwise a new opened image that must be
+     *   closed with closeImage.
+     */
+    EXPORT
+    void* cloneImage(void* image);
+
+    /*
+     * drawImage - draw on an opened image like ImageMagick convert
+     *             -stroke <stroke> -fill <fill> -draw <primitive>
+     *
+     * Parameters:
+     *   - image        - opened image, modified in place
+     *   - stroke       - stroke color, for instance "red" or "none".
+     *                    NULL uses the default (none).
+     *   - fill         - fill color, NULL uses the default (black).
+     *   - primitive    - drawing primitive, for instance
+     *                    "fill-opacity 0.2 rectangle 10,10 20,20",
+     *                    "line 0,0 10,10" or "text 10,10 'label'".
+     *
+     * Return value:
+     *   0 on success, ERROR_CANNOT_DRAW on failure.
+     */
+    EXPORT
+    int drawImage(void* image, const char* stroke, const char* fill,
+                  const char* primitive);
+
     EXPORT
     void closeImage(void* image);
 
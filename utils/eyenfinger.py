@@ -225,6 +225,18 @@ try:
     else:
         raise ImportError("%s cannot load eye4graphics%s" % (__file__, _suffix))
 
+    eye4graphics.openImage.argtypes = [ctypes.c_char_p]
+    eye4graphics.openImage.restype = ctypes.c_void_p
+    eye4graphics.cloneImage.argtypes = [ctypes.c_void_p]
+    eye4graphics.cloneImage.restype = ctypes.c_void_p
+    eye4graphics.drawImage.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_char_p,
+        ctypes.c_char_p,
+        ctypes.c_char_p]
+    eye4graphics.writeImage.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+    eye4graphics.closeImage.argtypes = [ctypes.c_void_p]
+
     class Bbox(ctypes.Structure):
         _fields_ = [("left", ctypes.c_int32),
                     ("top", ctypes.c_int32),
@@ -306,8 +318,49 @@ def _runcmd(cmd):
         p.stderr.read()
     return exit_status, output
 
-def _runDrawCmd(inputfilename, cmd, outputfilename):
+def _e4gDraw(inputfilename, cmd, outputfilename, inputImage=None):
+    """
+    Execute convert draw options (-stroke, -fill and -draw) in
+    process with eye4graphics. If inputImage is given, draw on a copy
+    of the already opened image instead of reading inputfilename.
+
+    Returns True on success, False if cmd contains other options or
+    drawing failed.
+    """
+    if not eye4graphics or len(cmd) % 2 != 0:
+        return False
+    draws = []
+    stroke, fill = None, None
+    for option, argument in zip(cmd[::2], cmd[1::2]):
+        if isinstance(argument, unicode):
+            argument = argument.encode("utf-8")
+        if option == "-stroke":
+            stroke = argument
+        elif option == "-fill":
+            fill = argument
+        elif option == "-draw":
+            draws.append((stroke, fill, argument))
+        else:
+            return False
+    if inputImage:
+        image = eye4graphics.cloneImage(inputImage)
+    else:
+        image = eye4graphics.openImage(inputfilename)
+    if not image:
+        return False
+    try:
+        for stroke, fill, primitive in draws:
+            if eye4graphics.drawImage(image, stroke, fill, primitive) != 0:
+                _log("eye4graphics drawing failed: %s" % (primitive,))
+                return False
+        return eye4graphics.writeImage(image, outputfilename) == 0
+    finally:
+        eye4graphics.closeImage(image)
+
+def _runDrawCmd(inputfilename, cmd, outputfilename, inputImage=None):
     if not _g_defaultDelayedDrawing:
+        if _e4gDraw(inputfilename, cmd, outputfilename, inputImage):
+            return (0, "")
         return _runcmd([fmbt_config.imagemagick_convert,
                         inputfilename] + cmd + [outputfilename])
     # Do delayed drawing to save test execution time. If the output
@@ -375,7 +428,9 @@ def iSetDefaultDelayedDrawing(delayedDrawing):
 
     If delayedDrawing == False, drawing actions on screenshots (like
     highlighting icon and clicked coordinates) takes place during the
-    function execution (like iClickIcon).
+    function execution (like iClickIcon). Drawing is done in process
+    by eye4graphics when it is available, otherwise by ImageMagick
+    convert.
 
     If delayedDrawing == True, the screenshot is saved without
     highlighted areas, and <screenshot filename>.delayeddraw file
@@ -1614,7 +1669,7 @@ def iActiveWindow(windowId = None):
 
     return windowId
 
-def drawBboxes(inputfilename, outputfilename, bboxes):
+def drawBboxes(inputfilename, outputfilename, bboxes, inputImage=None):
     """
     Draw bounding boxes
     """
@@ -1627,9 +1682,9 @@ def drawBboxes(inputfilename, outputfilename, bboxes):
         color = "green"
         draw_commands += ["-stroke", color, "-fill", "blue", "-draw", "fill-opacity 0.2 rectangle %s,%s %s,%s" % (
             left, top, right, bottom)]
-    _runDrawCmd(inputfilename, draw_commands, outputfilename)
+    _runDrawCmd(inputfilename, draw_commands, outputfilename, inputImage)
 
-def drawBbox(inputfilename, outputfilename, bbox, caption):
+def drawBbox(inputfilename, outputfilename, bbox, caption, inputImage=None):
     """
     Draw bounding box
     """
@@ -1644,9 +1699,9 @@ def drawBbox(inputfilename, outputfilename, bbox, caption):
         left, top, right, bottom)]
     draw_commands += ["-stroke", "none", "-fill", color, "-draw", "text %s,%s '%s'" % (
         left, top, _safeForShell(caption))]
-    _runDrawCmd(inputfilename, draw_commands, outputfilename)
+    _runDrawCmd(inputfilename, draw_commands, outputfilename, inputImage)
 
-def drawWords(inputfilename, outputfilename, words, detected_words):
+def drawWords(inputfilename, outputfilename, words, detected_words, inputImage=None):
     """
     Draw boxes around words detected in inputfilename that match to
     given words. Result is saved to outputfilename.
@@ -1670,9 +1725,9 @@ def drawWords(inputfilename, outputfilename, words, detected_words):
             left, top, _safeForShell(w))]
         draw_commands += ["-stroke", "none", "-fill", color, "-draw", "text %s,%s '%.2f'" % (
             left, bottom+10, score)]
-    _runDrawCmd(inputfilename, draw_commands, outputfilename)
+    _runDrawCmd(inputfilename, draw_commands, outputfilename, inputImage)
 
-def drawIcon(inputfilename, outputfilename, iconFilename, bboxes, color='green', area=None):
+def drawIcon(inputfilename, outputfilename, iconFilename, bboxes, color='green', area=None, inputImage=None):
     if inputfilename == None:
         return
     if type(bboxes) == tuple:
@@ -1692,9 +1747,9 @@ def drawIcon(inputfilename, outputfilename, iconFilename, bboxes, color='green',
             left, top, _safeForShell(caption))]
     if area != None:
         draw_commands += ["-stroke", "yellow", "-draw", "fill-opacity 0.0 rectangle %s,%s %s,%s" % (area[0]-1, area[1]-1, area[2], area[3])]
-    _runDrawCmd(inputfilename, draw_commands, outputfilename)
+    _runDrawCmd(inputfilename, draw_commands, outputfilename, inputImage)
 
-def drawClickedPoint(inputfilename, outputfilename, clickedXY):
+def drawClickedPoint(inputfilename, outputfilename, clickedXY, inputImage=None):
     """
     clickedXY contains absolute screen coordinates
     """
@@ -1707,7 +1762,7 @@ def drawClickedPoint(inputfilename, outputfilename, clickedXY):
     draw_commands = ["-stroke", "red", "-fill", "blue", "-draw", "fill-opacity 0.2 circle %s,%s %s,%s" % (
         x, y, x + 20, y)]
     draw_commands += ["-stroke", "none", "-fill", "red", "-draw", "point %s,%s" % (x, y)]
-    _runDrawCmd(inputfilename, draw_commands, outputfilename)
+    _runDrawCmd(inputfilename, draw_commands, outputfilename, inputImage)
 
 def _screenToWindow(x,y):
     """
@@ -1727,7 +1782,7 @@ def _windowToScreen(x,y):
 
     return (x+offsetX, y+offsetY)
 
-def drawLines(inputfilename, outputfilename, orig_coordinates, final_coordinates):
+def drawLines(inputfilename, outputfilename, orig_coordinates, final_coordinates, inputImage=None):
     """
     coordinates contains the coordinates connected by lines
     """
@@ -1762,7 +1817,7 @@ def drawLines(inputfilename, outputfilename, orig_coordinates, final_coordinates
         (finalX, finalY) = _screenToWindow(final_coordinates[lastIndex][0], final_coordinates[lastIndex][1])
         draw_commands += ["-fill", "blue", "-stroke", "red", "-draw", "fill-opacity 0.2 circle %d, %d %d, %d" % (finalX, finalY, finalX-5, finalY-5)]
 
-    _runDrawCmd(inputfilename, draw_commands, outputfilename)
+    _runDrawCmd(inputfilename, draw_commands, outputfilename, inputImage)
 
 def evaluatePreprocessFilter(imageFilename, ppfilter, words):
     """
@@ -192,6 +192,15 @@ try:
 except ImportError:
     fmbtpng = None
 
+# screencap raw colorspaces as ImageMagick pixel orders, P is padding
+_screencapPixelOrder = {
+    "RGB": "RGB",
+    "RGBA": "RGBA",
+    "RGB_": "RGBP",
+    "BGR": "BGR",
+    "BGR_": "BGRP"
+}
+
 ROTATION_0 = 0
 ROTATION_90 = 1
 ROTATION_180 = 2
@@ -1020,7 +1029,7 @@ class Device(fmbtgti.GUITestInterface):
             _adapterLog("reconnect failed: %s" % (e,))
             return False
 
-    def refreshScreenshot(self, forcedScreenshot=None, rotate=None):
+    def refreshScreenshot(self, forcedScreenshot=None, rotate=None, newerThan=None):
         # convert Android display/user rotation to degrees
         if rotate in ROTATIONS:
             rotate = ROTATION_DEGS[rotate]
@@ -1033,8 +1042,8 @@ class Device(fmbtgti.GUITestInterface):
                 else:
                     drot = None
                 if drot != None:
-                    return self.refreshScreenshot(forcedScreenshot, rotate=-drot)
-        rv = fmbtgti.GUITestInterface.refreshScreenshot(self, forcedScreenshot, rotate)
+                    return self.refreshScreenshot(forcedScreenshot, rotate=-drot, newerThan=newerThan)
+        rv = fmbtgti.GUITestInterface.refreshScreenshot(self, forcedScreenshot, rotate, newerThan)
         if rv:
             if not forcedScreenshot:
                 self._screenSize = self.existingConnection().recvScreenSize()
@@ -1601,7 +1610,7 @@ class Device(fmbtgti.GUITestInterface):
                 use uiautomator to read view dump from the device.
                 If not given, uiautomatorDump() default will be used.
 
-          waitTime, pollDelay, beforeRefresh, afterRefresh (optional):
+          waitTime, pollDelay, minPollDelay, beforeRefresh, afterRefresh (optional):
                   refer to wait documentation.
 
         Returns list of texts that appear in the first refreshed view
@@ -1642,7 +1651,7 @@ class Device(fmbtgti.GUITestInterface):
                 use uiautomator to read view dump from the device.
                 If not given, uiautomatorDump() default will be used.
 
-          waitTime, pollDelay, beforeRefresh, afterRefresh (optional):
+          waitTime, pollDelay, minPollDelay, beforeRefresh, afterRefresh (optional):
                 refer to wait documentation.
 
         Returns True if text appeared within given time limit,
@@ -2341,6 +2350,11 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         os.remove(filename)
         return contents
 
+    def canRecvScreenshotConcurrently(self):
+        # screenshots are captured with adb screencap, input events
+        # are sent through the monkey socket
+        return True
+
     def _runAdb(self, adbCommand, expectedExitStatus=0, timeout=None):
         if not self._stopOnError:
             expect = None
@@ -2534,6 +2548,45 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
             else:
                 raise AndroidConnectionError('Android monkey socket connection lost while sending command "%s"' % (command,))
 
+    def _monkeyCommands(self, commands, timeout=5.0, retry=3):
+        """
+        Send commands to monkey at once and read their responses.
+        Returns True if all commands succeeded.
+        """
+        responses = []
+        data = ""
+        try:
+            self._monkeySocket.settimeout(timeout)
+            self._monkeySocket.sendall("".join([c + "\n" for c in commands]))
+            while len(responses) < len(commands):
+                received = self._monkeySocket.recv(4096)
+                if not received:
+                    raise socket.error("connection closed by monkey")
+                data += received
+                lines = data.split("\n")
+                data = lines.pop()
+                responses.extend([l.strip() for l in lines])
+            self._monkeySocket.settimeout(5.0)
+        except socket.error, e:
+            try: self._monkeySocket.close()
+            except: pass
+            self._resetMonkey()
+            # If the connection was lost before monkey responded at
+            # all, no command has been executed and the sequence can
+            # be resent. Otherwise (or if monkey is just slow to
+            # respond) resending could repeat a part of the sequence,
+            # report the error instead.
+            if (not responses and not data and retry > 0 and
+                not isinstance(e, socket.timeout)):
+                return self._monkeyCommands(commands, timeout, retry-1)
+            raise AndroidConnectionError('Android monkey socket connection lost while sending commands "%s"' % ("; ".join(commands),))
+        failed = [(c, r) for c, r in map(None, commands, responses)
+                  if r == None or not r.startswith("OK")]
+        if failed:
+            _adapterLog("monkeyCommands failing... command: '%s' response: '%s'" % failed[0])
+            return False
+        return True
+
     def install(self, filename, lock, reinstall, downgrade,
                 sdcard, algo, key, iv):
         cmd = ["install"]
@@ -2901,6 +2954,22 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         xCoord, yCoord = self._screenToDisplay(xCoord, yCoord)
         return self._monkeyCommand("touch move " + str(xCoord) + " " + str(yCoord))[0]
 
+    def sendInputSequence(self, events):
+        # Send all touch events in one go, monkey sleep commands
+        # time the events on the device.
+        commands = []
+        prevMs = 0
+        for event, xCoord, yCoord, tOffset in events:
+            if not event in ("down", "move", "up"):
+                raise ValueError('invalid input event "%s"' % (event,))
+            ms = int(round(tOffset * 1000))
+            if ms > prevMs:
+                commands.append("sleep " + str(ms - prevMs))
+                prevMs = ms
+            xCoord, yCoord = self._screenToDisplay(xCoord, yCoord)
+            commands.append("touch " + event + " " + str(xCoord) + " " + str(yCoord))
+        return self._monkeyCommands(commands, timeout=5.0 + prevMs / 1000.0)
+
     def sendTrackBallMove(self, dx, dy):
         dx, dy = self._screenToDisplay(dx, dy)
         return self._monkeyCommand("trackball " + str(dx) + " " + str(dy))[0]
@@ -3007,63 +3076,14 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
         _screenshotTimeout = 60
         if self._screencapFormat != "png" and fmbtpng != None:
             # EXPERIMENTAL: PNG encoding moved from device to host
-            remotefile = '/sdcard/fmbtandroid-s.raw'
-            cmd = ['shell', 'screencap %s | gzip -3 > %s' % (
-                ' '.join(self._screencapArgs), remotefile)]
-            status, out, err = self._runAdb(cmd, [0, 124], timeout=_screenshotTimeout)
-            if status != 0:
-                errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
-                    " ".join(cmd), status, out, err)
-            else:
-                cmd = ['pull', remotefile, filename + ".raw"]
-                status, out, err = self._runAdb(cmd, [0, 1, 124], timeout=_screenshotTimeout)
-                if status == 124:
-                    errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
-                        " ".join(cmd), status, out, err)
-                else:
-                    errmsg = "screenshot 'adb %s' failed, exit status %s" % (" ".join(cmd), status)
-            if status != 0:
-                _adapterLog(errmsg)
-                raise FMBTAndroidError(errmsg)
-            try:
-                data = gzip.open(filename + ".raw").read()
-            except Exception, e:
-                msg = 'reading screenshot from "%s" failed: %s' % (
-                    filename + ".raw", e)
-                _adapterLog(msg)
-                raise FMBTAndroidError(msg)
-            os.unlink(filename + ".raw")
-
-            if len(data) < 256:
-                msg = "Too small screenshot: %s bytes, skip unpack." % (
-                    len(data),)
-                _adapterLog(msg)
+            raw = self._recvScreencapRaw(filename + ".raw")
+            if raw == False:
                 # This is not an error, it's ok to DRM to prevent a screenshot
                 return False
-            try:
-                width, height, fmt = struct.unpack("<LLL", data[:12])
-            except struct.error, e:
-                msg = ("error unpacking screenshot data (%s bytes): %s" %
-                       (len(data), e))
-                _adapterLog(msg)
-                raise FMBTAndroidError(msg)
-            if isinstance(self._screencapFormat, tuple):
-                depth, colorspace = self._screencapFormat
-            elif fmt == 1:
-                depth, colorspace = 8, "RGBA"
-            elif fmt == 2:
-                depth, colorspace = 8, "RGB_"
-            elif fmt == 3:
-                depth, colorspace = 8, "RGB"
-            elif fmt == 5:
-                depth, colorspace = 8, "BGR_" # ignore alpha
-            else:
-                _adapterLog("unsupported screencap raw format %s" % (fmt,))
-                depth, colorspace = None, None
-
-            if depth != None:
+            elif raw != None:
+                width, height, depth, colorspace, data = raw
                 file(filename, "w").write(fmbtpng.raw2png(
-                    data[12:], width, height, depth, colorspace))
+                    data, width, height, depth, colorspace))
                 return True
             else:
                 # fallback to slower screenshot method
@@ -3102,6 +3122,95 @@ class _AndroidDeviceConnection(fmbtgti.GUITestConnection):
 
         return True
 
+    def recvScreenshotData(self):
+        """
+        Capture a screenshot without saving it to a file.
+
+        Returns (width, height, pixelOrder, data) on success, False
+        if screenshot was not available (for instance, prevented by
+        DRM) and None if raw screencap format is not in use.
+        """
+        if self._screencapFormat == "png":
+            return None
+        fd, rawFilename = tempfile.mkstemp(prefix="fmbtandroid-", suffix=".raw")
+        os.close(fd)
+        try:
+            raw = self._recvScreencapRaw(rawFilename)
+        finally:
+            if os.access(rawFilename, os.F_OK):
+                os.unlink(rawFilename)
+        if raw == False or raw == None:
+            return raw
+        width, height, depth, colorspace, data = raw
+        if depth == 8 and colorspace in _screencapPixelOrder:
+            return (width, height, _screencapPixelOrder[colorspace], data)
+        else:
+            # other formats are converted through a PNG file
+            return None
+
+    def _recvScreencapRaw(self, rawFilename):
+        """
+        Capture raw screencap output to rawFilename on host.
+
+        Returns (width, height, depth, colorspace, pixeldata) on
+        success, False if screenshot data was too small and None if
+        the raw format is not supported.
+        """
+        _screenshotTimeout = 60
+        remotefile = '/sdcard/fmbtandroid-s.raw'
+        cmd = ['shell', 'screencap %s | gzip -3 > %s' % (
+            ' '.join(self._screencapArgs), remotefile)]
+        status, out, err = self._runAdb(cmd, [0, 124], timeout=_screenshotTimeout)
+        if status != 0:
+            errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
+                " ".join(cmd), status, out, err)
+        else:
+            cmd = ['pull', remotefile, rawFilename]
+            status, out, err = self._runAdb(cmd, [0, 1, 124], timeout=_screenshotTimeout)
+            if status == 124:
+                errmsg = "screenshot timeout: command='adb %s' status=%s, stdout=%s, stderr=%s" % (
+                    " ".join(cmd), status, out, err)
+            else:
+                errmsg = "screenshot 'adb %s' failed, exit status %s" % (" ".join(cmd), status)
+        if status != 0:
+            _adapterLog(errmsg)
+            raise FMBTAndroidError(errmsg)
+        try:
+            data = gzip.open(rawFilename).read()
+        except Exception, e:
+            msg = 'reading screenshot from "%s" failed: %s' % (
+                rawFilename, e)
+            _adapterLog(msg)
+            raise FMBTAndroidError(msg)
+        os.unlink(rawFilename)
+
+        if len(data) < 256:
+            msg = "Too small screenshot: %s bytes, skip unpack." % (
+                len(data),)
+            _adapterLog(msg)
+            return False
+        try:
+            width, height, fmt = struct.unpack("<LLL", data[:12])
+        except struct.error, e:
+            msg = ("error unpacking screenshot data (%s bytes): %s" %
+                   (len(data), e))
+            _adapterLog(msg)
+            raise FMBTAndroidError(msg)
+        if isinstance(self._screencapFormat, tuple):
+            depth, colorspace = self._screencapFormat
+        elif fmt == 1:
+            depth, colorspace = 8, "RGBA"
+        elif fmt == 2:
+            depth, colorspace = 8, "RGB_"
+        elif fmt == 3:
+            depth, colorspace = 8, "RGB"
+        elif fmt == 5:
+            depth, colorspace = 8, "BGR_" # ignore alpha
+        else:
+            _adapterLog("unsupported screencap raw format %s" % (fmt,))
+            return None
+        return (width, height, depth, colorspace, data[12:])
+
     def setScreenToDisplayCoords(self, screenToDisplayFunction):
         self._screenToDisplay = screenToDisplayFunction
 
@@ -96,23 +96,30 @@ verifyBitmap("bitmap.png") returns True. Visual log shows the
 information about which of the alternatives actually matched.
 """
 
+import array
+import atexit
 import cgi
+import collections
 import ctypes
 import datetime
 import distutils.sysconfig
-import gc
 import glob
+import gzip
+import hashlib
 import inspect
 import math
 import os
+import Queue
 import re
 import shlex
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import traceback
 import types
+import weakref
 
 import fmbt
 import fmbt_config
@@ -133,6 +140,28 @@ _g_oirEngines = []
 
 _g_forcedLocExt = ".fmbtoir.loc"
 
+# Memory budget for decoded bitmaps in the eye4graphics OIR engine.
+_g_defaultBitmapCacheSize = 64 * 1024 * 1024
+# Number of findBitmap results kept in the content-addressed cache.
+_g_defaultResultCacheSize = 256
+# Estimated memory usage per decoded pixel (MagickCore PixelPacket).
+_g_e4gBytesPerPixel = 8
+# Width and height of tiles compared in change detection, pixels.
+_g_tileSize = 32
+# Pyramid search falls back to searching everywhere if downsampled
+# screenshot gives more candidates than this.
+_g_pyramidMaxCandidates = 4096
+# Number of searches whose matches are kept for incremental search.
+_g_incrementalSearches = 64
+# Number of screenshots waiting for archiving before refreshScreenshot
+# blocks until the background archiver catches up.
+_g_screenshotArchiveQueueSize = 64
+# Number of latest calls of each instrumented method kept in perfStats.
+_g_perfStatsBufferSize = 1024
+# Number of visual log writes waiting for the writer thread before
+# logging blocks.
+_g_visualLogQueueSize = 1024
+
 class _USE_DEFAULTS:
     pass
 
@@ -151,7 +180,7 @@ def _takeTapArgs(d):
     return _takeArgs(("tapOffset", "tapPos", "long", "hold", "count", "delayBetweenTaps", "button"), d)
 
 def _takeWaitArgs(d):
-    return _takeArgs(("waitTime", "pollDelay",
+    return _takeArgs(("waitTime", "pollDelay", "minPollDelay",
                       "beforeRefresh", "afterRefresh"), d)
 
 def _takeOirArgs(screenshotOrOirEngine, d, thatsAll=False):
@@ -193,6 +222,19 @@ def _convert(srcFile, convertArgs, dstFile):
         os.access(srcFile, os.R_OK) and
         os.stat(srcFile).st_mtime < os.stat(dstFile).st_mtime):
         return # cached file is up-to-date
+    if _e4gConvertOptions(convertArgs) and os.access(srcFile, os.R_OK):
+        srcImage = eye4graphics.openImage(srcFile)
+        if srcImage:
+            try:
+                dstImage = _e4gConvert(srcImage, convertArgs)
+            finally:
+                eye4graphics.closeImage(srcImage)
+            if dstImage:
+                try:
+                    if eye4graphics.writeImage(dstImage, dstFile) == 0:
+                        return
+                finally:
+                    eye4graphics.closeImage(dstImage)
     subprocess.call([fmbt_config.imagemagick_convert, srcFile] + convertArgs + [dstFile])
 
 def _ppFilename(origFilename, preprocess):
@@ -211,6 +253,40 @@ def _boxOnRegion((x1, y1, x2, y2), (minX, minY, maxX, maxY), partial=True):
         return (x1 < x2 and ((minX <= x1 <= maxX) and (minX <= x2 <= maxX)) and
                 y1 < y2 and ((minY <= y1 <= maxY) and (minY <= y2 <= maxY)))
 
+class _BboxGrid(object):
+    """
+    Bounding boxes indexed by grid cells they cover. Finds boxes
+    containing a point without going through all boxes.
+    """
+    def __init__(self, cellWidth, cellHeight):
+        self._cellWidth = max(1, cellWidth)
+        self._cellHeight = max(1, cellHeight)
+        self._cells = {} # (column, row) -> [bbox, ...]
+
+    def add(self, (left, top, right, bottom)):
+        for column in xrange(left // self._cellWidth,
+                             right // self._cellWidth + 1):
+            for row in xrange(top // self._cellHeight,
+                              bottom // self._cellHeight + 1):
+                self._cells.setdefault((column, row), []).append(
+                    (left, top, right, bottom))
+
+    def boxesAt(self, (x, y)):
+        """
+        Returns boxes that may contain (x, y), borders included.
+        """
+        return self._cells.get((x // self._cellWidth, y // self._cellHeight), ())
+
+def _bitmapMatchesOverlap((itemLeft, itemTop, itemRight, itemBottom), bbox):
+    """
+    Returns True if bbox of a new bitmap match overlaps the bbox of
+    an accepted match so that the new match must be filtered out.
+    """
+    return (((itemLeft <= bbox[0] <= itemRight or itemLeft <= bbox[2] <= itemRight) and
+             (itemTop <= bbox[1] <= itemBottom or itemTop <= bbox[3] <= itemBottom)) and
+            ((itemLeft < bbox[0] < itemRight or itemLeft < bbox[2] < itemRight) or
+             (itemTop < bbox[1] < itemBottom or itemTop < bbox[3] < itemBottom)))
+
 def _edgeDistanceInDirection((x, y), (width, height), direction):
     x, y = _intCoords((x, y), (width, height))
 
@@ -247,6 +323,20 @@ class _Rgb888(ctypes.Structure):
                 ("green", ctypes.c_uint8),
                 ("blue", ctypes.c_uint8)]
 
+class _ColorRegion(ctypes.Structure):
+    _fields_ = [("left", ctypes.c_int32),
+                ("top", ctypes.c_int32),
+                ("right", ctypes.c_int32),
+                ("bottom", ctypes.c_int32),
+                ("pixels", ctypes.c_int32),
+                ("color", ctypes.c_int32)]
+
+class _PixelLayout(ctypes.Structure):
+    _fields_ = [("pixelSize", ctypes.c_int32),
+                ("red", ctypes.c_int32),
+                ("green", ctypes.c_int32),
+                ("blue", ctypes.c_int32)]
+
 _libpath = ["", ".",
             os.path.dirname(os.path.abspath(__file__)),
             distutils.sysconfig.get_python_lib(plat_specific=1)]
@@ -277,6 +367,72 @@ for _dirname in _libpath:
             ctypes.c_int]
         eye4graphics.openImage.argtypes = [ctypes.c_char_p]
         eye4graphics.openImage.restype = ctypes.c_void_p
+        eye4graphics.openBlob.argtypes = [
+            ctypes.c_char_p,
+            ctypes.c_char_p,
+            ctypes.c_int,
+            ctypes.c_int]
+        eye4graphics.openBlob.restype = ctypes.c_void_p
+        eye4graphics.findNextIconThreads.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_double,
+            ctypes.c_double,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_float,
+            ctypes.c_float,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int]
+        eye4graphics.findNextIconCandidates.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_double,
+            ctypes.c_double,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_float,
+            ctypes.c_float,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_int]
+        eye4graphics.sampleImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_float,
+            ctypes.c_float,
+            ctypes.c_int]
+        eye4graphics.sampleImage.restype = ctypes.c_void_p
+        eye4graphics.findIcons.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_double,
+            ctypes.c_double,
+            ctypes.c_void_p,
+            ctypes.c_float,
+            ctypes.c_float,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int]
+        eye4graphics.colorCompareKernel.restype = ctypes.c_char_p
+        eye4graphics.convertImage.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_char_p,
+            ctypes.c_char_p]
+        eye4graphics.convertImage.restype = ctypes.c_void_p
+        eye4graphics.writeImage.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        eye4graphics.writeImage.restype = ctypes.c_int
         eye4graphics.openedImageDimensions.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
         eye4graphics.closeImage.argtypes = [ctypes.c_void_p]
         eye4graphics.rgb5652rgb.restype = ctypes.c_int
@@ -285,6 +441,30 @@ for _dirname in _libpath:
             ctypes.c_int,
             ctypes.c_int,
             ctypes.c_void_p]
+        eye4graphics.openedImagePixels.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        eye4graphics.openedImagePixels.restype = ctypes.c_void_p
+        eye4graphics.colorHistogram.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_void_p]
+        eye4graphics.colorHistogram.restype = ctypes.c_int
+        eye4graphics.tileHashes.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_int]
+        eye4graphics.tileHashes.restype = ctypes.c_int
+        eye4graphics.findColorRegions.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_void_p,
+            ctypes.c_double,
+            ctypes.c_double,
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_int]
+        eye4graphics.findColorRegions.restype = ctypes.c_int
         break
     except: pass
 else:
@@ -297,6 +477,67 @@ def _e4gOpenImage(filename):
     else:
         return image
 
+def _e4gOpenBlob(width, height, pixelOrder, data):
+    image = eye4graphics.openBlob(data, pixelOrder, width, height)
+    if not image:
+        raise IOError('Cannot open %sx%s %s image data' % (width, height, pixelOrder))
+    else:
+        return image
+
+# ImageMagick convert options implemented by eye4graphics.convertImage,
+# mapped to the number of their arguments.
+_g_e4gConvertOptions = {
+    "-colorspace": 1,
+    "-crop": 1,
+    "-depth": 1,
+    "-flip": 0,
+    "-flop": 0,
+    "-resize": 1,
+    "-rotate": 1,
+    "-threshold": 1,
+}
+
+def _e4gConvertOptions(convertArgs):
+    """
+    Returns convertArgs as a list of (option, argument) pairs, or
+    None if eye4graphics does not implement all of the options.
+    """
+    if isinstance(convertArgs, basestring):
+        convertArgs = shlex.split(convertArgs)
+    options = []
+    i = 0
+    while i < len(convertArgs):
+        option = convertArgs[i]
+        if not option in _g_e4gConvertOptions:
+            return None
+        if _g_e4gConvertOptions[option] == 1:
+            if i + 1 >= len(convertArgs):
+                return None
+            options.append((option, convertArgs[i + 1]))
+        else:
+            options.append((option, None))
+        i += 1 + _g_e4gConvertOptions[option]
+    return options or None
+
+def _e4gConvert(e4gImage, convertArgs):
+    """
+    Returns new opened image converted from e4gImage with convert
+    options, or None if options are not supported by eye4graphics.
+    """
+    options = _e4gConvertOptions(convertArgs)
+    if not options:
+        return None
+    image = e4gImage
+    for option, argument in options:
+        newImage = eye4graphics.convertImage(
+            ctypes.c_void_p(image), option, argument)
+        if image != e4gImage:
+            eye4graphics.closeImage(image)
+        if not newImage:
+            return None
+        image = newImage
+    return image
+
 def _e4gImageDimensions(e4gImage):
     struct_bbox = _Bbox(0, 0, 0, 0, 0)
     eye4graphics.openedImageDimensions(ctypes.byref(struct_bbox), e4gImage)
@@ -307,6 +548,35 @@ def _e4gImageIsBlank(filename):
     rv = (eye4graphics.openedImageIsBlank(e4gImage) == 1)
     eye4graphics.closeImage(e4gImage)
     return rv
+
+class _OpenedE4gImage(object):
+    """
+    Owns an opened image and closes it when the last reference to
+    the owner is deleted.
+    """
+    def __init__(self, e4gImage):
+        self.e4gImage = e4gImage
+
+    def __del__(self):
+        eye4graphics.closeImage(self.e4gImage)
+
+class _PixelBuffer(object):
+    """
+    Exposes pixels of an opened image through NumPy array interface
+    without copying them. Holds a reference to the owner of the
+    opened image so that the image stays open as long as arrays
+    created from the buffer exist.
+    """
+    def __init__(self, owner, address, (width, height), layout):
+        self._owner = owner
+        self.__array_interface__ = {
+            "shape": (height, width, 3),
+            "typestr": "|u1",
+            "data": (address + layout.red, True), # read-only
+            "strides": (width * layout.pixelSize,
+                        layout.pixelSize,
+                        layout.green - layout.red),
+            "version": 3}
 ### end of binding to eye4graphics.so
 
 def sortItems(items, criteria):
@@ -359,6 +629,40 @@ class GUITestConnection(object):
         raise NotImplementedError('sendTouchMove(%d, %d) needed but not implemented.' % (x, y))
     def sendTouchUp(self, x, y):
         raise NotImplementedError('sendTouchUp(%d, %d) needed but not implemented.' % (x, y))
+    def sendInputSequence(self, events, **kwargs):
+        """
+        Sends a sequence of touch events.
+
+        Parameters:
+
+          events (list of (event, x, y, t_offset) tuples):
+                  event is "down", "move" or "up", x and y are
+                  screen coordinates, and t_offset is the time in
+                  seconds from the beginning of the sequence when the
+                  event is sent.
+
+          rest of the parameters are passed to sendTouchDown,
+          sendTouchMove and sendTouchUp (for instance, button).
+
+        Connections can implement this to send the whole sequence to
+        the device at once so that events are timed on the device.
+        The default implementation calls sendTouchDown, sendTouchMove
+        and sendTouchUp, and sleeps between them.
+        """
+        sendEvent = {"down": self.sendTouchDown,
+                     "move": self.sendTouchMove,
+                     "up": self.sendTouchUp}
+        for event in events:
+            if not event[0] in sendEvent:
+                raise ValueError('invalid input event "%s"' % (event[0],))
+        startTime = time.time()
+        for event, x, y, tOffset in events:
+            delay = startTime + tOffset - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if not sendEvent[event](x, y, **kwargs):
+                return False
+        return True
     def sendType(self, text):
         raise NotImplementedError('sendType("%s") needed but not implemented.' % (text,))
     def recvScreenshot(self, filename):
@@ -366,6 +670,20 @@ class GUITestConnection(object):
         Saves screenshot from the GUI under test to given filename.
         """
         raise NotImplementedError('recvScreenshot("%s") needed but not implemented.' % (filename,))
+    def recvScreenshotData(self):
+        """
+        Returns screenshot from the GUI under test as raw pixel data
+        without writing it to a file.
+
+        Return value is a tuple (width, height, pixelOrder, data),
+        where pixelOrder is the order of 8-bit channels in a pixel
+        in data, for instance "RGB", "RGBA" or "BGRP" (P for
+        padding). Returns False if screenshot is not available.
+
+        Implementing this method is optional. If not implemented, the
+        method returns None, and recvScreenshot is used instead.
+        """
+        return None
     def recvScreenUpdated(self, waitTime, pollDelay):
         """
         Wait until the screen has been updated, but no longer than the
@@ -379,6 +697,17 @@ class GUITestConnection(object):
         (update-event based triggering, for instance).
         """
         return None
+    def canRecvScreenshotConcurrently(self):
+        """
+        Returns True if recvScreenshot and recvScreenshotData can be
+        called in another thread while send* methods are being
+        called, otherwise False.
+
+        Connections that capture screenshots through the same channel
+        (socket, pipe, display connection) that they use for sending
+        input events must return False. The default is False.
+        """
+        return False
     def target(self):
         """
         Returns a string that is unique to each test target. For
@@ -416,6 +745,9 @@ class SimulatedGUITestConnection(GUITestConnection):
         return lambda *args, **kwargs: self._calls.append(
             (time.time(), method, args, kwargs)) or True
 
+    def canRecvScreenshotConcurrently(self):
+        return True
+
     def history(self):
         return self._calls
 
@@ -971,7 +1303,46 @@ class OirEngine(OrEngine):
             except Exception, e:
                 raise ValueError('Error reading bounding box list from %s: %s' %
                                  repr(bitmapLocsFilename), e)
-        return self._findBitmap(screenshot, bitmap, **oirArgs)
+        # Engines may return and cache read-only sequences of items,
+        # callers get a list of their own.
+        return list(self._findBitmap(screenshot, bitmap, **oirArgs))
+
+    def findBitmaps(self, screenshot, bitmaps, **kwargs):
+        """
+        Return list of lists of fmbtgti.GUIItems that match to
+        bitmaps. The nth list contains items matching to the nth
+        bitmap.
+        """
+        results = [None] * len(bitmaps)
+        searchIndexes = []
+        for index, bitmap in enumerate(bitmaps):
+            if os.access(bitmap + _g_forcedLocExt, os.R_OK):
+                results[index] = self.findBitmap(screenshot, bitmap, **kwargs)
+            else:
+                searchIndexes.append(index)
+        if searchIndexes:
+            oirArgs = self.__oirArgs(screenshot, None, **kwargs)
+            foundItems = self._findBitmaps(
+                screenshot, [bitmaps[index] for index in searchIndexes],
+                **oirArgs)
+            for index, items in zip(searchIndexes, foundItems):
+                results[index] = list(items)
+        return results
+
+    def _findBitmaps(self, screenshot, bitmaps, **kwargs):
+        """
+        Find appearances of each bitmap from the screenshot.
+
+        Parameters are the same as in _findBitmap, except that
+        bitmaps is a list of bitmaps.
+
+        Returns list of lists of fmbtgti.GUIItems, one list per
+        bitmap. The default implementation calls _findBitmap for
+        each bitmap. Engines can override this to search all bitmaps
+        at once.
+        """
+        return [self._findBitmap(screenshot, bitmap, **kwargs)
+                for bitmap in bitmaps]
 
     def _findBitmap(self, screenshot, bitmap, **kwargs):
         """
@@ -1067,6 +1438,40 @@ class _Eye4GraphicsOirEngine(OirEngine):
               and then search for ref-pp.png in screenshot-pp.png. This results
               in black-and-white comparison (immune to slight color changes).
 
+      threads (integer, optional):
+              number of threads searching for the bitmap. Rows of
+              the search area are split into bands that are searched
+              in parallel. Results are the same as with a single
+              thread. The default is 1.
+
+      pyramid (integer, optional):
+              search candidates for matches from a downsampled
+              screenshot first. Every 2**pyramid'th pixel of the
+              screenshot is sampled, and only candidates found in
+              the samples are checked in the screenshot. Samples are
+              kept in memory with the screenshot, so searching for
+              several bitmaps or scales reuses them. Results are the
+              same as without pyramid. Not used if the effective
+              bitmap and screenshot pixel sizes are not 1, or the
+              bitmap is too small to be sampled. The default is 0:
+              search everywhere in the screenshot.
+
+      incremental (boolean, optional):
+              update matches of the previous screenshot instead of
+              searching the whole screenshot. Matches of the latest
+              screenshot are kept for each bitmap and parameters.
+              When the same bitmap is searched for with the same
+              parameters from a new screenshot, only rows of 32x32
+              pixel tiles that have changed, extended by the height
+              of the bitmap, are searched. Results are the same as
+              without incremental. Used only when searching from
+              the full width of the screenshot, and effective bitmap
+              and screenshot pixel sizes are 1. With scale != 1.0,
+              screenshotPixelSize must be given. The default is
+              False. Example: enable in waitBitmap loops on screens
+              where only small parts change:
+              d.oirEngine().setFindBitmapDefaults(incremental=True)
+
     If unsure about parameters, but you have a bitmap that should be
     detected in a screenshot, try obj.oirEngine().adjustParameters().
 
@@ -1083,8 +1488,24 @@ class _Eye4GraphicsOirEngine(OirEngine):
 
     Notice, that you can force refreshScreenshot to load old screenshot:
     d.refreshScreenshot("old.png")
+
+    Decoded bitmaps are kept in memory between findBitmap calls. The
+    memory budget of the cache can be given with the bitmapCacheSize
+    constructor parameter (bytes, the default is 64 MB), or changed
+    with setBitmapCacheSize().
+
+    Results of findBitmap are cached by the contents of the
+    screenshot and the bitmap, so searching from a screenshot that
+    is identical to an earlier one does not search again. The
+    number of cached results can be given with the resultCacheSize
+    constructor parameter (the default is 256), or changed with
+    setResultCacheSize(). See resultCacheStats().
     """
     def __init__(self, *args, **engineDefaults):
+        bitmapCacheSize = engineDefaults.pop("bitmapCacheSize",
+                                             _g_defaultBitmapCacheSize)
+        resultCacheSize = engineDefaults.pop("resultCacheSize",
+                                             _g_defaultResultCacheSize)
         engineDefaults["colorMatch"] = engineDefaults.get("colorMatch", 1.0)
         engineDefaults["opacityLimit"] = engineDefaults.get("opacityLimit", 0.0)
         engineDefaults["area"] = engineDefaults.get("area", (0.0, 0.0, 1.0, 1.0))
@@ -1094,17 +1515,288 @@ class _Eye4GraphicsOirEngine(OirEngine):
         engineDefaults["bitmapPixelSize"] = engineDefaults.get("bitmapPixelSize", 0)
         engineDefaults["screenshotPixelSize"] = engineDefaults.get("screenshotPixelSize", 0)
         engineDefaults["preprocess"] = engineDefaults.get("preprocess", "")
+        engineDefaults["threads"] = engineDefaults.get("threads", 1)
+        engineDefaults["pyramid"] = engineDefaults.get("pyramid", 0)
+        engineDefaults["incremental"] = engineDefaults.get("incremental", False)
         OirEngine.__init__(self, *args, **engineDefaults)
         self._openedImages = {}
+        # sharedImages contains filenames of images in openedImages
+        # that are owned by Screenshot objects. They must not be
+        # closed by the engine.
+        self._sharedImages = set()
         # openedRelatedScreenshots maps a screenshot filename to
         # a list of preprocessed screenshot objects. All those objects
         # must be closed when the screenshot is removed.
         self._openedRelatedScreenshots = {}
         self._findBitmapCache = {}
+        # pyramidLevels maps a screenshot filename to {step: e4gImage}
+        # where e4gImage contains every step'th pixel of the
+        # screenshot in openedImages.
+        self._pyramidLevels = {}
+        # incrementalBase maps search parameters to (screenshotSize,
+        # tileHashes, matches) of the latest screenshot searched with
+        # them, least recently searched first.
+        self._incrementalBase = collections.OrderedDict()
+        # bitmapCache maps absolute bitmap path to
+        # (fileId, e4gImage, imageBytes) in least recently used first
+        # order. fileId (mtime, size) is used to detect changed files.
+        self._bitmapCache = collections.OrderedDict()
+        self._bitmapCacheBytes = 0
+        self._bitmapCacheSize = bitmapCacheSize
+        # bitmapSamples maps absolute bitmap path to
+        # {(xscale, yscale, step): (samples, samplesBytes)}, where
+        # samples are the step * step sampled images of the bitmap
+        # in bitmapCache used by pyramid search. They are closed
+        # together with the bitmap and count in bitmapCacheBytes.
+        self._bitmapSamples = {}
+        # bitmapsInUse maps absolute bitmap path to the number of
+        # searches using it. Bitmaps in use are not closed.
+        self._bitmapsInUse = {}
+        # resultCache maps (screenshot digest, bitmap digest, search
+        # parameters) to bounding boxes of found items in least
+        # recently used first order.
+        self._resultCache = collections.OrderedDict()
+        self._resultCacheSize = resultCacheSize
+        self._resultCacheHits = 0
+        self._resultCacheMisses = 0
+        # bitmapDigests maps absolute bitmap path to (fileId, digest)
+        self._bitmapDigests = {}
+        # lock protects caches and preprocessing when bitmaps are
+        # searched for in parallel threads.
+        self._lock = threading.RLock()
+
+    def bitmapCacheSize(self):
+        """
+        Returns the memory budget of decoded bitmap cache in bytes.
+        """
+        return self._bitmapCacheSize
+
+    def setBitmapCacheSize(self, bitmapCacheSize):
+        """
+        Set the memory budget of decoded bitmap cache.
+
+        Parameters:
+
+          bitmapCacheSize (integer):
+                  maximum number of bytes used for decoded bitmaps.
+                  Least recently used bitmaps are closed when the
+                  budget is exceeded. 0 disables caching.
+        """
+        with self._lock:
+            self._bitmapCacheSize = bitmapCacheSize
+            self._trimBitmapCache()
+
+    def invalidateBitmapCache(self, bitmap=None):
+        """
+        Close decoded bitmaps in the cache.
+
+        Parameters:
+
+          bitmap (string, optional):
+                  bitmap file to be dropped from the cache.
+                  The default is None: drop all bitmaps.
+
+        Bitmap files that have been modified are reloaded
+        automatically. Invalidation is needed only if a file is
+        rewritten without changing its size or modification time.
+        """
+        with self._lock:
+            if bitmap == None:
+                filepaths = self._bitmapCache.keys()
+            else:
+                filepaths = [os.path.abspath(bitmap)]
+            for filepath in filepaths:
+                if (filepath in self._bitmapCache and
+                    not filepath in self._bitmapsInUse):
+                    _, e4gImage, imageBytes = self._bitmapCache.pop(filepath)
+                    eye4graphics.closeImage(e4gImage)
+                    self._bitmapCacheBytes -= imageBytes
+                    self._closeBitmapSamples(filepath)
+
+    def resultCacheSize(self):
+        """
+        Returns the max. number of cached findBitmap results.
+        """
+        return self._resultCacheSize
+
+    def setResultCacheSize(self, resultCacheSize):
+        """
+        Set the max. number of cached findBitmap results.
+
+        Parameters:
+
+          resultCacheSize (integer):
+                  number of results cached by screenshot and bitmap
+                  contents. Least recently used results are dropped
+                  when the cache is full. 0 disables caching.
+        """
+        with self._lock:
+            self._resultCacheSize = resultCacheSize
+            self._trimResultCache()
+
+    def resultCacheStats(self):
+        """
+        Returns statistics of the findBitmap result cache as a
+        dictionary with keys "hits", "misses" and "size" (number of
+        cached results). Searches from the latest screenshot that
+        are repeated with the same parameters are not counted.
+        """
+        with self._lock:
+            return {"hits": self._resultCacheHits,
+                    "misses": self._resultCacheMisses,
+                    "size": len(self._resultCache)}
+
+    def _trimResultCache(self):
+        while len(self._resultCache) > max(self._resultCacheSize, 0):
+            self._resultCache.popitem(last=False)
+
+    def _bitmapDigest(self, bitmap):
+        filepath = os.path.abspath(bitmap)
+        st = os.stat(filepath)
+        fileId = (st.st_mtime, st.st_size)
+        with self._lock:
+            if self._bitmapDigests.get(filepath, (None,))[0] == fileId:
+                return self._bitmapDigests[filepath][1]
+        digest = hashlib.sha1(file(filepath, "rb").read()).hexdigest()
+        with self._lock:
+            self._bitmapDigests[filepath] = (fileId, digest)
+        return digest
+
+    def _resultCacheKey(self, screenshot, bitmap, cacheKey):
+        """
+        Returns content-addressed result cache key for searching
+        bitmap from screenshot with parameters in cacheKey, or None
+        if results cannot be cached.
+        """
+        if self._resultCacheSize <= 0:
+            return None
+        try:
+            bitmapDigest = self._bitmapDigest(bitmap)
+        except (IOError, OSError):
+            return None
+        return (screenshot._contentDigest(), bitmapDigest) + cacheKey[1:]
+
+    def _cachedResult(self, resultCacheKey, ssFilename, bitmap):
+        """
+        Returns found items from the result cache or None.
+        """
+        if resultCacheKey == None:
+            return None
+        with self._lock:
+            bboxes = self._resultCache.pop(resultCacheKey, None)
+            if bboxes == None:
+                self._resultCacheMisses += 1
+                return None
+            self._resultCache[resultCacheKey] = bboxes
+            self._resultCacheHits += 1
+        return _GUIItemArray("bitmap", bboxes, ssFilename, bitmap=bitmap)
+
+    def _cacheResult(self, resultCacheKey, foundItems):
+        if resultCacheKey == None:
+            return
+        bboxes = array.array("i")
+        for item in foundItems:
+            bboxes.extend(item.bbox())
+        with self._lock:
+            self._resultCache.pop(resultCacheKey, None)
+            self._resultCache[resultCacheKey] = bboxes
+            self._trimResultCache()
+
+    def _trimBitmapCache(self):
+        for filepath in self._bitmapCache.keys():
+            if self._bitmapCacheBytes <= self._bitmapCacheSize:
+                break
+            if filepath in self._bitmapsInUse:
+                continue
+            _, e4gImage, imageBytes = self._bitmapCache.pop(filepath)
+            eye4graphics.closeImage(e4gImage)
+            self._bitmapCacheBytes -= imageBytes
+            self._closeBitmapSamples(filepath)
+
+    def _closeBitmapSamples(self, filepath):
+        for samples, samplesBytes in self._bitmapSamples.pop(filepath, {}).itervalues():
+            for e4gSample in samples:
+                eye4graphics.closeImage(e4gSample)
+            self._bitmapCacheBytes -= samplesBytes
+
+    def _openBitmapSamples(self, bitmap, e4gIcon, xscale, yscale, step):
+        """
+        Returns list of step * step images sampled from opened bitmap
+        e4gIcon starting from every pixel in a step x step square,
+        or None if they cannot be created. Samples are cached with
+        the bitmap, they must not be closed by the caller.
+        """
+        filepath = os.path.abspath(bitmap)
+        sampleKey = (xscale, yscale, step)
+        with self._lock:
+            bitmapSamples = self._bitmapSamples.setdefault(filepath, {})
+            if sampleKey in bitmapSamples:
+                return bitmapSamples[sampleKey][0]
+            samples = []
+            samplesBytes = 0
+            for yOffset in xrange(step):
+                for xOffset in xrange(step):
+                    e4gSample = eye4graphics.sampleImage(
+                        ctypes.c_void_p(e4gIcon), xOffset, yOffset, step,
+                        ctypes.c_float(xscale), ctypes.c_float(yscale), 1)
+                    if not e4gSample:
+                        for e4gSample in samples:
+                            eye4graphics.closeImage(e4gSample)
+                        return None
+                    samples.append(e4gSample)
+                    width, height = _e4gImageDimensions(e4gSample)
+                    samplesBytes += width * height * _g_e4gBytesPerPixel
+            bitmapSamples[sampleKey] = (samples, samplesBytes)
+            self._bitmapCacheBytes += samplesBytes
+            return samples
+
+    def _openBitmap(self, bitmap):
+        """
+        Returns opened bitmap from the bitmap cache. The bitmap is
+        opened and added to the cache if needed. Returned image must
+        not be closed by the caller, instead the caller must call
+        _releaseBitmap(bitmap) after using the image.
+        """
+        filepath = os.path.abspath(bitmap)
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            raise IOError('Cannot open image "%s"' % (bitmap,))
+        fileId = (st.st_mtime, st.st_size)
+        with self._lock:
+            if filepath in self._bitmapCache:
+                cachedFileId, e4gImage, imageBytes = self._bitmapCache.pop(filepath)
+                if (cachedFileId == fileId or
+                    filepath in self._bitmapsInUse):
+                    self._bitmapCache[filepath] = (cachedFileId, e4gImage, imageBytes)
+                    self._bitmapsInUse[filepath] = self._bitmapsInUse.get(filepath, 0) + 1
+                    return e4gImage
+                eye4graphics.closeImage(e4gImage)
+                self._bitmapCacheBytes -= imageBytes
+                self._closeBitmapSamples(filepath)
+            e4gImage = _e4gOpenImage(filepath)
+            width, height = _e4gImageDimensions(e4gImage)
+            imageBytes = width * height * _g_e4gBytesPerPixel
+            self._bitmapCache[filepath] = (fileId, e4gImage, imageBytes)
+            self._bitmapCacheBytes += imageBytes
+            self._bitmapsInUse[filepath] = 1
+            return e4gImage
+
+    def _releaseBitmap(self, bitmap):
+        filepath = os.path.abspath(bitmap)
+        with self._lock:
+            self._bitmapsInUse[filepath] -= 1
+            if self._bitmapsInUse[filepath] == 0:
+                del self._bitmapsInUse[filepath]
+            self._trimBitmapCache()
 
     def _addScreenshot(self, screenshot, **findBitmapDefaults):
-        filename = screenshot.filename()
-        self._openedImages[filename] = _e4gOpenImage(filename)
+        filename = screenshot._filename
+        if screenshot._e4gImage:
+            self._openedImages[filename] = screenshot._e4gImage
+            self._sharedImages.add(filename)
+        else:
+            self._openedImages[filename] = _e4gOpenImage(filename)
         # make sure size() is available, this can save an extra
         # opening of the screenshot file.
         if screenshot.size(allowReadingFile=False) == None:
@@ -1112,12 +1804,17 @@ class _Eye4GraphicsOirEngine(OirEngine):
         self._findBitmapCache[filename] = {}
 
     def _removeScreenshot(self, screenshot):
-        filename = screenshot.filename()
+        filename = screenshot._filename
         if filename in self._openedRelatedScreenshots:
             for screenshotPP in self._openedRelatedScreenshots[filename]:
                 self._removeScreenshot(screenshotPP)
             del self._openedRelatedScreenshots[filename]
-        eye4graphics.closeImage(self._openedImages[filename])
+        for e4gLevel in self._pyramidLevels.pop(filename, {}).itervalues():
+            eye4graphics.closeImage(e4gLevel)
+        if filename in self._sharedImages:
+            self._sharedImages.remove(filename)
+        else:
+            eye4graphics.closeImage(self._openedImages[filename])
         del self._openedImages[filename]
         del self._findBitmapCache[filename]
 
@@ -1126,6 +1823,7 @@ class _Eye4GraphicsOirEngine(OirEngine):
                          colorMatchRange = [p/100.0 for p in range(100,60,-10)],
                          pixelSizeRange = range(2,5),
                          resultCount = 1,
+                         parallel = 1,
                          **oirArgs):
         """
         Search for scale, colorMatch, bitmapPixelSize and
@@ -1155,18 +1853,24 @@ class _Eye4GraphicsOirEngine(OirEngine):
                   number of parameter combinations to be found.
                   The default is 1. 0 is unlimited.
 
+          parallel (integer, optional):
+                  number of threads searching with different
+                  parameter combinations at the same time. Results
+                  are the same as with a single thread. The default
+                  is 1.
+
           other OIR parameters: as usual, refer to engine documentation.
 
         Returns list of pairs: (GUIItem, findParams), where
         GUIItem is the detected item (GUIItem.bbox() is the box around it),
         and findParams is a dictionary containing the parameters.
         """
-        if not screenshot.filename() in self._findBitmapCache:
+        if not screenshot._filename in self._findBitmapCache:
             self.addScreenshot(screenshot)
             ssAdded = True
         else:
             ssAdded = False
-        retval = []
+        findParamsList = []
         for colorMatch in colorMatchRange:
             for pixelSize in pixelSizeRange:
                 for scale in scaleRange:
@@ -1176,62 +1880,226 @@ class _Eye4GraphicsOirEngine(OirEngine):
                                        "scale": scale,
                                        "bitmapPixelSize": pixelSize,
                                        "screenshotPixelSize": pixelSize})
-                    results = self.findBitmap(screenshot, bitmap,
-                                               **findParams)
-                    if results:
-                        retval.append((results[0], findParams))
-                        if len(retval) == resultCount:
-                            return retval
-        if ssAdded:
-            self.removeScreenshot(screenshot)
+                    findParamsList.append(findParams)
+        try:
+            if parallel > 1:
+                resultsList = self._findBitmapParallel(
+                    screenshot, bitmap, findParamsList, resultCount, parallel)
+            else:
+                resultsList = self._findBitmapSerial(
+                    screenshot, bitmap, findParamsList, resultCount)
+        finally:
+            if ssAdded:
+                self.removeScreenshot(screenshot)
+        retval = []
+        for results, findParams in zip(resultsList, findParamsList):
+            if results:
+                retval.append((results[0], findParams))
+                if len(retval) == resultCount:
+                    break
         return retval
 
+    def _findBitmapSerial(self, screenshot, bitmap, findParamsList, resultCount):
+        """
+        Returns list of findBitmap results, one for each parameters
+        in findParamsList, until resultCount results are found.
+        """
+        resultsList = []
+        foundCount = 0
+        for findParams in findParamsList:
+            results = self.findBitmap(screenshot, bitmap, **findParams)
+            resultsList.append(results)
+            if results:
+                foundCount += 1
+                if foundCount == resultCount:
+                    break
+        return resultsList
+
+    def _findBitmapParallel(self, screenshot, bitmap, findParamsList,
+                            resultCount, threadCount):
+        """
+        Parallel version of _findBitmapSerial. Stops searching when
+        results of the first parameters in findParamsList include
+        resultCount found results.
+        """
+        resultsList = [None] * len(findParamsList)
+        lock = threading.Lock()
+        state = {"next": 0, "done": False, "error": None}
+        def enoughResults():
+            foundCount = 0
+            for results in resultsList:
+                if results == None:
+                    return False
+                if results:
+                    foundCount += 1
+                    if foundCount == resultCount:
+                        return True
+            return False
+        def searchThread():
+            while True:
+                with lock:
+                    if state["done"] or state["next"] >= len(findParamsList):
+                        return
+                    index = state["next"]
+                    state["next"] += 1
+                try:
+                    results = self.findBitmap(screenshot, bitmap,
+                                              **findParamsList[index])
+                except:
+                    with lock:
+                        state["done"] = True
+                        state["error"] = sys.exc_info()
+                    return
+                with lock:
+                    resultsList[index] = results
+                    if resultCount > 0 and enoughResults():
+                        state["done"] = True
+        threads = [threading.Thread(target=searchThread)
+                   for _ in xrange(min(threadCount, len(findParamsList)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if state["error"]:
+            raise state["error"][0], state["error"][1], state["error"][2]
+        return [results or [] for results in resultsList]
+
     def _findBitmap(self, screenshot, bitmap, colorMatch=None,
                     opacityLimit=None, area=None, limit=None,
                     allowOverlap=None, scale=None,
                     bitmapPixelSize=None, screenshotPixelSize=None,
-                    preprocess=None):
+                    preprocess=None, threads=None, pyramid=None,
+                    incremental=None):
         """
         Find items on the screenshot that match to bitmap.
         """
-        ssFilename = screenshot.filename()
+        ssFilename = screenshot._filename
         ssSize = screenshot.size()
         cacheKey = (bitmap, colorMatch, opacityLimit, area, limit,
-                    scale, bitmapPixelSize, screenshotPixelSize, preprocess)
-        if cacheKey in self._findBitmapCache[ssFilename]:
-            return self._findBitmapCache[ssFilename][cacheKey]
-        self._findBitmapCache[ssFilename][cacheKey] = []
+                    allowOverlap, scale, bitmapPixelSize,
+                    screenshotPixelSize, preprocess)
+        resultCache = self._findBitmapCache[ssFilename]
+        if cacheKey in resultCache:
+            return resultCache[cacheKey]
+        resultCacheKey = self._resultCacheKey(screenshot, bitmap, cacheKey)
+        if preprocess:
+            foundItems = self._cachedResult(
+                resultCacheKey, _ppFilename(ssFilename, preprocess),
+                _ppFilename(bitmap, preprocess))
+        else:
+            foundItems = self._cachedResult(resultCacheKey, ssFilename, bitmap)
+        if foundItems != None:
+            resultCache[cacheKey] = foundItems
+            return foundItems
 
         if preprocess:
             ssFilenamePP = _ppFilename(ssFilename, preprocess)
             bitmapPP = _ppFilename(bitmap, preprocess)
-            if not ssFilenamePP in self._openedImages:
-                _convert(ssFilename, preprocess, ssFilenamePP)
-                screenshotPP = Screenshot(ssFilenamePP)
-                self.addScreenshot(screenshotPP)
-                if not ssFilename in self._openedRelatedScreenshots:
-                    self._openedRelatedScreenshots[ssFilename] = []
-                self._openedRelatedScreenshots[ssFilename].append(screenshotPP)
-            _convert(bitmap, preprocess, bitmapPP)
+            with self._lock:
+                if not ssFilenamePP in self._openedImages:
+                    e4gImagePP = screenshot._convertedE4gImage(preprocess)
+                    if e4gImagePP == None:
+                        _convert(screenshot.filename(), preprocess, ssFilenamePP)
+                    screenshotPP = Screenshot(ssFilenamePP, e4gImage=e4gImagePP)
+                    self.addScreenshot(screenshotPP)
+                    if not ssFilename in self._openedRelatedScreenshots:
+                        self._openedRelatedScreenshots[ssFilename] = []
+                    self._openedRelatedScreenshots[ssFilename].append(screenshotPP)
+                _convert(bitmap, preprocess, bitmapPP)
             ssFilename = ssFilenamePP
             bitmap = bitmapPP
-            self._findBitmapCache[ssFilename][cacheKey] = []
 
-        e4gIcon = _e4gOpenImage(bitmap)
+        e4gIcon = self._openBitmap(bitmap)
+        try:
+            if incremental and not preprocess:
+                incrementalScreenshot = screenshot
+            else:
+                incrementalScreenshot = None
+            foundItems = self._findBitmapMatches(
+                ssFilename, ssSize, bitmap, e4gIcon, colorMatch,
+                opacityLimit, area, limit, allowOverlap, scale,
+                bitmapPixelSize, screenshotPixelSize, threads, pyramid,
+                incrementalScreenshot)
+        finally:
+            self._releaseBitmap(bitmap)
+        resultCache[cacheKey] = foundItems
+        self._cacheResult(resultCacheKey, foundItems)
+        return foundItems
+
+    def _findBitmapMatches(self, ssFilename, ssSize, bitmap, e4gIcon,
+                           colorMatch, opacityLimit, area, limit,
+                           allowOverlap, scale, bitmapPixelSize,
+                           screenshotPixelSize, threads=1, pyramid=0,
+                           screenshot=None):
+        """
+        Returns list of GUIItems matching to opened bitmap e4gIcon.
+
+        If screenshot is given, matches may be updated from the
+        matches of the previous screenshot instead of searching the
+        whole screenshot. See _incrementalMatches.
+        """
+        foundBboxes = array.array("i")
+        # accepted matches indexed by their corners, a new match can
+        # overlap only matches that contain one of its corners.
+        acceptedBboxes = None
         matchCount = 0
         leftTopRightBottomZero = (_intCoords((area[0], area[1]), ssSize) +
                                   _intCoords((area[2], area[3]), ssSize) +
                                   (0,))
-        struct_area_bbox = _Bbox(*leftTopRightBottomZero)
-        struct_bbox = _Bbox(0, 0, 0, 0, 0)
-        contOpts = 0 # search for the first hit
         try:
             xscale, yscale = scale
         except TypeError:
             xscale = yscale = float(scale)
-        while True:
+        candidates = None
+        if pyramid:
+            candidates = self._pyramidCandidates(
+                ssFilename, bitmap, e4gIcon, colorMatch, opacityLimit,
+                xscale, yscale, bitmapPixelSize, screenshotPixelSize,
+                pyramid)
+        searchArgs = (e4gIcon, colorMatch, opacityLimit, xscale, yscale,
+                      bitmapPixelSize, screenshotPixelSize, threads,
+                      candidates)
+        matches = None
+        if screenshot != None:
+            matches = self._incrementalMatches(
+                screenshot, bitmap, leftTopRightBottomZero[:4], searchArgs)
+        if matches == None:
+            matches = self._bitmapMatches(
+                ssFilename, leftTopRightBottomZero[:4], searchArgs)
+        for bbox in matches:
             if matchCount == limit: break
-            result = eye4graphics.findNextIcon(
+            if allowOverlap == False:
+                if acceptedBboxes == None:
+                    acceptedBboxes = _BboxGrid(bbox[2] - bbox[0] + 1,
+                                               bbox[3] - bbox[1] + 1)
+                corners = ((bbox[0], bbox[1]), (bbox[2], bbox[1]),
+                           (bbox[0], bbox[3]), (bbox[2], bbox[3]))
+                if any(_bitmapMatchesOverlap(itemBbox, bbox)
+                       for corner in corners
+                       for itemBbox in acceptedBboxes.boxesAt(corner)):
+                    continue
+                acceptedBboxes.add(bbox)
+            foundBboxes.extend(bbox)
+            matchCount += 1
+        return _GUIItemArray("bitmap", foundBboxes, ssFilename, bitmap=bitmap)
+
+    def _bitmapMatches(self, ssFilename, (left, top, right, bottom),
+                       (e4gIcon, colorMatch, opacityLimit, xscale, yscale,
+                        bitmapPixelSize, screenshotPixelSize, threads,
+                        candidates)):
+        """
+        Generates bounding boxes of all matches of e4gIcon in the
+        area of the screenshot, in the order eye4graphics finds them.
+        """
+        struct_area_bbox = _Bbox(left, top, right, bottom, 0)
+        struct_bbox = _Bbox(0, 0, 0, 0, 0)
+        if candidates == None:
+            candidateCount = 0
+        else:
+            candidateCount = len(candidates) / 2
+        contOpts = 0 # search for the first hit
+        while True:
+            result = eye4graphics.findNextIconCandidates(
                 ctypes.byref(struct_bbox),
                 ctypes.c_void_p(self._openedImages[ssFilename]),
                 ctypes.c_void_p(e4gIcon),
@@ -1243,27 +2111,268 @@ class _Eye4GraphicsOirEngine(OirEngine):
                 ctypes.c_float(xscale),
                 ctypes.c_float(yscale),
                 ctypes.c_int(bitmapPixelSize),
-                ctypes.c_int(screenshotPixelSize))
+                ctypes.c_int(screenshotPixelSize),
+                ctypes.c_int(threads or 1),
+                candidates,
+                ctypes.c_int(candidateCount))
             contOpts = 1 # search for the next hit
             if result < 0: break
-            bbox = (int(struct_bbox.left), int(struct_bbox.top),
-                    int(struct_bbox.right), int(struct_bbox.bottom))
-            addToFoundItems = True
-            if allowOverlap == False:
-                for guiItem in self._findBitmapCache[ssFilename][cacheKey]:
-                    itemLeft, itemTop, itemRight, itemBottom = guiItem.bbox()
-                    if ((itemLeft <= bbox[0] <= itemRight or itemLeft <= bbox[2] <= itemRight) and
-                        (itemTop <= bbox[1] <= itemBottom or itemTop <= bbox[3] <= itemBottom)):
-                        if ((itemLeft < bbox[0] < itemRight or itemLeft < bbox[2] < itemRight) or
-                            (itemTop < bbox[1] < itemBottom or itemTop < bbox[3] < itemBottom)):
-                            addToFoundItems = False
-                            break
-            if addToFoundItems:
-                self._findBitmapCache[ssFilename][cacheKey].append(
-                    GUIItem("bitmap", bbox, ssFilename, bitmap=bitmap))
-                matchCount += 1
-        eye4graphics.closeImage(e4gIcon)
-        return self._findBitmapCache[ssFilename][cacheKey]
+            yield (int(struct_bbox.left), int(struct_bbox.top),
+                   int(struct_bbox.right), int(struct_bbox.bottom))
+
+    def _incrementalMatches(self, screenshot, bitmap, searchArea, searchArgs):
+        """
+        Returns list of all matches of a bitmap in the search area of
+        the screenshot, or None if matches cannot be updated
+        incrementally with the search parameters.
+
+        Matches are stored for the next screenshot. If the bitmap has
+        been searched for with the same parameters from a previous
+        screenshot of the same size, only rows of tiles that have
+        changed since it, extended by the height of the bitmap, are
+        searched. Matches on other rows are copied from the previous
+        screenshot. Results are the same as from searching the whole
+        area.
+        """
+        (e4gIcon, colorMatch, opacityLimit, xscale, yscale,
+         bitmapPixelSize, screenshotPixelSize, threads, candidates) = searchArgs
+        left, top, right, bottom = searchArea
+        ssSize = screenshot.size()
+        xscale = ctypes.c_float(xscale).value
+        yscale = ctypes.c_float(yscale).value
+        neePixelSize = bitmapPixelSize or (xscale > 1.0 and 2 or 1)
+        hayPixelSize = screenshotPixelSize or int(math.ceil(neePixelSize * xscale))
+        # A match depends only on pixels under it if pixels are
+        # compared one by one and eye4graphics does not skip
+        # coordinates around previous matches. Areas narrower than
+        # the screenshot are not supported as eye4graphics copies
+        # their pixels.
+        if (neePixelSize != 1 or hayPixelSize != 1 or
+            (screenshotPixelSize == 0 and xscale != 1.0) or
+            left > 0 or right < ssSize[0]):
+            return None
+        try:
+            st = os.stat(bitmap)
+        except OSError:
+            return None
+        searchKey = (os.path.abspath(bitmap), st.st_mtime, st.st_size,
+                     colorMatch, opacityLimit, searchArea,
+                     xscale, yscale, bitmapPixelSize, screenshotPixelSize)
+        tileHashes = screenshot._tileHashGrid(_g_tileSize)
+        with self._lock:
+            previous = self._incrementalBase.get(searchKey, None)
+        if previous and previous[0] == ssSize:
+            _, previousTileHashes, previousMatches = previous
+            changedRows = set()
+            columns, rows, hashes = tileHashes
+            previousHashes = previousTileHashes[2]
+            if hashes is not previousHashes:
+                for index in xrange(columns * rows):
+                    if hashes[index] != previousHashes[index]:
+                        changedRows.add(index // columns)
+            # matches with top-left corner on rows firstY...lastY-1
+            # may cover a changed tile
+            iconHeight = _e4gImageDimensions(e4gIcon)[1]
+            margin = int(math.ceil(iconHeight * yscale)) + 1
+            dirtyRows = []
+            for row in sorted(changedRows):
+                firstY = max(top, row * _g_tileSize - margin + 1)
+                lastY = min(bottom, (row + 1) * _g_tileSize)
+                if dirtyRows and firstY <= dirtyRows[-1][1]:
+                    dirtyRows[-1] = (dirtyRows[-1][0], lastY)
+                elif firstY < lastY:
+                    dirtyRows.append((firstY, lastY))
+            def isDirty(y):
+                for firstY, lastY in dirtyRows:
+                    if firstY <= y < lastY:
+                        return True
+                return False
+            matches = [bbox for bbox in previousMatches if not isDirty(bbox[1])]
+            for firstY, lastY in dirtyRows:
+                matches.extend(
+                    bbox for bbox in self._bitmapMatches(
+                        screenshot._filename,
+                        (left, firstY, right, min(bottom, lastY + margin)),
+                        searchArgs)
+                    if firstY <= bbox[1] < lastY)
+            matches.sort(key=lambda bbox: (bbox[1], bbox[0]))
+        else:
+            matches = list(self._bitmapMatches(
+                screenshot._filename, searchArea, searchArgs))
+        with self._lock:
+            self._incrementalBase.pop(searchKey, None)
+            self._incrementalBase[searchKey] = (ssSize, tileHashes, matches)
+            while len(self._incrementalBase) > _g_incrementalSearches:
+                self._incrementalBase.popitem(last=False)
+        return matches
+
+    def _pyramidLevel(self, ssFilename, step):
+        """
+        Returns opened image that contains every step'th pixel of the
+        screenshot, or None if it cannot be created.
+        """
+        with self._lock:
+            levels = self._pyramidLevels.setdefault(ssFilename, {})
+            if not step in levels:
+                levels[step] = eye4graphics.sampleImage(
+                    ctypes.c_void_p(self._openedImages[ssFilename]),
+                    0, 0, step, ctypes.c_float(1.0), ctypes.c_float(1.0), 0)
+            return levels[step]
+
+    def _pyramidCandidates(self, ssFilename, bitmap, e4gIcon, colorMatch,
+                           opacityLimit, xscale, yscale, bitmapPixelSize,
+                           screenshotPixelSize, pyramid):
+        """
+        Returns array of (x, y) coordinates in raster order that
+        include all top-left corners of pixel perfect matches of
+        e4gIcon (opened bitmap), or None if candidates cannot be
+        searched for with the parameters.
+
+        Candidates are found by searching for samples of the scaled
+        bitmap from the samples of the screenshot. As a match can be
+        at any coordinates, the bitmap is sampled starting from
+        every pixel in a step x step square.
+        """
+        xscale = ctypes.c_float(xscale).value
+        yscale = ctypes.c_float(yscale).value
+        neePixelSize = bitmapPixelSize or (xscale > 1.0 and 2 or 1)
+        hayPixelSize = screenshotPixelSize or int(math.ceil(neePixelSize * xscale))
+        if neePixelSize != 1 or hayPixelSize != 1:
+            return None
+        # pixelperfect_match compares all but the last row and column
+        # of the scaled bitmap, make sure they contain samples from
+        # all offsets.
+        iconWidth, iconHeight = _e4gImageDimensions(e4gIcon)
+        comparedSize = min(int(iconWidth * xscale), int(iconHeight * yscale)) - 1
+        step = 2 ** pyramid
+        while step > 1 and comparedSize < 2 * step:
+            step /= 2
+        if step < 2:
+            return None
+        e4gLevel = self._pyramidLevel(ssFilename, step)
+        if not e4gLevel:
+            return None
+        levelWidth, levelHeight = _e4gImageDimensions(e4gLevel)
+        struct_level_bbox = _Bbox(0, 0, levelWidth, levelHeight, 0)
+        struct_bbox = _Bbox(0, 0, 0, 0, 0)
+        samples = self._openBitmapSamples(bitmap, e4gIcon, xscale, yscale, step)
+        if samples == None:
+            return None
+        candidates = []
+        for yOffset in xrange(step):
+            for xOffset in xrange(step):
+                e4gSample = samples[yOffset * step + xOffset]
+                contOpts = 0
+                while eye4graphics.findNextIconThreads(
+                        ctypes.byref(struct_bbox),
+                        ctypes.c_void_p(e4gLevel),
+                        ctypes.c_void_p(e4gSample),
+                        0, # no fuzzy matching
+                        ctypes.c_double(colorMatch),
+                        ctypes.c_double(opacityLimit),
+                        ctypes.byref(struct_level_bbox),
+                        ctypes.c_int(contOpts),
+                        ctypes.c_float(1.0), ctypes.c_float(1.0),
+                        0, 0, 1) == 0:
+                    contOpts = 1
+                    x = struct_bbox.left * step - xOffset
+                    y = struct_bbox.top * step - yOffset
+                    if x >= 0 and y >= 0:
+                        candidates.append((y, x))
+                    if len(candidates) > _g_pyramidMaxCandidates:
+                        # too many candidates to gain anything
+                        return None
+        candidates.sort()
+        coordinates = (ctypes.c_int32 * (2 * len(candidates)))()
+        for index, (y, x) in enumerate(candidates):
+            coordinates[2 * index] = x
+            coordinates[2 * index + 1] = y
+        return coordinates
+
+    def _findBitmaps(self, screenshot, bitmaps, **oirArgs):
+        """
+        Find items on the screenshot that match to bitmaps.
+
+        If only the first match of each bitmap is needed (limit is 1)
+        and there is no preprocessing, all bitmaps are searched for
+        in a single pass over the screenshot.
+        """
+        if (oirArgs["limit"] != 1 or oirArgs["preprocess"] or
+            len(bitmaps) < 2):
+            return OirEngine._findBitmaps(self, screenshot, bitmaps, **oirArgs)
+        ssFilename = screenshot._filename
+        ssSize = screenshot.size()
+        results = [None] * len(bitmaps)
+        searchBitmaps = [] # [(cacheKey, [index, ...], resultCacheKey), ...]
+        searchCacheKeys = {}
+        for index, bitmap in enumerate(bitmaps):
+            cacheKey = (bitmap, oirArgs["colorMatch"], oirArgs["opacityLimit"],
+                        oirArgs["area"], oirArgs["limit"],
+                        oirArgs["allowOverlap"], oirArgs["scale"],
+                        oirArgs["bitmapPixelSize"],
+                        oirArgs["screenshotPixelSize"], oirArgs["preprocess"])
+            if cacheKey in self._findBitmapCache[ssFilename]:
+                results[index] = self._findBitmapCache[ssFilename][cacheKey]
+            elif cacheKey in searchCacheKeys:
+                searchBitmaps[searchCacheKeys[cacheKey]][1].append(index)
+            else:
+                resultCacheKey = self._resultCacheKey(screenshot, bitmap, cacheKey)
+                items = self._cachedResult(resultCacheKey, ssFilename, bitmap)
+                if items != None:
+                    self._findBitmapCache[ssFilename][cacheKey] = items
+                    results[index] = items
+                    continue
+                searchCacheKeys[cacheKey] = len(searchBitmaps)
+                searchBitmaps.append((cacheKey, [index], resultCacheKey))
+        if not searchBitmaps:
+            return results
+
+        iconCount = len(searchBitmaps)
+        e4gIcons = (ctypes.c_void_p * iconCount)()
+        openedBitmaps = []
+        try:
+            for iconIndex, (cacheKey, _, _) in enumerate(searchBitmaps):
+                e4gIcons[iconIndex] = self._openBitmap(cacheKey[0])
+                openedBitmaps.append(cacheKey[0])
+            area = oirArgs["area"]
+            leftTopRightBottomZero = (_intCoords((area[0], area[1]), ssSize) +
+                                      _intCoords((area[2], area[3]), ssSize) +
+                                      (0,))
+            struct_area_bbox = _Bbox(*leftTopRightBottomZero)
+            struct_bboxes = (_Bbox * iconCount)()
+            try:
+                xscale, yscale = oirArgs["scale"]
+            except TypeError:
+                xscale = yscale = float(oirArgs["scale"])
+            eye4graphics.findIcons(
+                struct_bboxes,
+                ctypes.c_void_p(self._openedImages[ssFilename]),
+                e4gIcons,
+                ctypes.c_int(iconCount),
+                ctypes.c_double(oirArgs["colorMatch"]),
+                ctypes.c_double(oirArgs["opacityLimit"]),
+                ctypes.byref(struct_area_bbox),
+                ctypes.c_float(xscale),
+                ctypes.c_float(yscale),
+                ctypes.c_int(oirArgs["bitmapPixelSize"]),
+                ctypes.c_int(oirArgs["screenshotPixelSize"]),
+                ctypes.c_int(oirArgs["threads"]))
+        finally:
+            for bitmap in openedBitmaps:
+                self._releaseBitmap(bitmap)
+        for iconIndex, (cacheKey, indexes, resultCacheKey) in enumerate(searchBitmaps):
+            struct_bbox = struct_bboxes[iconIndex]
+            if struct_bbox.error == -1:
+                items = []
+            else:
+                bbox = (int(struct_bbox.left), int(struct_bbox.top),
+                        int(struct_bbox.right), int(struct_bbox.bottom))
+                items = [GUIItem("bitmap", bbox, ssFilename, bitmap=cacheKey[0])]
+            self._findBitmapCache[ssFilename][cacheKey] = items
+            self._cacheResult(resultCacheKey, items)
+            for index in indexes:
+                results[index] = items
+        return results
 
 def _defaultOirEngine():
     if _g_defaultOirEngine:
@@ -1401,6 +2510,352 @@ class _Paths(object):
                 return None
 
 
+_g_screenshotArchivers = weakref.WeakKeyDictionary()
+
+def _closeScreenshotArchivers():
+    for archiver in _g_screenshotArchivers.keys():
+        archiver.close()
+
+atexit.register(_closeScreenshotArchivers)
+
+class _ScreenshotArchiver(object):
+    """
+    Archives screenshot files in a background thread. Screenshots are
+    queued by archive() and processed in the order they were queued.
+    """
+    def __init__(self, queueSize=_g_screenshotArchiveQueueSize):
+        self._queue = Queue.Queue(queueSize)
+        self._archived = 0
+        self._failed = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _g_screenshotArchivers[self] = None
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job == None:
+                    return
+                filepath, convertArgs = job
+                try:
+                    if convertArgs == None:
+                        os.remove(filepath)
+                    else:
+                        self._convert(filepath, convertArgs)
+                    self._archived += 1
+                except (IOError, OSError), e:
+                    self._failed += 1
+                    _fmbtLog('archiving screenshot "%s" failed: %s' % (filepath, e))
+            finally:
+                self._queue.task_done()
+
+    def _convert(self, filepath, convertArgs):
+        """
+        Convert to a temporary file that replaces filepath when
+        complete, so that filepath is never left half written.
+        """
+        dirname, basename = os.path.split(filepath)
+        tmpFilepath = os.path.join(dirname, ".fmbtarchive." + basename)
+        try:
+            if os.access(tmpFilepath, os.F_OK):
+                os.remove(tmpFilepath) # left over from an earlier run
+            _convert(filepath, convertArgs, tmpFilepath)
+            try:
+                os.rename(tmpFilepath, filepath)
+            except OSError:
+                if not os.access(tmpFilepath, os.R_OK):
+                    raise
+                # rename does not replace existing files on Windows
+                os.remove(filepath)
+                os.rename(tmpFilepath, filepath)
+        finally:
+            if os.access(tmpFilepath, os.F_OK):
+                os.remove(tmpFilepath)
+
+    def archive(self, filepath, convertArgs):
+        """
+        Queue filepath for archiving. If convertArgs is None the file
+        is removed, otherwise it is replaced by the converted
+        file. Blocks if the queue is full.
+        """
+        self._queue.put((filepath, convertArgs))
+
+    def flush(self):
+        """
+        Wait until all queued screenshots have been archived.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Archive queued screenshots and stop the background thread.
+        """
+        if self._thread.isAlive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def stats(self):
+        return {"queued": self._queue.qsize(),
+                "archived": self._archived,
+                "failed": self._failed}
+
+class _PerfStats(object):
+    """
+    Records start times, durations and byte counts of the latest
+    calls of instrumented methods in ring buffers, one buffer per
+    method. Methods are instrumented by replacing them with timing
+    wrappers in object attributes, so that nothing is recorded, and
+    nothing is slowed down, when instrumentation is not installed.
+    Only objects owned by one GUITestInterface are instrumented,
+    calls to shared OIR and OCR engines are recorded by screenshots.
+    """
+    def __init__(self, bufferSize=_g_perfStatsBufferSize):
+        self._bufferSize = bufferSize
+        self._buffers = {}
+        self._patched = [] # [(obj, name, wrapper, instanceAttr, recording), ...]
+        self._lock = threading.Lock()
+
+    def record(self, name, startTime, duration, byteCount=None):
+        try:
+            buf = self._buffers[name]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                buf = self._buffers.setdefault(
+                    name, collections.deque(maxlen=self._bufferSize))
+            finally:
+                self._lock.release()
+        buf.append((startTime, duration, byteCount))
+
+    def call(self, statsName, func, *args, **kwargs):
+        """
+        Call func with args and kwargs, record the call as statsName.
+        """
+        startTime = time.time()
+        rv = func(*args, **kwargs)
+        self.record(statsName, startTime, time.time() - startTime)
+        return rv
+
+    def instrument(self, obj, name, statsName, countBytes=None):
+        """
+        Replace method name of obj with a wrapper that records its
+        calls as statsName. countBytes(returnValue, args) returns the
+        number of bytes transferred in a call.
+        """
+        origMethod = getattr(obj, name)
+        record = self.record
+        recording = [True]
+        def perfStatsWrapper(*args, **kwargs):
+            if not recording[0]:
+                return origMethod(*args, **kwargs)
+            startTime = time.time()
+            rv = origMethod(*args, **kwargs)
+            endTime = time.time()
+            if countBytes:
+                try:
+                    byteCount = countBytes(rv, args)
+                except Exception:
+                    byteCount = None
+            else:
+                byteCount = None
+            record(statsName, startTime, endTime - startTime, byteCount)
+            return rv
+        self._patched.append((obj, name, perfStatsWrapper,
+                              obj.__dict__.get(name, perfStatsWrapper),
+                              recording))
+        setattr(obj, name, perfStatsWrapper)
+
+    def uninstrument(self):
+        """
+        Restore instrumented methods, latest instrumented first.
+        """
+        while self._patched:
+            obj, name, wrapper, instanceAttr, recording = self._patched.pop()
+            if obj.__dict__.get(name, None) != wrapper:
+                # the wrapper has been wrapped, leave it in place
+                # but stop recording
+                recording[0] = False
+                continue
+            if instanceAttr == wrapper:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, instanceAttr)
+
+    def stats(self):
+        rv = {}
+        for name, buf in self._buffers.items():
+            records = list(buf)
+            if not records:
+                continue
+            durations = [r[1] for r in records]
+            byteCounts = [r[2] for r in records if r[2] != None]
+            rv[name] = {"count": len(records),
+                        "time": sum(durations),
+                        "min": min(durations),
+                        "max": max(durations),
+                        "bytes": sum(byteCounts) if byteCounts else None}
+        return rv
+
+    def dump(self, fileObj):
+        fileObj.write("# start time\tname\tduration\tbytes\n")
+        records = []
+        for name, buf in self._buffers.items():
+            records.extend([(r[0], name, r[1], r[2]) for r in list(buf)])
+        records.sort()
+        for startTime, name, duration, byteCount in records:
+            if byteCount == None:
+                byteCount = "-"
+            fileObj.write("%.6f\t%s\t%.6f\t%s\n" % (
+                startTime, name, duration, byteCount))
+
+def _screenshotFileBytes(rv, args):
+    if rv:
+        return os.stat(args[0]).st_size
+    else:
+        return 0
+
+def _screenshotDataBytes(rv, args):
+    if rv:
+        return len(rv[3])
+    else:
+        return 0
+
+# GUITestConnection methods recorded in perfStats, and functions that
+# count bytes transferred in their calls.
+_g_perfStatsConnMethods = (
+    ("sendPress", None),
+    ("sendKeyDown", None),
+    ("sendKeyUp", None),
+    ("sendTap", None),
+    ("sendTouchDown", None),
+    ("sendTouchMove", None),
+    ("sendTouchUp", None),
+    ("sendInputSequence", None),
+    ("sendType", None),
+    ("recvScreenshot", _screenshotFileBytes),
+    ("recvScreenshotData", _screenshotDataBytes))
+
+class _ScreenshotPrefetcher(object):
+    """
+    Captures screenshots in a background thread and keeps the latest
+    of them until it is taken with frame(). A frame that is not taken
+    before the next one is captured is dropped. A new capture starts
+    pollDelay seconds after the previous one started, or immediately
+    when frame() is waiting for a new frame.
+    """
+    def __init__(self, newFilepath, recvScreenshot, pollDelay):
+        self._newFilepath = newFilepath
+        self._recvScreenshot = recvScreenshot
+        self._pollDelay = pollDelay
+        self._cond = threading.Condition()
+        self._frame = None # (captureStartTime, filepath, data)
+        self._error = None # (captureStartTime, exc_info)
+        self._waiting = 0 # number of frame() calls waiting for a frame
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        nextCaptureTime = 0
+        while True:
+            self._cond.acquire()
+            try:
+                while (not self._stopped and not self._waiting and
+                       time.time() < nextCaptureTime):
+                    self._cond.wait(nextCaptureTime - time.time())
+                if self._stopped:
+                    return
+            finally:
+                self._cond.release()
+            captureStartTime = time.time()
+            nextCaptureTime = captureStartTime + self._pollDelay
+            filepath = self._newFilepath()
+            try:
+                data = self._recvScreenshot(filepath)
+                error = None
+            except Exception:
+                error = sys.exc_info()
+            self._cond.acquire()
+            try:
+                if error:
+                    # the error is raised by frame() only once,
+                    # capturing continues
+                    self._error = (captureStartTime, error)
+                else:
+                    self._dropFrame()
+                    self._frame = (captureStartTime, filepath, data)
+                    self._error = None
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def _dropFrame(self):
+        if self._frame != None:
+            _, filepath, data = self._frame
+            if data == None:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+            self._frame = None
+
+    def frame(self, newerThan=None, timeout=None):
+        """
+        Returns pair (filepath, data) of a frame whose capturing
+        started at or after newerThan, or the latest captured frame
+        if newerThan is None. Waits for the frame if necessary, but
+        at most timeout seconds (None: no limit). data is raw
+        screenshot data, None if the screenshot is saved to filepath,
+        or False if capturing the screenshot failed or timed out.
+        Raises the exception of a failed capture that started at or
+        after newerThan.
+        """
+        if timeout != None:
+            endTime = time.time() + timeout
+        self._cond.acquire()
+        try:
+            while True:
+                if self._frame != None and (
+                        newerThan == None or self._frame[0] >= newerThan):
+                    _, filepath, data = self._frame
+                    self._frame = None
+                    return filepath, data
+                if self._error != None:
+                    captureStartTime, exc_info = self._error
+                    self._error = None
+                    if newerThan == None or captureStartTime >= newerThan:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                waitTime = None
+                if timeout != None:
+                    waitTime = endTime - time.time()
+                    if waitTime <= 0:
+                        return None, False
+                self._waiting += 1
+                try:
+                    self._cond.notifyAll()
+                    self._cond.wait(waitTime)
+                finally:
+                    self._waiting -= 1
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """
+        Stops capturing, waits for the ongoing capture to finish and
+        drops the frame that has not been taken.
+        """
+        self._cond.acquire()
+        try:
+            self._stopped = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._thread.join()
+        self._dropFrame()
+
 class GUITestInterface(object):
     def __init__(self, ocrEngine=None, oirEngine=None, rotateScreenshot=None):
         self._paths = _Paths("", "")
@@ -1414,6 +2869,11 @@ class GUITestInterface(object):
         self._screenshotLimit = None
         self._screenshotRefCount = {} # filename -> Screenshot object ref count
         self._screenshotArchiveMethod = "resize"
+        self._screenshotArchiver = None
+        self._screenshotPrefetcher = None
+        self._screenshotPrefetchTimeout = None
+        self._waitStats = None
+        self._perfStats = None
 
         if ocrEngine == None:
             self.setOcrEngine(_defaultOcrEngine())
@@ -1456,6 +2916,12 @@ class GUITestInterface(object):
 
     def close(self):
         self._lastScreenshot = None
+        self.setScreenshotPrefetch(False)
+        if self._perfStats:
+            self._perfStats.uninstrument()
+        if self._screenshotArchiver:
+            self._screenshotArchiver.close()
+            self._screenshotArchiver = None
         if self._visualLog:
             if (hasattr(self._visualLog._outFileObj, "name") and
                 self._visualLog._outFileObj.name in self._visualLogFilenames):
@@ -1507,6 +2973,10 @@ class GUITestInterface(object):
           button (integer, optional):
                   send drag using given mouse button. The default is None.
 
+        The drag is sent as one input sequence, see
+        GUITestConnection.sendInputSequence. Delays are handled on
+        the device if the connection supports it.
+
         Returns True on success, False if sending input failed.
         """
         x1, y1 = self.intCoords((x1, y1))
@@ -1516,29 +2986,36 @@ class GUITestInterface(object):
         if button != _USE_DEFAULTS:
             extraArgs["button"] = button
 
+        events = []
+        tOffset = 0.0
         if delayBeforeMoves >= 0:
-            if not self.existingConnection().sendTouchDown(x1, y1, **extraArgs):
-                return False
+            events.append(("down", x1, y1, tOffset))
         if delayBeforeMoves > 0:
-            time.sleep(delayBeforeMoves)
+            tOffset += delayBeforeMoves
         else:
-            time.sleep(delayBetweenMoves)
+            tOffset += delayBetweenMoves
         for i in xrange(0, movePoints):
             nx = x1 + int(round(((x2 - x1) / float(movePoints+1)) * (i+1)))
             ny = y1 + int(round(((y2 - y1) / float(movePoints+1)) * (i+1)))
-            if not self.existingConnection().sendTouchMove(nx, ny, **extraArgs):
-                return False
-            time.sleep(delayBetweenMoves)
+            events.append(("move", nx, ny, tOffset))
+            tOffset += delayBetweenMoves
         if delayAfterMoves > 0:
-            self.existingConnection().sendTouchMove(x2, y2, **extraArgs)
-            time.sleep(delayAfterMoves)
+            events.append(("move", x2, y2, tOffset))
+            tOffset += delayAfterMoves
         if delayAfterMoves >= 0:
-            if self.existingConnection().sendTouchUp(x2, y2, **extraArgs):
-                return True
-            else:
-                return False
-        else:
+            events.append(("up", x2, y2, tOffset))
+        if not events:
             return True
+        return self._sendInputSequence(events, **extraArgs)
+
+    def _sendInputSequence(self, events, **kwargs):
+        conn = self.existingConnection()
+        if hasattr(conn, "sendInputSequence"):
+            return conn.sendInputSequence(events, **kwargs)
+        # Connections that are not GUITestConnections may lack
+        # sendInputSequence, send events one by one.
+        return GUITestConnection.sendInputSequence.im_func(
+            conn, events, **kwargs)
 
     def enableVisualLog(self, filenameOrObj,
                         screenshotWidth="240", thumbnailWidth="",
@@ -1554,7 +3031,8 @@ class GUITestInterface(object):
                   split into multiple html files by using strftime
                   conversion specifications in filenameOrObj. For
                   instance, "%a-%H.html" will log to "Thu-16.html" on
-                  Thurday from 4 pm to 5 pm.
+                  Thurday from 4 pm to 5 pm. If the filename ends
+                  with ".gz", the log is gzip compressed.
 
           screenshotWidth (string, optional)
                   Width of screenshot images in HTML.
@@ -1583,7 +3061,7 @@ class GUITestInterface(object):
         """
         if type(filenameOrObj) == str:
             try:
-                outFileObj = file(filenameOrObj, "w")
+                outFileObj = _openVisualLogFile(filenameOrObj)
                 self._visualLogFileObj = outFileObj
             except Exception, e:
                 _fmbtLog('Failed to open file "%s" for logging.' % (filenameOrObj,))
@@ -1643,12 +3121,52 @@ class GUITestInterface(object):
         maxX, maxY = self.screenSize()
         return _boxOnRegion(guiItem.bbox(), (0, 0, maxX, maxY))
 
-    def ocrEngine(self):
+    def ocrEngine(self):
+        """
+        Returns the OCR engine that is used by default for new
+        screenshots.
+        """
+        return self._ocrEngine
+
+    def perfStats(self):
+        """
+        Returns statistics on the latest calls of instrumented
+        methods, or None if instrumentation is disabled. The statistics
+        is a dictionary that maps method names to dictionaries with
+        keys "count" (number of calls), "time", "min" and "max"
+        (total, minimum and maximum duration in seconds) and "bytes"
+        (total number of bytes in screenshots, None if not
+        applicable).
+
+        See also setPerfStats() and dumpPerfStats().
+        """
+        if self._perfStats:
+            return self._perfStats.stats()
+        else:
+            return None
+
+    def dumpPerfStats(self, filenameOrObj):
         """
-        Returns the OCR engine that is used by default for new
-        screenshots.
+        Writes every recorded call of instrumented methods to a file,
+        one call per line in the order of start times. Lines contain
+        tab-separated start time, method name, duration and number of
+        bytes ("-" if not applicable).
+
+        Parameters:
+
+          filenameOrObj (string or file object):
+                  file to write to.
         """
-        return self._ocrEngine
+        if not self._perfStats:
+            raise ValueError("perfStats not enabled")
+        if isinstance(filenameOrObj, basestring):
+            fileObj = file(filenameOrObj, "w")
+            try:
+                self._perfStats.dump(fileObj)
+            finally:
+                fileObj.close()
+        else:
+            self._perfStats.dump(filenameOrObj)
 
     def oirEngine(self):
         """
@@ -1720,11 +3238,12 @@ class GUITestInterface(object):
         return filepath
 
     def _archiveScreenshot(self, filepath):
+        if not os.access(filepath, os.F_OK):
+            # Screenshots received as data are written to files only
+            # when needed.
+            return
         if self._screenshotArchiveMethod == "remove":
-            try:
-                os.remove(filepath)
-            except IOError:
-                pass
+            convertArgs = None
         elif self._screenshotArchiveMethod.startswith("resize"):
             if self._screenshotArchiveMethod == "resize":
                 convertArgs = ["-resize",
@@ -1732,7 +3251,11 @@ class GUITestInterface(object):
             else:
                 widthHeight = self._screenshotArchiveMethod.split()[1]
                 convertArgs = ["-resize", widthHeight]
-            subprocess.call([fmbt_config.imagemagick_convert, filepath] + convertArgs + [filepath])
+        else:
+            return
+        if self._screenshotArchiver == None:
+            self._screenshotArchiver = _ScreenshotArchiver()
+        self._screenshotArchiver.archive(filepath, convertArgs)
 
     def _archiveScreenshots(self):
         """
@@ -1753,7 +3276,22 @@ class GUITestInterface(object):
                 del self._screenshotRefCount[toBeArchived]
                 archiveCount -= 1
 
-    def refreshScreenshot(self, forcedScreenshot=None, rotate=None):
+    def _recvScreenshot(self, screenshotFile):
+        """
+        Receives screenshot from the connection. Returns raw
+        screenshot data, None if the screenshot was saved to
+        screenshotFile, or False if the screenshot cannot be taken.
+        """
+        conn = self.existingConnection()
+        if hasattr(conn, "recvScreenshotData"):
+            screenshotData = conn.recvScreenshotData()
+        else:
+            screenshotData = None
+        if screenshotData == None and not conn.recvScreenshot(screenshotFile):
+            screenshotData = False
+        return screenshotData
+
+    def refreshScreenshot(self, forcedScreenshot=None, rotate=None, newerThan=None):
         """
         Takes new screenshot and updates the latest screenshot object.
 
@@ -1768,6 +3306,14 @@ class GUITestInterface(object):
                   overrides constructor rotateScreenshot parameter
                   value. The default is None (no override).
 
+          newerThan (float, optional):
+                  if screenshot prefetch is enabled, return a
+                  screenshot whose capturing started at or after
+                  this time (seconds since the epoch). Use this to
+                  see the effect of an input event. The default is
+                  None, that is, the latest prefetched screenshot is
+                  returned. See setScreenshotPrefetch().
+
         Returns Screenshot object, and makes the same object "the
         latest screenshot" that is used by all *Bitmap and *OcrText
         methods. Returns None if screenshot cannot be taken.
@@ -1787,48 +3333,63 @@ class GUITestInterface(object):
                 self.setScreenshotDir(self._screenshotDirDefault)
             if self.screenshotSubdir() == None:
                 self.setScreenshotSubdir(self._screenshotSubdirDefault)
-            screenshotFile = self._newScreenshotFilepath()
-            if self.existingConnection().recvScreenshot(screenshotFile):
-                # New screenshot successfully received from device
-                if rotate == None:
-                    rotate = self._rotateScreenshot
+            if rotate == None:
+                rotate = self._rotateScreenshot
+            if self._screenshotPrefetcher:
+                screenshotFile, screenshotData = self._screenshotPrefetcher.frame(
+                    newerThan, self._screenshotPrefetchTimeout)
+            else:
+                screenshotFile = self._newScreenshotFilepath()
+                screenshotData = self._recvScreenshot(screenshotFile)
+            if screenshotData == False:
+                self._lastScreenshot = None
+            elif screenshotData != None:
+                # New screenshot received from device without a file.
+                # Screenshot file is written only if needed.
+                e4gImage = _e4gOpenBlob(*screenshotData)
                 if rotate != None and rotate != 0:
+                    rotatedImage = _e4gConvert(e4gImage, ["-rotate", str(rotate)])
+                else:
+                    rotatedImage = e4gImage
+                if rotatedImage:
+                    if rotatedImage != e4gImage:
+                        eye4graphics.closeImage(e4gImage)
+                        e4gImage = rotatedImage
+                else:
+                    # Rotating in memory failed, fall back to convert.
+                    try:
+                        if eye4graphics.writeImage(e4gImage, screenshotFile) != 0:
+                            raise IOError('Cannot write image "%s"' % (screenshotFile,))
+                    finally:
+                        eye4graphics.closeImage(e4gImage)
                     subprocess.call([fmbt_config.imagemagick_convert, screenshotFile, "-rotate", str(rotate), screenshotFile])
+                    e4gImage = None
                 self._lastScreenshot = Screenshot(
                     screenshotFile=screenshotFile,
                     paths = self._paths,
                     ocrEngine=self._ocrEngine,
                     oirEngine=self._oirEngine,
-                    screenshotRefCount=self._screenshotRefCount)
+                    screenshotRefCount=self._screenshotRefCount,
+                    e4gImage=e4gImage)
             else:
-                self._lastScreenshot = None
+                # New screenshot successfully received from device
+                if rotate != None and rotate != 0:
+                    _convert(screenshotFile, ["-rotate", str(rotate)], screenshotFile)
+                self._lastScreenshot = Screenshot(
+                    screenshotFile=screenshotFile,
+                    paths = self._paths,
+                    ocrEngine=self._ocrEngine,
+                    oirEngine=self._oirEngine,
+                    screenshotRefCount=self._screenshotRefCount)
         else: # No connection, cannot get a screenshot
             self._lastScreenshot = None
-        # Make sure unreachable Screenshot instances are released from
-        # memory.
-        gc.collect()
-        for obj in gc.garbage:
-            if isinstance(obj, Screenshot):
-                if hasattr(obj, "_logCallReturnValue"):
-                    # Some methods have been wrapped by visual
-                    # log. Break reference cycles to let gc collect
-                    # them.
-                    try:
-                        del obj.findItemsByBitmap
-                    except:
-                        pass
-                    try:
-                        del obj.findItemsByOcr
-                    except:
-                        pass
-        del gc.garbage[:]
-        gc.collect()
-
         # If screenshotLimit has been set, archive old screenshot
         # stored on the disk.
         if self._screenshotLimit != None and self._screenshotLimit >= 0:
             self._archiveScreenshots()
 
+        if self._perfStats and self._lastScreenshot:
+            self._lastScreenshot._perfStats = self._perfStats
         return self._lastScreenshot
 
     def screenshot(self):
@@ -1845,6 +3406,17 @@ class GUITestInterface(object):
         """
         return self._screenshotArchiveMethod
 
+    def screenshotArchiveStats(self):
+        """
+        Returns statistics on archiving screenshots in the background
+        as a dictionary with keys "queued" (number of screenshots
+        waiting for archiving), "archived" and "failed".
+        """
+        if self._screenshotArchiver:
+            return self._screenshotArchiver.stats()
+        else:
+            return {"queued": 0, "archived": 0, "failed": 0}
+
     def screenshotDir(self):
         """
         Returns the directory under which new screenshots are saved.
@@ -1857,6 +3429,13 @@ class GUITestInterface(object):
         """
         return self._screenshotLimit
 
+    def screenshotPrefetch(self):
+        """
+        Returns True if screenshots are prefetched in the background,
+        otherwise False.
+        """
+        return self._screenshotPrefetcher != None
+
     def screenshotSubdir(self):
         """
         Returns the subdirectory in screenshotDir under which new
@@ -1921,6 +3500,8 @@ class GUITestInterface(object):
                   The connection to be used.
         """
         self._conn = conn
+        if self._perfStats:
+            self._instrumentPerfStats()
 
     def setOcrEngine(self, ocrEngine):
         """
@@ -1944,6 +3525,49 @@ class GUITestInterface(object):
         self._oirEngine = oirEngine
         return prevDefault
 
+    def setPerfStats(self, enabled, bufferSize=_g_perfStatsBufferSize):
+        """
+        Enable or disable recording durations of time-critical calls.
+
+        Parameters:
+
+          enabled (boolean):
+                  If True, calls of refreshScreenshot, connection's
+                  send* and recvScreenshot* methods, and every poll
+                  in wait are recorded. The latest screenshot and
+                  screenshots refreshed after it record their calls
+                  of OIR engine's findBitmap(s) and OCR engine's
+                  findText. If False,
+                  recording is stopped and recorded calls are
+                  discarded. The default is False.
+
+          bufferSize (integer, optional):
+                  number of latest calls recorded for each method.
+                  The default is 1024.
+
+        Instrumentation has no cost when it is disabled.
+
+        See also perfStats() and dumpPerfStats().
+        """
+        if self._perfStats:
+            self._perfStats.uninstrument()
+            self._perfStats = None
+        if enabled:
+            self._perfStats = _PerfStats(bufferSize)
+            self._instrumentPerfStats()
+        if self._lastScreenshot:
+            self._lastScreenshot._perfStats = self._perfStats
+
+    def _instrumentPerfStats(self):
+        perfStats = self._perfStats
+        perfStats.uninstrument()
+        perfStats.instrument(self, "refreshScreenshot", "refreshScreenshot")
+        if self._conn:
+            for name, countBytes in _g_perfStatsConnMethods:
+                if callable(getattr(self._conn, name, None)):
+                    perfStats.instrument(self._conn, name,
+                                         "conn." + name, countBytes)
+
     def setScreenshotArchiveMethod(self, screenshotArchiveMethod):
         """
         Set method for archiving screenshots when screenshotLimit is exceeded.
@@ -1989,11 +3613,75 @@ class GUITestInterface(object):
                   The default is None, that is, there is no limit and
                   screenshots are never archived.
 
+        Screenshots are archived in a background thread. close()
+        waits until all of them have been archived.
+
         See also:
           setScreenshotArchiveMethod()
         """
         self._screenshotLimit = screenshotLimit
 
+    def setScreenshotPrefetch(self, prefetch, pollDelay=0.5, timeout=60.0):
+        """
+        Enable or disable prefetching screenshots in the background.
+
+        Parameters:
+          prefetch (boolean)
+                  If True, a background thread keeps capturing
+                  screenshots from the connection, and
+                  refreshScreenshot() returns the latest captured
+                  screenshot without waiting for a new capture. Each
+                  captured screenshot is returned only once. The
+                  default is False.
+
+          pollDelay (float, optional):
+                  seconds from the start of a capture to the start
+                  of the next one. If refreshScreenshot() is waiting
+                  for a screenshot, capturing starts immediately.
+                  The default is 0.5.
+
+          timeout (float, optional):
+                  seconds refreshScreenshot() waits for a prefetched
+                  screenshot before it returns None. None waits
+                  forever. The default is 60.0.
+
+        If capturing a screenshot raises an exception, the next
+        refreshScreenshot() raises it, and capturing continues.
+
+        Notice that a prefetched screenshot may have been captured
+        before the latest input event. Use refreshScreenshot
+        parameter newerThan to wait for a screenshot captured after
+        it.
+
+        Prefetching requires a connection that can capture
+        screenshots while input events are being sent, see
+        GUITestConnection.canRecvScreenshotConcurrently(). Enabling
+        it on other connections raises ConnectionError.
+
+        Example:
+          sut.setScreenshotPrefetch(True)
+          t = time.time()
+          sut.tap((100, 200))
+          sut.refreshScreenshot(newerThan=t)
+        """
+        if self._screenshotPrefetcher:
+            self._screenshotPrefetcher.close()
+            self._screenshotPrefetcher = None
+        if prefetch:
+            conn = self.existingConnection()
+            if not (hasattr(conn, "canRecvScreenshotConcurrently") and
+                    conn.canRecvScreenshotConcurrently()):
+                raise ConnectionError(
+                    "connection cannot capture screenshots while "
+                    "sending input events, prefetching not supported")
+            if self.screenshotDir() == None:
+                self.setScreenshotDir(self._screenshotDirDefault)
+            if self.screenshotSubdir() == None:
+                self.setScreenshotSubdir(self._screenshotSubdirDefault)
+            self._screenshotPrefetchTimeout = timeout
+            self._screenshotPrefetcher = _ScreenshotPrefetcher(
+                self._newScreenshotFilepath, self._recvScreenshot, pollDelay)
+
     def setScreenshotSubdir(self, screenshotSubdir):
         """
         Define a subdirectory under screenshotDir() for screenshot files.
@@ -2270,11 +3958,9 @@ class GUITestInterface(object):
             self.existingConnection().sendTouchMove(x, y)
         while count > 0:
             if hold > 0.0:
-                try:
-                    assert self.existingConnection().sendTouchDown(x, y, **extraParams)
-                    time.sleep(hold)
-                    assert self.existingConnection().sendTouchUp(x, y, **extraParams)
-                except AssertionError:
+                if not self._sendInputSequence(
+                        [("down", x, y, 0.0), ("up", x, y, hold)],
+                        **extraParams):
                     return False
             else:
                 if not self.existingConnection().sendTap(x, y, **extraParams):
@@ -2450,7 +4136,8 @@ class GUITestInterface(object):
 
     def wait(self, refreshFunc, waitFunc, waitFuncArgs=(), waitFuncKwargs={},
              waitTime = 5.0, pollDelay = 1.0,
-             beforeRefresh = lambda: None, afterRefresh = lambda: None):
+             beforeRefresh = lambda: None, afterRefresh = lambda: None,
+             minPollDelay = None):
         """
         Wait until waitFunc returns True or waitTime has expired.
 
@@ -2481,28 +4168,80 @@ class GUITestInterface(object):
                   this function will be called after every refreshFunc call.
                   The default is no operation.
 
+          minPollDelay (float, optional):
+                  if given, polling is adaptive. The first refresh
+                  is done after minPollDelay, and the delay is
+                  doubled after every refresh up to pollDelay. If
+                  refreshFunc is refreshScreenshot, the delay is
+                  reset to minPollDelay whenever the screen changes,
+                  and waitFunc is not called again if the screen has
+                  not changed. The default is None, that is, sleep
+                  pollDelay between every refresh.
+
         Returns True if waitFunc returns True - either immediately or
         before waitTime has expired - otherwise False.
 
         refreshFunc will not be called if waitFunc returns immediately
         True.
+
+        See also waitStats().
         """
+        startTime = time.time()
+        stats = {"polls": 0, "evaluations": 1, "time": 0.0}
+        self._waitStats = stats
         if waitFunc(*waitFuncArgs, **waitFuncKwargs):
+            stats["time"] = time.time() - startTime
             return True
-        startTime = time.time()
         endTime = startTime + waitTime
         now = startTime
+        if minPollDelay == None:
+            delay = pollDelay
+        else:
+            delay = min(minPollDelay, pollDelay)
+        trackScreen = (minPollDelay != None and
+                       refreshFunc == self.refreshScreenshot)
         while now < endTime:
-            time.sleep(min(pollDelay, (endTime - now)))
-            now = time.time()
+            time.sleep(min(delay, (endTime - now)))
+            pollStartTime = time.time()
+            previousScreenshot = self._lastScreenshot
             beforeRefresh()
             refreshFunc()
             afterRefresh()
-            if waitFunc(*waitFuncArgs, **waitFuncKwargs):
+            stats["polls"] += 1
+            changed = (not trackScreen or
+                       previousScreenshot == None or
+                       self._lastScreenshot == None or
+                       self._lastScreenshot.changedRegions(previousScreenshot) != [])
+            if changed:
+                stats["evaluations"] += 1
+                found = waitFunc(*waitFuncArgs, **waitFuncKwargs)
+            else:
+                found = False
+            if self._perfStats:
+                self._perfStats.record("wait.poll", pollStartTime,
+                                       time.time() - pollStartTime)
+            if found:
+                stats["time"] = time.time() - startTime
                 return True
+            if minPollDelay != None:
+                if trackScreen and changed:
+                    delay = minPollDelay
+                else:
+                    delay = min(delay * 2, pollDelay)
+            now = time.time()
+        stats["time"] = now - startTime
         return False
 
-    def waitAny(self, listOfFuncs, waitTime=5.0, pollDelay=1.0):
+    def waitStats(self):
+        """
+        Returns statistics on the latest wait as a dictionary with keys
+        "polls" (number of refreshes), "evaluations" (number of
+        waitFunc calls) and "time" (seconds spent waiting). Returns
+        None if nothing has been waited for.
+        """
+        return self._waitStats
+
+    def waitAny(self, listOfFuncs, waitTime=5.0, pollDelay=1.0, concurrent=False):
         """
         Wait until any function returns True (or equivalent)
 
@@ -2521,13 +4260,30 @@ class GUITestInterface(object):
                   functions again, if no function returned True.
                   The default is 1.0.
 
+          concurrent (boolean, optional):
+                  if True, every function is called in its own
+                  thread. A function is called again pollDelay
+                  after its previous call returned False. When any
+                  function returns True, no more calls are started,
+                  and waitAny waits for calls that are still running
+                  to finish, but not longer than until waitTime has
+                  passed. Calls still running after that are left
+                  running in the background. Their return values
+                  are ignored. The functions must be thread-safe:
+                  connections that send and receive through one
+                  channel, like Windows, Tizen and X11 connections,
+                  must not be used by more than one of them. The
+                  default is False.
+
         Returns tuple [(function index, function, return value), ...]
         of functions in the list that returned True or equivalent.
         Returns empty list in case of timeout.
-        Exceptions raised by functions are not catched.
+        Exceptions raised by functions are not catched. With
+        concurrent=True the first exception is raised from waitAny.
 
         Example: run an async cmd on Windows, wait for it to finish
-          or dialog X or Y to appear:
+          or dialog X or Y to appear (all functions use the same
+          connection, so they are not called concurrently):
 
           sut.shellSOE(cmd, asyncStatus="c:/temp/cmd.async.status")
           detected = sut.waitAny(
@@ -2547,6 +4303,8 @@ class GUITestInterface(object):
             endTime = float("inf")
         else:
             endTime = startTime + waitTime
+        if concurrent:
+            return self._waitAnyConcurrent(listOfFuncs, endTime, pollDelay)
         now = startTime
         rv = []
         while now <= endTime and not rv:
@@ -2558,6 +4316,67 @@ class GUITestInterface(object):
             now = time.time()
         return rv
 
+    def _waitAnyConcurrent(self, listOfFuncs, endTime, pollDelay):
+        funcs = list(listOfFuncs)
+        cond = threading.Condition()
+        stop = threading.Event()
+        rv = []
+        excInfo = []
+        callCounts = [0] * len(funcs)
+        def poll(index, func):
+            while not stop.isSet():
+                try:
+                    retval = func()
+                except Exception:
+                    cond.acquire()
+                    try:
+                        excInfo.append(sys.exc_info())
+                        cond.notifyAll()
+                    finally:
+                        cond.release()
+                    return
+                cond.acquire()
+                try:
+                    callCounts[index] += 1
+                    if retval and not stop.isSet():
+                        rv.append((index, func, retval))
+                    cond.notifyAll()
+                finally:
+                    cond.release()
+                if retval:
+                    return
+                stop.wait(pollDelay)
+        threads = [threading.Thread(target=poll, args=(index, func))
+                   for index, func in enumerate(funcs)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        cond.acquire()
+        try:
+            # Like in sequential waitAny, every function is called at
+            # least once even if waitTime has already expired.
+            while not rv and not excInfo:
+                now = time.time()
+                if now > endTime and 0 not in callCounts:
+                    break
+                if now > endTime:
+                    cond.wait(1.0)
+                else:
+                    cond.wait(min(1.0, endTime - now))
+        finally:
+            stop.set()
+            cond.release()
+            # functions may use the device, let running calls finish
+            # but do not wait for them after waitTime has passed
+            for t in threads:
+                if endTime == float("inf"):
+                    t.join()
+                else:
+                    t.join(max(0, endTime - time.time()))
+        if excInfo and not rv:
+            raise excInfo[0][0], excInfo[0][1], excInfo[0][2]
+        return sorted(rv, key=lambda r: r[0])
+
     def waitAnyBitmap(self, listOfBitmaps, **waitAndOirArgs):
         """
         Wait until any of given bitmaps appears on screen.
@@ -2570,7 +4389,7 @@ class GUITestInterface(object):
           optical image recognition arguments (optional)
                   refer to help(obj.oirEngine()).
 
-          waitTime, pollDelay, beforeRefresh, afterRefresh (optional):
+          waitTime, pollDelay, minPollDelay, beforeRefresh, afterRefresh (optional):
                   refer to wait documentation.
 
         Returns list of bitmaps appearing in the first screenshot that
@@ -2586,8 +4405,10 @@ class GUITestInterface(object):
         oirArgs, _ = _takeOirArgs(self._lastScreenshot, rest, thatsAll=True)
         foundBitmaps = []
         def observe():
-            for bitmap in listOfBitmaps:
-                if self._lastScreenshot.findItemsByBitmap(bitmap, **oirArgs):
+            foundItems = self._lastScreenshot.findItemsByBitmaps(
+                listOfBitmaps, **oirArgs)
+            for bitmap, items in zip(listOfBitmaps, foundItems):
+                if items:
                     foundBitmaps.append(bitmap)
             return foundBitmaps != []
         self.wait(self.refreshScreenshot, observe, **waitArgs)
@@ -2602,7 +4423,7 @@ class GUITestInterface(object):
           listOfTexts (list of string):
                   texts to be waited for.
 
-          waitTime, pollDelay, beforeRefresh, afterRefresh (optional):
+          waitTime, pollDelay, minPollDelay, beforeRefresh, afterRefresh (optional):
                   refer to wait documentation.
 
           OCR engine specific arguments
@@ -2640,7 +4461,7 @@ class GUITestInterface(object):
           optical image recognition arguments (optional)
                   refer to help(obj.oirEngine()).
 
-          waitTime, pollDelay, beforeRefresh, afterRefresh (optional):
+          waitTime, pollDelay, minPollDelay, beforeRefresh, afterRefresh (optional):
                   refer to wait documentation.
 
         Returns True if bitmap appeared within given time limit,
@@ -2660,7 +4481,7 @@ class GUITestInterface(object):
           text (string):
                   text to be waited for.
 
-          waitTime, pollDelay, beforeRefresh, afterRefresh (optional):
+          waitTime, pollDelay, minPollDelay, beforeRefresh, afterRefresh (optional):
                   refer to wait documentation.
 
           OCR engine specific arguments
@@ -2680,7 +4501,7 @@ class GUITestInterface(object):
 
         Parameters:
 
-          waitTime, pollDelay, beforeRefresh, afterRefresh (optional):
+          waitTime, pollDelay, minPollDelay, beforeRefresh, afterRefresh (optional):
                   refer to wait documentation.
 
         Returns True if screenshot was updated before waitTime expired,
@@ -2707,9 +4528,11 @@ class GUITestInterface(object):
             beforeRefresh()
             self.refreshScreenshot()
             afterRefresh()
+            # compare tile hashes instead of searching the previous
+            # screenshot from the new one
             return self.wait(
                 self.refreshScreenshot,
-                lambda: not self.verifyBitmap(previousScreenshot.filename()),
+                lambda: self.screenshot().changedRegions(previousScreenshot) != [],
                 **waitArgs)
         elif updated == True:
             self.refreshScreenshot()
@@ -2725,8 +4548,19 @@ class Screenshot(object):
     display, or a forced bitmap file if device connection is not given.
     """
     def __init__(self, screenshotFile=None, paths=None,
-                 ocrEngine=None, oirEngine=None, screenshotRefCount=None):
+                 ocrEngine=None, oirEngine=None, screenshotRefCount=None,
+                 e4gImage=None):
         self._filename = screenshotFile
+        # If e4gImage is given, the screenshot owns the opened image
+        # and screenshotFile is written only when filename() is
+        # called. The image is closed when the screenshot and pixel
+        # arrays that share it have been released.
+        self._e4gImage = e4gImage
+        if e4gImage:
+            self._e4gImageOwner = _OpenedE4gImage(e4gImage)
+        else:
+            self._e4gImageOwner = None
+        self._fileWritten = (e4gImage == None)
         self._ocrEngine = ocrEngine
         self._ocrEngineNotified = False
         self._oirEngine = oirEngine
@@ -2736,23 +4570,184 @@ class Screenshot(object):
             self._screenshotRefCount[self._filename] = (1 +
                 self._screenshotRefCount.get(self._filename, 0))
         self._screenSize = None
+        if e4gImage != None:
+            self._screenSize = _e4gImageDimensions(e4gImage)
         self._paths = paths
+        self._tileHashes = {} # tileSize -> (columns, rows, hashes)
+        self._digest = None
+        self._perfStats = None # set by GUITestInterface.refreshScreenshot
 
     def __del__(self):
+        self.release()
+
+    def release(self):
+        """
+        Releases resources reserved for the screenshot by OCR and OIR
+        engines, and lets the screenshot file be archived. This is
+        done automatically when the Screenshot object is deleted.
+        The screenshot must not be used after release().
+        """
         if self._ocrEngine and self._ocrEngineNotified:
             self._ocrEngine.removeScreenshot(self)
         if self._oirEngine and self._oirEngineNotified:
             if (self._ocrEngineNotified == False or
                 id(self._oirEngine) != id(self._ocrEngine)):
                 self._oirEngine.removeScreenshot(self)
+        self._ocrEngineNotified = False
+        self._oirEngineNotified = False
         if (type(self._screenshotRefCount) == dict and self._filename):
             self._screenshotRefCount[self._filename] -= 1
+            self._screenshotRefCount = None
+        self._e4gImage = None
+        self._e4gImageOwner = None
+
+    def _openedE4gImage(self, openFile=True):
+        """
+        Returns pair (e4gImage, mustClose). mustClose is True if the
+        image was opened for the caller only. If openFile is False
+        and the image is not open already, returns (None, False).
+        """
+        if self._e4gImage:
+            return self._e4gImage, False
+        elif self._filename in getattr(self._oirEngine, "_openedImages", {}):
+            # reuse already opened image
+            return self._oirEngine._openedImages[self._filename], False
+        elif openFile:
+            return _e4gOpenImage(self._filename), True
+        else:
+            return None, False
+
+    def _writeFile(self):
+        if eye4graphics.writeImage(self._e4gImage, self._filename) != 0:
+            raise IOError('Cannot write screenshot "%s"' % (self._filename,))
+        self._fileWritten = True
+
+    def _convertedE4gImage(self, convertArgs):
+        """
+        Returns new opened image converted from this screenshot with
+        convert options, or None if options are not supported by
+        eye4graphics.
+        """
+        image, mustClose = self._openedE4gImage()
+        try:
+            return _e4gConvert(image, convertArgs)
+        finally:
+            if mustClose:
+                eye4graphics.closeImage(image)
+
+    def _convert(self, convertArgs, resultFilename):
+        """
+        Returns new screenshot converted from this screenshot with
+        convert options. Conversion is done in-process if possible,
+        otherwise with ImageMagick convert.
+        """
+        e4gImage = self._convertedE4gImage(convertArgs)
+        if e4gImage == None:
+            _convert(self.filename(), convertArgs, resultFilename)
+        return Screenshot(resultFilename, self._paths, self._ocrEngine,
+                          self._oirEngine, self._screenshotRefCount,
+                          e4gImage=e4gImage)
 
     def isBlank(self):
         """
         Returns True if screenshot is blank, otherwise False.
         """
-        return _e4gImageIsBlank(self._filename)
+        image, mustClose = self._openedE4gImage()
+        try:
+            return (eye4graphics.openedImageIsBlank(ctypes.c_void_p(image)) == 1)
+        finally:
+            if mustClose:
+                eye4graphics.closeImage(image)
+
+    def _tileHashGrid(self, tileSize=_g_tileSize):
+        """
+        Returns (columns, rows, hashes) where hashes contains hashes
+        of colors in tileSize x tileSize tiles in raster order.
+        """
+        if not tileSize in self._tileHashes:
+            width, height = self.size()
+            columns = (width + tileSize - 1) // tileSize
+            rows = (height + tileSize - 1) // tileSize
+            hashes = (ctypes.c_uint32 * (columns * rows))()
+            image, closeImage = self._openedE4gImage()
+            try:
+                if eye4graphics.tileHashes(hashes, ctypes.c_void_p(image),
+                                           tileSize, tileSize) < 0:
+                    raise ValueError("cannot hash tiles of %s" % (self,))
+            finally:
+                if closeImage:
+                    eye4graphics.closeImage(image)
+            self._tileHashes[tileSize] = (columns, rows, hashes)
+        return self._tileHashes[tileSize]
+
+    def _contentDigest(self):
+        """
+        Returns digest of the size and colors of the screenshot.
+        """
+        if self._digest == None:
+            hashes = self._tileHashGrid()[2]
+            self._digest = "%sx%s-%s" % (self.size() + (hashlib.sha1(
+                ctypes.string_at(hashes, ctypes.sizeof(hashes))).hexdigest(),))
+        return self._digest
+
+    def _changedTiles(self, other, tileSize=_g_tileSize):
+        """
+        Returns set of (column, row) of tiles that differ in this and
+        other screenshot, or None if the screenshots have different
+        sizes.
+        """
+        if self.size() != other.size():
+            return None
+        columns, rows, hashes = self._tileHashGrid(tileSize)
+        otherHashes = other._tileHashGrid(tileSize)[2]
+        return set((index % columns, index // columns)
+                   for index in xrange(columns * rows)
+                   if hashes[index] != otherHashes[index])
+
+    def changedRegions(self, other, tileSize=_g_tileSize):
+        """
+        Return list of regions where this screenshot differs from
+        other screenshot.
+
+        Parameters:
+
+          other (Screenshot):
+                  screenshot to be compared with.
+
+          tileSize (integer, optional):
+                  screenshots are compared in tileSize x tileSize
+                  pixel tiles. The default is 32.
+
+        Returns list of bounding boxes (left, top, right, bottom) of
+        adjacent changed tiles, ordered by their top-left tiles. If
+        the screenshots have different sizes, the whole screenshot
+        is changed. Empty list if screenshots are the same.
+        """
+        changed = self._changedTiles(other, tileSize)
+        width, height = self.size()
+        if changed == None:
+            return [(0, 0, width, height)]
+        regions = []
+        unvisited = set(changed)
+        for tile in sorted(changed, key=lambda (column, row): (row, column)):
+            if not tile in unvisited:
+                continue
+            unvisited.remove(tile)
+            left, top = right, bottom = tile
+            adjacent = [tile]
+            while adjacent:
+                column, row = adjacent.pop()
+                left, top = min(left, column), min(top, row)
+                right, bottom = max(right, column), max(bottom, row)
+                for neighbour in ((column - 1, row), (column + 1, row),
+                                  (column, row - 1), (column, row + 1)):
+                    if neighbour in unvisited:
+                        unvisited.remove(neighbour)
+                        adjacent.append(neighbour)
+            regions.append((left * tileSize, top * tileSize,
+                            min((right + 1) * tileSize, width),
+                            min((bottom + 1) * tileSize, height)))
+        return regions
 
     def setSize(self, screenSize):
         self._screenSize = screenSize
@@ -2762,9 +4757,10 @@ class Screenshot(object):
         Returns screenshot size in pixels, as pair (width, height).
         """
         if self._screenSize == None and allowReadingFile:
-            e4gImage = _e4gOpenImage(self._filename)
+            e4gImage, mustClose = self._openedE4gImage()
             self._screenSize = _e4gImageDimensions(e4gImage)
-            eye4graphics.closeImage(e4gImage)
+            if mustClose:
+                eye4graphics.closeImage(e4gImage)
         return self._screenSize
 
     def _notifyOcrEngine(self):
@@ -2788,7 +4784,8 @@ class Screenshot(object):
         """
         items = self.findItemsByHcr(**hcrArgs)
         eyenfinger.drawBboxes(self.filename(), filename,
-                             [i.bbox() for i in items])
+                             [i.bbox() for i in items],
+                             inputImage=self._openedE4gImage(openFile=False)[0])
 
     def dumpOcr(self, **kwargs):
         """
@@ -2806,11 +4803,22 @@ class Screenshot(object):
         return self.dumpOcr(**kwargs)
 
     def filename(self):
+        """
+        Returns the name of the screenshot file. Screenshots received
+        as raw data are written to the file on the first call.
+        """
+        if not self._fileWritten:
+            self._writeFile()
         return self._filename
 
     def _findFirstMatchingBitmapCandidate(self, bitmap, **oirArgs):
         for candidate in self._paths.abspaths(bitmap):
-            found = self._oirEngine.findBitmap(self, candidate, **oirArgs)
+            if self._perfStats:
+                found = self._perfStats.call(
+                    "oir.findBitmap", self._oirEngine.findBitmap,
+                    self, candidate, **oirArgs)
+            else:
+                found = self._oirEngine.findBitmap(self, candidate, **oirArgs)
             if found:
                 return found
         return []
@@ -2836,6 +4844,63 @@ class Screenshot(object):
         else:
             raise RuntimeError('Trying to use OIR on "%s" without OIR engine.' % (self.filename(),))
 
+    def findItemsByBitmaps(self, bitmaps, **oirFindArgs):
+        """
+        Find items matching to any of bitmaps.
+
+        Returns list of lists of GUIItems. The nth list contains
+        items that findItemsByBitmap would return for the nth
+        bitmap. The OIR engine may search for all bitmaps at once,
+        which is faster than calling findItemsByBitmap for each of
+        them.
+        """
+        if self._oirEngine == None:
+            raise RuntimeError('Trying to use OIR on "%s" without OIR engine.' % (self.filename(),))
+        self._notifyOirEngine()
+        # Each bitmap has a list of (oirArgs, candidate) search
+        # attempts. They are tried in the same order as
+        # findItemsByBitmap would try them, but the nth attempts of
+        # all bitmaps that share oirArgs are searched at once.
+        attempts = []
+        for bitmap in bitmaps:
+            oirArgsList = self._paths.oirArgsList(bitmap)
+            if oirArgsList:
+                argsList = []
+                for oirArgs in oirArgsList:
+                    oirArgs, _ = _takeOirArgs(self._oirEngine, oirArgs.copy())
+                    oirArgs.update(oirFindArgs)
+                    argsList.append(oirArgs)
+            else:
+                argsList = [oirFindArgs]
+            bitmapAttempts = [(oirArgs, candidate)
+                              for oirArgs in argsList
+                              for candidate in self._paths.abspaths(bitmap)]
+            bitmapAttempts.reverse()
+            attempts.append(bitmapAttempts)
+        results = [[] for bitmap in bitmaps]
+        unresolved = range(len(bitmaps))
+        while unresolved:
+            argGroups = {}
+            for index in unresolved:
+                oirArgs, candidate = attempts[index].pop()
+                argGroup = argGroups.setdefault(repr(sorted(oirArgs.items())),
+                                                (oirArgs, []))
+                argGroup[1].append((index, candidate))
+            for oirArgs, indexCandidates in argGroups.itervalues():
+                candidates = [candidate for _, candidate in indexCandidates]
+                if self._perfStats:
+                    foundItems = self._perfStats.call(
+                        "oir.findBitmaps", self._oirEngine.findBitmaps,
+                        self, candidates, **oirArgs)
+                else:
+                    foundItems = self._oirEngine.findBitmaps(
+                        self, candidates, **oirArgs)
+                for (index, _), items in zip(indexCandidates, foundItems):
+                    results[index] = list(items)
+            unresolved = [index for index in unresolved
+                          if not results[index] and attempts[index]]
+        return results
+
     def findItemsByDiff(self, image, colorMatch=1.0, limit=1, area=None):
         """
         Return list of items that differ in this and the reference images
@@ -2859,12 +4924,7 @@ class Screenshot(object):
         self._notifyOirEngine()
         try:
             # Open imageA and imageB for comparison
-            if (self.filename() in getattr(self._oirEngine, "_openedImages", {})):
-                # if possible, use already opened image object
-                imageA = self._oirEngine._openedImages[self.filename()]
-            else:
-                imageA = _e4gOpenImage(self.filename())
-                closeImageA = True
+            imageA, closeImageA = self._openedE4gImage()
             imageB = _e4gOpenImage(image)
             closeImageB = True
 
@@ -2899,7 +4959,7 @@ class Screenshot(object):
         return foundItems
 
     def findItemsByColor(self, rgb888, colorMatch=1.0, limit=1, area=None,
-                         invertMatch=False, group=""):
+                         invertMatch=False, group="", connectivity=4):
         """
         Return list of items that match given color.
 
@@ -2929,15 +4989,18 @@ class Screenshot(object):
                   group matching pixels to large items. Accepted
                   values are "adjacent" (group pixels that are next to
                   each other) and "" (no grouping). The default is "".
+
+          connectivity (optional, integer):
+                  pixels next to each other when grouping "adjacent"
+                  pixels. Accepted values are 4 (left, right, up and
+                  down) and 8 (diagonal pixels, too). The default is 4.
         """
+        if group not in ("", "adjacent"):
+            raise ValueError('invalid group "%s"' % (group,))
+        if connectivity not in (4, 8):
+            raise ValueError('invalid connectivity %s' % (connectivity,))
         self._notifyOirEngine()
-        if (self.filename() in getattr(self._oirEngine, "_openedImages", {})):
-            # if possible, use already opened image object
-            image = self._oirEngine._openedImages[self.filename()]
-            closeImage = False
-        else:
-            image = _e4gOpenImage(self.filename())
-            closeImage = True
+        image, closeImage = self._openedE4gImage()
         bbox = _Bbox(-1, 0, 0, 0, 0)
         color = _Rgb888(*rgb888)
         ssSize = self.size()
@@ -2947,9 +5010,16 @@ class Screenshot(object):
                                   _intCoords((area[2], area[3]), ssSize) +
                                   (0,))
         areaBbox = _Bbox(*leftTopRightBottomZero)
+        if invertMatch:
+            comp = "!="
+        else:
+            comp = "=="
         foundItems = []
-        coord2item = {} # (x, y) -> viewItem
         try:
+            if group == "adjacent":
+                return self._findColorRegions(
+                    image, rgb888, color, colorMatch, limit, areaBbox,
+                    invertMatch, connectivity, comp)
             while limit != 0:
                 found = eye4graphics.findNextColor(
                     ctypes.byref(bbox),
@@ -2965,65 +5035,60 @@ class Screenshot(object):
                 foundRgb = (foundColor >> 16 & 0xff,
                             foundColor >> 8 & 0xff,
                             foundColor & 0xff)
-                if invertMatch:
-                    comp = "!="
-                else:
-                    comp = "=="
-                if not group:
-                    foundItems.append(
-                        GUIItem("RGB#%.2x%.2x%.2x%s%.2x%.2x%.2x (%s)" %
-                                (rgb888 + (comp,) + foundRgb + (colorMatch,)),
-                                (bbox.left, bbox.top, bbox.right, bbox.bottom),
-                                self))
-                    limit -= 1
-                elif group == "adjacent":
-                    x = bbox.left
-                    y = bbox.top
-                    itemA = None
-                    itemB = None
-                    if (x-1, y) in coord2item:
-                        # AAAx
-                        itemA = coord2item[(x-1, y)]
-                        if itemA._bbox[2] < x: # right < x
-                            itemA._bbox = (itemA._bbox[0], itemA._bbox[1], x, itemA._bbox[3])
-                        coord2item[(x, y)] = itemA
-                    if (x, y-1) in coord2item:
-                        # BBB
-                        # x
-                        itemB = coord2item[(x, y-1)]
-                        if itemB._bbox[3] < y: # bottom < y
-                            itemB._bbox = (itemB._bbox[0], itemB._bbox[1], itemB._bbox[2], y)
-                        coord2item[(x, y)] = itemB
-                        if itemA:
-                            #    BBB
-                            # AAAx
-                            if itemB != itemA:
-                                itemB._bbox = (min(itemA._bbox[0], itemB._bbox[0]),
-                                               min(itemA._bbox[1], itemB._bbox[1]),
-                                               max(itemA._bbox[2], itemB._bbox[2]),
-                                               max(itemA._bbox[3], itemB._bbox[3]))
-                                for ax in xrange(itemA._bbox[0], itemA._bbox[2]+1):
-                                    for ay in xrange(itemA._bbox[1], itemA._bbox[3]+1):
-                                        if coord2item.get((ax, ay), None) == itemA:
-                                            coord2item[(ax, ay)] = itemB
-                                foundItems.remove(itemA)
-                                limit += 1
-                    if not itemA and not itemB:
-                        itemA = GUIItem("RGB#%.2x%.2x%.2x%s%.2x%.2x%.2x (%s)" %
-                                (rgb888 + (comp,) + foundRgb + (colorMatch,)),
-                                (bbox.left, bbox.top, bbox.right, bbox.bottom),
-                                self)
-                        limit -= 1
-                        foundItems.append(itemA)
-                        coord2item[(x, y)] = itemA
+                foundItems.append(
+                    GUIItem("RGB#%.2x%.2x%.2x%s%.2x%.2x%.2x (%s)" %
+                            (rgb888 + (comp,) + foundRgb + (colorMatch,)),
+                            (bbox.left, bbox.top, bbox.right, bbox.bottom),
+                            self))
+                limit -= 1
         finally:
             if closeImage:
                 eye4graphics.closeImage(image)
         return foundItems
 
+    def _findColorRegions(self, image, rgb888, color, colorMatch, limit,
+                          areaBbox, invertMatch, connectivity, comp):
+        if limit == 0:
+            return []
+        if limit > 0:
+            maxRegions = limit
+        else:
+            maxRegions = 256
+        while True:
+            regions = (_ColorRegion * maxRegions)()
+            regionCount = eye4graphics.findColorRegions(
+                regions, maxRegions,
+                ctypes.c_void_p(image),
+                ctypes.byref(color),
+                ctypes.c_double(colorMatch),
+                ctypes.c_double(1.0), # opacityLimit
+                ctypes.c_int(invertMatch),
+                ctypes.byref(areaBbox),
+                ctypes.c_int(connectivity))
+            if regionCount < 0:
+                raise ValueError("invalid color region search parameters")
+            if limit > 0 or regionCount <= maxRegions:
+                break
+            maxRegions = regionCount
+        foundItems = []
+        for region in regions[:min(regionCount, maxRegions)]:
+            foundRgb = (region.color >> 16 & 0xff,
+                        region.color >> 8 & 0xff,
+                        region.color & 0xff)
+            foundItems.append(
+                GUIItem("RGB#%.2x%.2x%.2x%s%.2x%.2x%.2x (%s)" %
+                        (rgb888 + (comp,) + foundRgb + (colorMatch,)),
+                        (region.left, region.top, region.right, region.bottom),
+                        self))
+        return foundItems
+
     def findItemsByOcr(self, text, **ocrEngineArgs):
         if self._ocrEngine != None:
             self._notifyOcrEngine()
+            if self._perfStats:
+                return self._perfStats.call(
+                    "ocr.findText", self._ocrEngine.findText,
+                    self, text, **ocrEngineArgs)
             return self._ocrEngine.findText(self, text, **ocrEngineArgs)
         else:
             raise RuntimeError('Trying to use OCR on "%s" without OCR engine.' % (self.filename(),))
@@ -3035,14 +5100,15 @@ class Screenshot(object):
         Experimental. See if it finds regions that could be
         interacted with.
         """
-        ppFilename = "%s-hcrpp.png" % (self.filename(),)
-        _convert(self.filename(),
-                 ["-colorspace", "gray", "-depth", "3"],
-                 ppFilename)
+        hcrArgs = ["-colorspace", "gray", "-depth", "3"]
+        image = self._convertedE4gImage(hcrArgs)
+        if image == None:
+            ppFilename = "%s-hcrpp.png" % (self.filename(),)
+            _convert(self.filename(), hcrArgs, ppFilename)
+            image = _e4gOpenImage(ppFilename)
         bbox = _Bbox(0, 0, 0, 0, 0)
         foundItems = []
         try:
-            image = _e4gOpenImage(ppFilename)
             while True:
                 if eye4graphics.findNextHighErrorBlock(ctypes.byref(bbox), image, xRes, yRes, threshold, 0) == 0:
                     break
@@ -3070,13 +5136,7 @@ class Screenshot(object):
         x, y = _intCoords((x, y), (xsize, ysize))
         if not (0 <= x < xsize and 0 <= y < ysize):
             raise ValueError("invalid coordinates (%s, %s)" % (x, y))
-        if (self.filename() in getattr(self._oirEngine, "_openedImages", {})):
-            # if possible, use already opened image object
-            image = self._oirEngine._openedImages[self.filename()]
-            closeImage = False
-        else:
-            image = _e4gOpenImage(self.filename())
-            closeImage = True
+        image, closeImage = self._openedE4gImage()
         try:
             color = _Rgb888(0, 0, 0)
             v = eye4graphics.rgb888at(ctypes.byref(color),
@@ -3091,6 +5151,90 @@ class Screenshot(object):
             if closeImage:
                 eye4graphics.closeImage(image)
 
+    def pixels(self):
+        """
+        Return pixels of the screenshot as a read-only NumPy array.
+
+        The array has shape (height, width, 3), dtype uint8 and
+        (red, green, blue) values in the last dimension. It shares
+        memory with the screenshot image: creating the array does not
+        copy pixels, and the image is kept in memory as long as the
+        array exists, even after release(). Requires NumPy.
+
+        Example: check that at least half of a progress bar is green
+          p = sut.screenshot().pixels()[100, 20:220]
+          green = (p[:, 1] > 200) & (p[:, 0] < 50) & (p[:, 2] < 50)
+          assert green.sum() >= 100
+        """
+        import numpy
+        if not self._e4gImage:
+            # the array may outlive an image opened for the caller
+            # only or cached by the OIR engine, open a private copy
+            self._e4gImage = _e4gOpenImage(self._filename)
+            self._e4gImageOwner = _OpenedE4gImage(self._e4gImage)
+        layout = _PixelLayout(0, 0, 0, 0)
+        address = eye4graphics.openedImagePixels(
+            ctypes.c_void_p(self._e4gImage), ctypes.byref(layout))
+        if (not address or
+            layout.blue - layout.green != layout.green - layout.red):
+            raise NotImplementedError(
+                "pixels of %s cannot be accessed as 8-bit colors" % (self,))
+        return numpy.asarray(_PixelBuffer(
+            self._e4gImageOwner, address, self.size(), layout))
+
+    def colorHistogram(self, area=(0.0, 0.0, 1.0, 1.0)):
+        """
+        Return number of pixels of each red, green and blue value.
+
+        Parameters:
+
+          area ((left, top, right, bottom), optional):
+                  subregion in the screenshot from which pixels are
+                  counted. The default is (0.0, 0.0, 1.0, 1.0), that
+                  is whole screen.
+
+        Returns tuple of three lists of 256 integers: (reds, greens,
+        blues). reds[i] is the number of pixels with red value i.
+        """
+        ssSize = self.size()
+        areaBbox = _Bbox(*(_intCoords((area[0], area[1]), ssSize) +
+                           _intCoords((area[2], area[3]), ssSize) +
+                           (0,)))
+        histogram = (ctypes.c_uint32 * (3 * 256))()
+        image, closeImage = self._openedE4gImage()
+        try:
+            count = eye4graphics.colorHistogram(
+                histogram, ctypes.c_void_p(image), ctypes.byref(areaBbox))
+        finally:
+            if closeImage:
+                eye4graphics.closeImage(image)
+        if count < 0:
+            raise ValueError("cannot count colors of %s" % (self,))
+        return (list(histogram[0:256]),
+                list(histogram[256:512]),
+                list(histogram[512:768]))
+
+    def meanColor(self, area=(0.0, 0.0, 1.0, 1.0)):
+        """
+        Return mean color of pixels in the area.
+
+        Parameters:
+
+          area ((left, top, right, bottom), optional):
+                  subregion in the screenshot. The default is
+                  (0.0, 0.0, 1.0, 1.0), that is whole screen.
+
+        Returns tuple of floats: (red, green, blue), or None if
+        the area is empty.
+        """
+        histograms = self.colorHistogram(area)
+        pixelCount = sum(histograms[0])
+        if pixelCount == 0:
+            return None
+        return tuple(
+            float(sum(value * count for value, count in enumerate(h))) / pixelCount
+            for h in histograms)
+
     def ocrItems(self, **ocrArgs):
         """
         Return list of GUIItems, each of them corresponding to a word
@@ -3117,7 +5261,7 @@ class Screenshot(object):
           fileOrDirName (string):
                   name of the destination file or directory.
         """
-        shutil.copy(self._filename, fileOrDirName)
+        shutil.copy(self.filename(), fileOrDirName)
 
     def crop(self, area):
         """
@@ -3138,27 +5282,21 @@ class Screenshot(object):
         x2, y2 = _intCoords((right, bottom), self.size())
         cropCoords = "%sx%s+%s+%s" % (x2-x1, y2-y1, x1, y1)
         croppedFilename = self._filename + "-crop_%s.png" % (cropCoords,)
-        _convert(self._filename, ["-crop", cropCoords], croppedFilename)
-        return Screenshot(croppedFilename, self._paths, self._ocrEngine,
-                          self._oirEngine, self._screenshotRefCount)
+        return self._convert(["-crop", cropCoords], croppedFilename)
 
     def flop(self):
         """
         Return horizontally flopped copy of the screenshot.
         """
         resultFilename = self._filename + "-flop.png"
-        _convert(self._filename, ["-flop"], resultFilename)
-        return Screenshot(resultFilename, self._paths, self._ocrEngine,
-                          self._oirEngine, self._screenshotRefCount)
+        return self._convert(["-flop"], resultFilename)
 
     def flip(self):
         """
         Return vertically flipped copy of the screenshot.
         """
         resultFilename = self._filename + "-flip.png"
-        _convert(self._filename, ["-flip"], resultFilename)
-        return Screenshot(resultFilename, self._paths, self._ocrEngine,
-                          self._oirEngine, self._screenshotRefCount)
+        return self._convert(["-flip"], resultFilename)
 
     def ocrEngine(self):
         return self._ocrEngine
@@ -3204,6 +5342,144 @@ class GUIItem(object):
         return ('GUIItem("%s", bbox=%s%s)'  % (
                 self.name(), self.bbox(), extras))
 
+class _GUIItemArray(object):
+    """
+    Read-only list of GUIItems stored as an array of bounding box
+    coordinates. GUIItem objects are created when accessed.
+    OirEngine.findBitmap returns the items in a list.
+    """
+    def __init__(self, name, bboxes, screenshot, bitmap=None):
+        self._name = name
+        self._bboxes = bboxes # array of left, top, right, bottom
+        self._screenshot = screenshot
+        self._bitmap = bitmap
+        self._items = [None] * (len(bboxes) / 4)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self._items)
+        if self._items[index] == None:
+            self._items[index] = GUIItem(
+                self._name, tuple(self._bboxes[index * 4:index * 4 + 4]),
+                self._screenshot, bitmap=self._bitmap)
+        return self._items[index]
+
+    def __iter__(self):
+        for index in xrange(len(self._items)):
+            yield self[index]
+
+    def __eq__(self, other):
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+def _openVisualLogFile(filename):
+    if filename.endswith(".gz"):
+        return gzip.GzipFile(filename, "w")
+    else:
+        return file(filename, "w")
+
+# Image ages in the visual log are resolved by the writer thread, so
+# that logging calls do not stat image files. The placeholder
+# contains the time of logging and the image filename.
+_g_imgAgePlaceholder = re.compile("\x00imgage:([0-9.]+):([^\x00]*)\x00")
+
+def _imgAgeAttr(match):
+    try:
+        imgAge = float(match.group(1)) - os.stat(match.group(2)).st_mtime
+    except OSError:
+        return ""
+    if imgAge > 0:
+        return ' data-imgage="%s"' % (imgAge,)
+    else:
+        return ""
+
+_g_visualLogWriters = weakref.WeakKeyDictionary()
+
+def _closeVisualLogWriters():
+    for writer in _g_visualLogWriters.keys():
+        writer.close()
+
+atexit.register(_closeVisualLogWriters)
+
+class _VisualLogWriter(object):
+    """
+    Writes visual log in a background thread. Writes queued between
+    two rounds of the thread are written to the file and flushed at
+    once.
+    """
+    def __init__(self, queueSize=_g_visualLogQueueSize):
+        self._queue = Queue.Queue(queueSize)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _g_visualLogWriters[self] = None
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            try:
+                while True:
+                    items.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+            try:
+                self._writeItems(items)
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+            if items[-1] == None:
+                return
+
+    def _writeItems(self, items):
+        # write consecutive strings to the same file at once
+        fileObj, batch = None, []
+        for item in items + [None]:
+            if item != None and item[0] is fileObj:
+                batch.append(item[1])
+                continue
+            if batch:
+                try:
+                    fileObj.write(_g_imgAgePlaceholder.sub(
+                        _imgAgeAttr, "".join(batch)))
+                    fileObj.flush()
+                except Exception, e:
+                    _fmbtLog("writing visual log failed: %s" % (e,))
+            if item != None:
+                fileObj, batch = item[0], [item[1]]
+
+    def write(self, fileObj, s):
+        self._queue.put((fileObj, s))
+
+    def flush(self):
+        """
+        Wait until everything written so far is in files.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Write everything and stop the writer thread.
+        """
+        if self._thread.isAlive():
+            self._queue.put(None)
+            self._thread.join()
+
 class _VisualLog:
     def __init__(self, device, outFileObj,
                  screenshotWidth, thumbnailWidth,
@@ -3229,6 +5505,7 @@ class _VisualLog:
         self._userFrameId = 0
         self._userFunction = ""
         self._userCallCount = 0
+        self._writer = None
         eyenfinger.iSetDefaultDelayedDrawing(delayedDrawing)
         device.refreshScreenshot = self.refreshScreenshotLogger(device.refreshScreenshot)
         device.tap = self.tapLogger(device.tap)
@@ -3279,6 +5556,9 @@ class _VisualLog:
                     html.append('') # end call
                 html.append('</body></html>') # end html
                 self.write('\n'.join(html))
+            if self._writer:
+                self._writer.close()
+                self._writer = None
             if (self._formattedOutFilename and
                 "%" in self._outFilename):
                 # Files with strftime-formatted names are opened and
@@ -3286,7 +5566,9 @@ class _VisualLog:
                 # own by someone else.
                 if hasattr(self._outFileObj, "close"):
                     self._outFileObj.close()
-                if os.stat(self._formattedOutFilename).st_size == 0:
+                # Do not check the file size, an empty gzip file
+                # still contains gzip header and trailer.
+                if self._bytesToFile == 0:
                     os.remove(self._formattedOutFilename)
             # File instance should be closed by the opener
             self._outFileObj = None
@@ -3294,13 +5576,14 @@ class _VisualLog:
     def open(self, newFormattedFilename):
         self._bytesToFile = 0
         self._formattedOutFilename = newFormattedFilename
-        self._outFileObj = file(self._formattedOutFilename, "w")
+        self._outFileObj = _openVisualLogFile(self._formattedOutFilename)
 
     def write(self, s):
         self._bytesToFile += len(s)
         if self._outFileObj != None:
-            self._outFileObj.write(s)
-            self._outFileObj.flush()
+            if self._writer == None:
+                self._writer = _VisualLogWriter()
+            self._writer.write(self._outFileObj, s)
 
     def timestamp(self, t=None):
         return fmbt.formatTime(self._timeFormat, t)
@@ -3637,10 +5920,10 @@ initializejQuery(function() {
             x2, y2 = args[1]
             retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
             try:
-                screenshotFilename = loggerSelf._device.screenshot().filename()
-                highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
                 iC = loggerSelf._device.intCoords
-                eyenfinger.drawLines(screenshotFilename, highlightFilename, [], [iC((x1, y1)), iC((x2, y2))])
+                highlightFilename = loggerSelf.drawHighlight(
+                    loggerSelf._device.screenshot(), eyenfinger.drawLines,
+                    [], [iC((x1, y1)), iC((x2, y2))])
                 loggerSelf.logReturn(retval, img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name)
             except:
                 loggerSelf.logReturn(str(retval) + " (no screenshot available)", tip=origMethod.func_name)
@@ -3655,8 +5938,19 @@ initializejQuery(function() {
             if retval != None:
                 retval._logCallReturnValue = logCallReturnValue
                 loggerSelf.logReturn(retval, img=retval, tip=origMethod.func_name)
-                retval.findItemsByBitmap = loggerSelf.findItemsByBitmapLogger(retval.findItemsByBitmap, retval)
-                retval.findItemsByOcr = loggerSelf.findItemsByOcrLogger(retval.findItemsByOcr, retval)
+                # Wrappers stored in the screenshot refer to it only
+                # weakly. Otherwise the screenshot would not be freed
+                # before garbage collection, and as it has __del__,
+                # not even by that. Wrapped methods are called with
+                # the screenshot itself, as OIR and OCR engines
+                # identify screenshots by id().
+                screenshotRef = weakref.ref(retval)
+                retval.findItemsByBitmap = loggerSelf.findItemsByBitmapLogger(
+                    type(retval).findItemsByBitmap.im_func, screenshotRef)
+                retval.findItemsByBitmaps = loggerSelf.findItemsByBitmapsLogger(
+                    type(retval).findItemsByBitmaps.im_func, screenshotRef)
+                retval.findItemsByOcr = loggerSelf.findItemsByOcrLogger(
+                    type(retval).findItemsByOcr.im_func, screenshotRef)
             else:
                 loggerSelf.logReturn(retval, tip=origMethod.func_name)
             return retval
@@ -3667,17 +5961,18 @@ initializejQuery(function() {
             loggerSelf.logCall()
             retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
             try:
-                screenshotFilename = loggerSelf._device.screenshot().filename()
-                highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
-                eyenfinger.drawClickedPoint(screenshotFilename, highlightFilename, loggerSelf._device.intCoords(args[0]))
+                highlightFilename = loggerSelf.drawHighlight(
+                    loggerSelf._device.screenshot(), eyenfinger.drawClickedPoint,
+                    loggerSelf._device.intCoords(args[0]))
                 loggerSelf.logReturn(retval, img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=loggerSelf._device.screenshot()._logCallReturnValue)
             except:
                 loggerSelf.logReturn(str(retval) + " (no screenshot available)", tip=origMethod.func_name)
             return retval
         return tapWRAP
 
-    def findItemsByBitmapLogger(loggerSelf, origMethod, screenshotObj):
+    def findItemsByBitmapLogger(loggerSelf, origMethod, screenshotRef):
         def findItemsByBitmapWRAP(*args, **kwargs):
+            screenshotObj = screenshotRef()
             bitmap = args[0]
             absPathBitmap = screenshotObj._paths.abspaths(bitmap)[0]
             if loggerSelf._copyBitmapsToScreenshotDir:
@@ -3703,30 +5998,52 @@ initializejQuery(function() {
                     absPathBitmap = screenshotDirBitmap
 
             loggerSelf.logCall(img=absPathBitmap)
-            retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
+            retval = loggerSelf.doCallLogException(origMethod, (screenshotObj,) + args, kwargs)
             if len(retval) == 0:
                 loggerSelf.logReturn("not found in", img=screenshotObj, tip=origMethod.func_name)
             else:
                 foundItems = retval
-                screenshotFilename = screenshotObj.filename()
-                highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
-                eyenfinger.drawIcon(screenshotFilename, highlightFilename, foundItems[0]._bitmap, [i.bbox() for i in foundItems])
+                highlightFilename = loggerSelf.drawHighlight(
+                    screenshotObj, eyenfinger.drawIcon,
+                    foundItems[0]._bitmap, [i.bbox() for i in foundItems])
                 loggerSelf.logReturn([str(quiItem) for quiItem in retval], img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=screenshotObj._logCallReturnValue)
             return retval
         return findItemsByBitmapWRAP
 
-    def findItemsByOcrLogger(loggerSelf, origMethod, screenshotObj):
+    def findItemsByBitmapsLogger(loggerSelf, origMethod, screenshotRef):
+        def findItemsByBitmapsWRAP(*args, **kwargs):
+            screenshotObj = screenshotRef()
+            loggerSelf.logCall()
+            retval = loggerSelf.doCallLogException(origMethod, (screenshotObj,) + args, kwargs)
+            foundItemLists = [items for items in retval if items]
+            if len(foundItemLists) == 0:
+                loggerSelf.logReturn("none found in", img=screenshotObj, tip=origMethod.func_name)
+            else:
+                highlightFilename = loggerSelf.drawHighlight(
+                    screenshotObj, eyenfinger.drawIcon,
+                    foundItemLists[0][0]._bitmap,
+                    [i.bbox() for i in foundItemLists[0]])
+                for foundItems in foundItemLists[1:]:
+                    eyenfinger.drawIcon(highlightFilename, highlightFilename,
+                                        foundItems[0]._bitmap,
+                                        [i.bbox() for i in foundItems])
+                loggerSelf.logReturn([[str(guiItem) for guiItem in items] for items in retval], img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=screenshotObj._logCallReturnValue)
+            return retval
+        return findItemsByBitmapsWRAP
+
+    def findItemsByOcrLogger(loggerSelf, origMethod, screenshotRef):
         def findItemsByOcrWRAP(*args, **kwargs):
+            screenshotObj = screenshotRef()
             loggerSelf.logCall()
-            retval = loggerSelf.doCallLogException(origMethod, args, kwargs)
+            retval = loggerSelf.doCallLogException(origMethod, (screenshotObj,) + args, kwargs)
             if len(retval) == 0:
                 loggerSelf.logReturn("not found in words " + str(screenshotObj.dumpOcrWords()),
                                      img=screenshotObj, tip=origMethod.func_name)
             else:
                 foundItem = retval[0]
-                screenshotFilename = screenshotObj.filename()
-                highlightFilename = loggerSelf.highlightFilename(screenshotFilename)
-                eyenfinger.drawIcon(screenshotFilename, highlightFilename, args[0], foundItem.bbox())
+                highlightFilename = loggerSelf.drawHighlight(
+                    screenshotObj, eyenfinger.drawIcon,
+                    args[0], foundItem.bbox())
                 for appearance, foundItem in enumerate(retval[1:42]):
                     eyenfinger.drawIcon(highlightFilename, highlightFilename, str(appearance+1) + ": " + args[0], foundItem.bbox())
                 loggerSelf.logReturn([str(retval[0])], img=highlightFilename, width=loggerSelf._screenshotWidth, tip=origMethod.func_name, imgTip=screenshotObj._logCallReturnValue)
@@ -3743,32 +6060,20 @@ initializejQuery(function() {
     def imgToHtml(self, img, width="", imgTip="", imgClass=""):
         if imgClass: imgClassAttr = 'class="%s" ' % (imgClass,)
         else: imgClassAttr = ""
-        imgAge = 0
         imgAgeAttr = ""
         if isinstance(img, Screenshot):
             #We must use the original screenshot modification time
-            try:
-                imgAge = time.time() - os.stat(self.unHighlightFilename(img.filename())).st_mtime
-            except:
-                #The file returned by unHighlightFilename did not exist.
-                pass
-            if imgAge > 0:
-                imgAgeAttr = ' data-imgage="%s"' % (imgAge,)
+            imgAgeAttr = self.imgAgeAttr(self.unHighlightFilename(img.filename()))
             imgHtmlName = self.relFilePath(img.filename(), self._outFileObj)
             imgHtml = '\n<div class="spacer"><img %s title="%s" src="%s" width="%s" alt="%s"%s/></div>' % (
                 imgClassAttr,
                 "%s refreshScreenshot() at %s:%s" % img._logCallReturnValue,
                 imgHtmlName, self._screenshotWidth, imgHtmlName, imgAgeAttr)
         elif img:
-            try:
-                imgAge = time.time() - os.stat(self.unHighlightFilename(img)).st_mtime
-            except:
-                pass
             if width: width = 'width="%s"' % (width,)
             if type(imgTip) == tuple and len(imgTip) == 3:
                 imgTip = 'title="%s refreshScreenshot() at %s:%s"' % imgTip
-                if imgAge > 0:
-                    imgAgeAttr = ' data-imgage="%s"' % (imgAge,)
+                imgAgeAttr = self.imgAgeAttr(self.unHighlightFilename(img))
             else:
                 imgTip = 'title="%s"' % (imgTip,)
             imgHtmlName = self.relFilePath(img, self._outFileObj)
@@ -3778,6 +6083,11 @@ initializejQuery(function() {
             imgHtml = ""
         return "\n" + imgHtml + "\n"
 
+    def imgAgeAttr(self, imgFilename):
+        """Returns placeholder for data-imgage attribute that the
+        writer thread replaces with the age of the image file"""
+        return "\x00imgage:%.6f:%s\x00" % (time.time(), imgFilename.replace("\x00", ""))
+
     def unHighlightFilename(self, screenshotFilename):
         '''Get the filename of the original screenshot based on
         the name of a highlighted screenshot.'''
@@ -3794,6 +6104,19 @@ initializejQuery(function() {
         retval = screenshotFilename + "." + str(self._highlightCounter).zfill(5) + ".png"
         return retval
 
+    def drawHighlight(self, screenshotObj, drawFunc, *args, **kwargs):
+        """
+        Draw on a copy of screenshotObj with an eyenfinger draw*
+        function, return the name of the highlighted image file.
+        Already opened screenshot image is drawn on without reading
+        the screenshot file.
+        """
+        screenshotFilename = screenshotObj.filename()
+        highlightFilename = self.highlightFilename(screenshotFilename)
+        kwargs["inputImage"] = screenshotObj._openedE4gImage(openFile=False)[0]
+        drawFunc(screenshotFilename, highlightFilename, *args, **kwargs)
+        return highlightFilename
+
     def changeCodeName(self, func, newName):
         c = func.func_code
         func.func_name = newName
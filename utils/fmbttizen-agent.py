@@ -732,6 +732,27 @@ def mtLinearGesture(listOfStartEndPoints, duration, movePoints, sleepBeforeMove=
         mtGestureEnd(finger)
     return True, None
 
+def inputSequence(events, button=1):
+    # events: [(event, x, y, tOffset), ...], event is "down", "move" or "up"
+    startTime = time.time()
+    for event, x, y, tOffset in events:
+        delay = startTime + tOffset - time.time()
+        if delay > 0: time.sleep(delay)
+        if g_Xavailable:
+            libXtst.XTestFakeMotionEvent(display, current_screen, x, y, X_CurrentTime)
+            if event == "down":
+                libXtst.XTestFakeButtonEvent(display, button, X_True, X_CurrentTime)
+            elif event == "up":
+                libXtst.XTestFakeButtonEvent(display, button, X_False, X_CurrentTime)
+            libX11.XFlush(display)
+        else:
+            if event == "down": rv, msg = sendHwFingerDown(x, y, button-1)
+            elif event == "move": rv, msg = sendHwMove(x, y)
+            elif event == "up": rv, msg = sendHwFingerUp(x, y, button-1)
+            else: rv, msg = False, 'invalid input event "%s"' % (event,)
+            if not rv: return rv, msg
+    return True, None
+
 def typeCharX(origChar):
     modifiers = []
     c         = specialCharToXString(origChar)
@@ -1131,6 +1152,12 @@ if __name__ == "__main__":
             else:
                 rv, skippedSymbols = subAgentCommand("root", "tizen", cmd)
             write_response(rv, skippedSymbols)
+        elif cmd.startswith("is "): # send input sequence
+            if g_Xavailable or iAmRoot:
+                rv, msg = inputSequence(_decode(cmd[3:]))
+            else:
+                rv, msg = subAgentCommand("root", "tizen", cmd)
+            write_response(rv, msg)
         elif cmd.startswith("ml "): # send multitouch linear gesture
             if iAmRoot:
                 rv, _ = mtLinearGesture(*_decode(cmd[3:]))
@@ -768,7 +768,7 @@ class TizenDeviceConnection(fmbtgti.GUITestConnection):
             l = l.strip()
 
     def _agentCmd(self, command, retry=3):
-        if command[:2] in ["tt", "td", "tm", "tu", "er"]:
+        if command[:2] in ["tt", "td", "tm", "tu", "is", "er"]:
             # Operating on coordinates on with a touch devices
             # may require information on screen resolution.
             # The agent does not know about possible rotation, so
@@ -839,6 +839,9 @@ class TizenDeviceConnection(fmbtgti.GUITestConnection):
     def sendTouchUp(self, x, y):
         return self._agentCmd("tu %s %s 1" % (x, y))[0]
 
+    def sendInputSequence(self, events):
+        return self._agentCmd("is %s" % (_encode(events),))[0]
+
     def sendType(self, string):
         return self._agentCmd("kt %s" % (_encode(string)))[0]
 
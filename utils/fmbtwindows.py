@@ -1997,6 +1997,18 @@ class WindowsConnection(fmbtgti.GUITestConnection):
             os.remove(ppmfilename)
         return True
 
+    def recvScreenshotData(self, screenshotSize=(None, None)):
+        if screenshotSize == (None, None):
+            screenshotSize = self._screenshotSize
+
+        width, height, zdata = self._agent.eval_in(
+            self._agent_ns, "screenshotZYBGR(%s)" % (repr(screenshotSize),))
+
+        data = zlib.decompress(zdata)
+
+        fmbtgti.eye4graphics.wbgr2rgb(data, width, height)
+        return (width, height, "RGB", data)
+
     def recvTopWindowProperties(self):
         return self.evalPython("topWindowProperties()")
 
@@ -2273,6 +2285,14 @@ class WindowsConnection(fmbtgti.GUITestConnection):
         self._agent.eval_in(self._agent_ns, command)
         return True
 
+    def sendInputSequence(self, events, button=None):
+        displayEvents = []
+        for event, x, y, tOffset in events:
+            x, y = self._screenToDisplay(x, y)
+            displayEvents.append((event, x, y, tOffset))
+        command = "sendInputSequence(%r, %r)" % (displayEvents, button)
+        return self._agent.eval_in(self._agent_ns, command)
+
     def sendPinch(self, *args):
         self.evalPython("touchPinch%s" % (args,))
         return True
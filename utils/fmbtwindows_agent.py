@@ -830,6 +830,36 @@ def sendMouseMove(x, y, button=1):
     event = Mouse(flags, x, y, 0)
     return sendInput(event)
 
+def sendInputSequence(events, button=None):
+    """
+    Send touch events, or mouse events if button is given. events is
+    a list of (event, x, y, tOffset), where event is "down", "move"
+    or "up" and tOffset is seconds from the start of the sequence.
+    """
+    startTime = time.time()
+    for event, x, y, tOffset in events:
+        delay = startTime + tOffset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if button == None:
+            if event == "down":
+                touchDown(x, y)
+            elif event == "move":
+                touchMove(x, y)
+            elif event == "up":
+                touchUp(x, y)
+            else:
+                return False
+        else:
+            sendMouseMove(x, y, button)
+            if event == "down":
+                sendMouseDown(button)
+            elif event == "up":
+                sendMouseUp(button)
+            elif event != "move":
+                return False
+    return True
+
 def windowList():
     windows = []
     def enumWindowsProc(hwnd, p):
@@ -388,6 +388,22 @@ class Display(object):
         libX11.XDestroyImage(image_p)
         return compressed_image
 
+    def recvScreenshotData(self):
+        """Returns (width, height, pixelOrder, data) of uncompressed
+        screenshot, or None if the image layout is not supported"""
+        image_p = libX11.XGetImage(self._display, self._root_window,
+                                   0, 0, self._width, self._height,
+                                   _X_AllPlanes, _X_ZPixmap)
+        image = image_p[0]
+        if (image.bits_per_pixel == 32 and
+            image.bytes_per_line == image.width * 4):
+            rawdata = ctypes.string_at(image.data, image.height * image.bytes_per_line)
+            screenshot_data = (image.width, image.height, "BGRP", rawdata)
+        else:
+            screenshot_data = None
+        libX11.XDestroyImage(image_p)
+        return screenshot_data
+
     def recvScreenUpdated(self, waitTime, pollDelay):
         return None # optimization not implemented
 
@@ -90,6 +90,8 @@ scripts = lines[lines.index("# scripts")+1:
                 lines.index("# end of scripts")]
 
 eye4graphcs_buildflags = pkg_config("MagickCore")
+if os.name != "nt":
+    eye4graphcs_buildflags["libraries"].append("pthread")
 ext_eye4graphics = Extension('eye4graphics',
                              sources = ['eye4graphics.cc'],
                              **eye4graphcs_buildflags)